@@ -0,0 +1,117 @@
+"""
+Synthetic documents for the benchmarks. A document is a JSON layout of pages made of text
+paragraphs and tables, which the fake Form Recognizer turns into an analyzeResult.
+"""
+import json
+import random
+
+WORDS = (
+    "the pipeline ingestion document section embedding summary keyphrase index search vector "
+    "storage container batch event topic subscriber publisher service cluster replica latency "
+    "throughput contract invoice agreement payment delivery customer supplier warranty clause "
+    "liability amendment schedule appendix revenue forecast quarter annual report analysis"
+).split()
+
+UNICODE_WORDS = (
+    "überprüfung straße naïve façade 東京 データ 검색 문서 поиск документ αναζήτηση "
+    "تحليل 🚀 résumé coöperatie ελέγχου"
+).split()
+
+
+def sentence(rng, words):
+    text = " ".join(rng.choice(words) for _ in range(rng.randint(6, 24)))
+    return text[0].upper() + text[1:] + rng.choice(".!?")
+
+
+def paragraph(rng, words, sentences):
+    return " ".join(sentence(rng, words) for _ in range(sentences))
+
+
+def table(rng, words, rows, columns):
+    return {"rows": [[" ".join(rng.choice(words) for _ in range(rng.randint(1, 4))) for _ in range(columns)]
+                     for _ in range(rows)]}
+
+
+def generate_document(rng, pages, paragraphs_per_page=6, sentences_per_paragraph=5, tables_per_page=0,
+                      table_rows=8, table_columns=5, unicode=False):
+    words = WORDS + UNICODE_WORDS if unicode else WORDS
+    document = {"pages": []}
+    for _ in range(pages):
+        blocks = [paragraph(rng, words, sentences_per_paragraph) for _ in range(paragraphs_per_page)]
+        for _ in range(tables_per_page):
+            blocks.insert(rng.randint(0, len(blocks)), table(rng, words, table_rows, table_columns))
+        document["pages"].append({"blocks": blocks})
+    return document
+
+
+def generate_corpus(documents, pages, seed=0, **kwargs):
+    """
+    Yields (name, bytes) for each synthetic document of the corpus
+    """
+    rng = random.Random(seed)
+    for i in range(documents):
+        document = generate_document(rng, pages, **kwargs)
+        yield f"document-{i:05d}.pdf", json.dumps(document).encode("utf-8")
+
+
+def polygon():
+    return [0.0, 0.0, 1.0, 0.0, 1.0, 1.0, 0.0, 1.0]
+
+
+def analyze_layout(document):
+    """
+    Turns a synthetic document into a prebuilt-layout analyzeResult (REST casing)
+    """
+    content = ""
+    pages, tables = [], []
+    for page_number, page in enumerate(document["pages"], start=1):
+        page_offset = len(content)
+        for block in page["blocks"]:
+            if isinstance(block, str):
+                content += block + "\n"
+                continue
+
+            table_offset = len(content)
+            cells = []
+            for row_index, row in enumerate(block["rows"]):
+                for column_index, text in enumerate(row):
+                    cells.append({
+                        "kind": "columnHeader" if row_index == 0 else "content",
+                        "rowIndex": row_index,
+                        "columnIndex": column_index,
+                        "rowSpan": 1,
+                        "columnSpan": 1,
+                        "content": text,
+                        "boundingRegions": [{"pageNumber": page_number, "polygon": polygon()}],
+                        "spans": [{"offset": len(content), "length": len(text)}],
+                    })
+                    content += text + " "
+                content += "\n"
+            tables.append({
+                "rowCount": len(block["rows"]),
+                "columnCount": max(len(row) for row in block["rows"]),
+                "cells": cells,
+                "boundingRegions": [{"pageNumber": page_number, "polygon": polygon()}],
+                "spans": [{"offset": table_offset, "length": len(content) - table_offset}],
+            })
+        pages.append({
+            "pageNumber": page_number,
+            "angle": 0,
+            "width": 8.5,
+            "height": 11,
+            "unit": "inch",
+            "spans": [{"offset": page_offset, "length": len(content) - page_offset}],
+            "words": [],
+            "lines": [],
+        })
+
+    return {
+        "apiVersion": "2023-07-31",
+        "modelId": "prebuilt-layout",
+        "stringIndexType": "unicodeCodePoint",
+        "content": content,
+        "pages": pages,
+        "tables": tables,
+        "paragraphs": [],
+        "styles": [],
+    }
@@ -0,0 +1,90 @@
+"""
+Peak memory of downloading documents in process-document, against the fake blob storage of
+fake_services.py:
+
+    python -m benchmarks.load_test.fake_services &
+    python -m benchmarks.load_test.bench_download_memory --size-mb 200 --in-flight 4
+
+"readall" is a plain download_blob().readall(), "spooled" is the download_to_spool used by
+process-document: parallel ranged reads into a SpooledTemporaryFile. Peak memory is the peak of
+Python allocations (tracemalloc) while --in-flight documents are downloaded at the same time.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.storage.blob import BlobServiceClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from common.blob_storage import BLOB_SPOOL_MAX_BYTES, create_blob_service_client, download_to_spool  # noqa: E402
+
+CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+    "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;"
+    "BlobEndpoint=http://127.0.0.1:7000/devstoreaccount1;"
+)
+CONTAINER = "loadtest"
+
+
+def readall(container_client, name):
+    return len(container_client.get_blob_client(name).download_blob().readall())
+
+
+def spooled(container_client, name):
+    stream, size = download_to_spool(container_client.get_blob_client(name))
+    with stream:
+        # what the analysis call does with it: read the stream in chunks
+        while stream.read(1024 * 1024):
+            pass
+    return size
+
+
+MODES = {
+    "readall": (BlobServiceClient.from_connection_string, readall),
+    "spooled": (create_blob_service_client, spooled),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=200, help="size of each document")
+    parser.add_argument("--in-flight", type=int, default=4, help="documents downloaded at the same time")
+    parser.add_argument("--connection-string", default=CONNECTION_STRING)
+    args = parser.parse_args()
+
+    names = [f"bench-download/document-{i}.pdf" for i in range(args.in_flight)]
+    # the fake blob storage only supports single put uploads
+    container_client = BlobServiceClient.from_connection_string(
+        args.connection_string, max_single_put_size=args.size_mb * 1024 * 1024 + 1).get_container_client(CONTAINER)
+    content = os.urandom(args.size_mb * 1024 * 1024)
+    for name in names:
+        container_client.upload_blob(name, content, overwrite=True)
+    del content
+
+    print(f"{args.in_flight} documents of {args.size_mb} MB in flight, spool max {BLOB_SPOOL_MAX_BYTES / 1e6:.0f} MB")
+    print(f"{'mode':<10} {'seconds':>8} {'MB/s':>8} {'peak MB':>9} {'peak MB/doc':>12}")
+    for mode, (create_client, download) in MODES.items():
+        mode_container_client = create_client(args.connection_string).get_container_client(CONTAINER)
+        tracemalloc.start()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.in_flight) as handlers:
+            sizes = list(handlers.map(lambda name: download(mode_container_client, name), names))
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        assert sizes == [args.size_mb * 1024 * 1024] * args.in_flight
+        print(f"{mode:<10} {elapsed:>8.2f} {sum(sizes) / 1e6 / elapsed:>8.1f} {peak / 1e6:>9.1f} "
+              f"{peak / 1e6 / args.in_flight:>12.1f}", flush=True)
+
+    for name in names:
+        container_client.delete_blob(name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Blobs the indexer has to read and clean-up has to delete per output compaction mode, against the
+fake blob storage of fake_services.py. A blob latency makes the per-request cost visible:
+
+    python -m benchmarks.load_test.fake_services --latency blob=0.01 &
+    python -m benchmarks.load_test.bench_output_compaction --documents 50 --batches 20
+
+For every mode the search items of --documents documents of --batches batches (8 sections with
+1536 dimensional embeddings each) are uploaded as enrichment-completed does. They are rolled up
+like complete_batch ("document") or document-completed ("ingestion") would do it. Then the
+indexed folder is read blob by blob, like the indexer does, and deleted. "off" deletes blob by
+blob as clean-up did before batch deletes. Every mode is checked to read back exactly the
+uploaded search items.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.storage.blob import BlobServiceClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from common.search_items import SEARCHITEMS_STAGING_FOLDER, delete_blobs, roll_up, roll_up_in_rounds, serialize_batch  # noqa: E402
+
+from benchmarks.load_test.bench_download_memory import CONNECTION_STRING, CONTAINER  # noqa: E402
+
+SECTIONS_PER_BATCH = 8
+FOLDER = "bench-compaction/items/"
+INGESTION_ID = "bench"
+UPLOAD_WORKERS = 16
+
+
+def search_items(documents, batches):
+    rng = random.Random(0)
+    for d in range(documents):
+        doc_id = f"doc{d:05d}"
+        for batch_nr in range(1, batches + 1):
+            yield doc_id, batch_nr, [{
+                "id": f"{INGESTION_ID}-{doc_id}-section-{(batch_nr - 1) * SECTIONS_PER_BATCH + i}",
+                "content": " ".join(rng.choice(("lorem", "ipsum", "dolor", "sit", "amet")) for _ in range(150)),
+                "category": "", "sourcepage": f"{doc_id}.pdf#page=1", "sourcefile": f"{doc_id}.pdf",
+                "embeddings": [round(rng.uniform(-0.05, 0.05), 8) for _ in range(1536)],
+                "keyphrases": ["lorem", "ipsum"], "summaries": "lorem ipsum",
+            } for i in range(SECTIONS_PER_BATCH)]
+
+
+def read_indexed_items(container_client):
+    ids, blobs = [], 0
+    for blob in container_client.list_blobs(name_starts_with=FOLDER):
+        text = container_client.get_blob_client(blob.name).download_blob().readall().decode("utf-8")
+        items = json.loads(text) if text.lstrip().startswith("[") else [json.loads(line) for line in text.splitlines() if line]
+        ids.extend(item["id"] for item in items)
+        blobs += 1
+    return blobs, ids
+
+
+def run(container_client, mode, output_format, batches_by_document):
+    folder = FOLDER if mode == "off" else f"{SEARCHITEMS_STAGING_FOLDER}{INGESTION_ID}/"
+    uploads = [(f"{folder}{doc_id}-batch-{batch_nr}.json", serialize_batch({"output_compaction": mode}, items))
+               for doc_id, batches in batches_by_document.items() for batch_nr, items in batches]
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        list(executor.map(lambda upload: container_client.upload_blob(*upload, overwrite=True), uploads))
+
+    started = time.perf_counter()
+    if mode == "document":
+        for doc_id in batches_by_document:
+            roll_up(container_client, f"{folder}{doc_id}-batch-", f"{FOLDER}{doc_id}-part-", output_format)
+    elif mode == "ingestion":
+        roll_up_in_rounds(container_client, folder, f"{FOLDER}shard-{INGESTION_ID}-", output_format)
+    roll_up_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    blobs, ids = read_indexed_items(container_client)
+    read_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    names = [blob.name for blob in container_client.list_blobs(name_starts_with=FOLDER)]
+    if mode == "off":
+        for name in names:
+            container_client.delete_blob(name)
+    else:
+        delete_blobs(container_client, names)
+    cleanup_seconds = time.perf_counter() - started
+
+    return blobs, ids, roll_up_seconds, read_seconds, cleanup_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=50)
+    parser.add_argument("--batches", type=int, default=20, help="batches per document")
+    parser.add_argument("--connection-string", default=CONNECTION_STRING)
+    args = parser.parse_args()
+
+    container_client = BlobServiceClient.from_connection_string(args.connection_string).get_container_client(CONTAINER)
+    batches_by_document = {}
+    for doc_id, batch_nr, items in search_items(args.documents, args.batches):
+        batches_by_document.setdefault(doc_id, []).append((batch_nr, items))
+    expected_ids = sorted(item["id"] for batches in batches_by_document.values() for _, items in batches for item in items)
+
+    print(f"{args.documents} documents of {args.batches} batches, {len(expected_ids)} search items")
+    print(f"{'mode':<22} {'blobs':>7} {'roll-up s':>10} {'read s':>8} {'clean-up s':>11}")
+    for mode, output_format in (("off", "jsonArray"), ("document", "jsonArray"), ("document", "jsonLines"),
+                                ("ingestion", "jsonArray"), ("ingestion", "jsonLines")):
+        blobs, ids, roll_up_seconds, read_seconds, cleanup_seconds = run(container_client, mode, output_format, batches_by_document)
+        assert sorted(ids) == expected_ids, f"{mode} {output_format} did not read back the uploaded search items"
+        print(f"{f'{mode} {output_format}':<22} {blobs:>7} {roll_up_seconds:>10.2f} {read_seconds:>8.2f} {cleanup_seconds:>11.2f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
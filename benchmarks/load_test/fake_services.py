@@ -0,0 +1,501 @@
+"""
+Local stand-ins for the external services used by the pipeline: Blob Storage, Form Recognizer,
+Azure OpenAI embeddings, Azure AI Language and Azure AI Search. All services are served from a
+single Flask app and speak just enough of the REST protocol for the Azure SDKs used in src/.
+
+Each service can be given a latency, a throttling rate (HTTP 429) and a failure rate (HTTP 500):
+
+    python -m benchmarks.load_test.fake_services --latency form_recognizer=2 --latency openai=0.3 --throttle openai=0.05
+
+The Search SDK only accepts https endpoints, so the same app is also served over TLS on --tls-port
+with a self-signed certificate for localhost, written to .certs/ next to this file. Point
+REQUESTS_CA_BUNDLE of the services at .certs/fake.crt to trust it.
+
+Call counts per service are available on /_fake/stats and reset with DELETE /_fake/stats.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from email.utils import formatdate
+from urllib.parse import unquote
+from xml.sax.saxutils import escape
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server, make_ssl_devcert
+
+from benchmarks.corpus import analyze_layout
+
+ACCOUNT_NAME = "devstoreaccount1"
+CERT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".certs")
+SERVICES = ("blob", "form_recognizer", "openai", "language", "search")
+EMBEDDING_DIMENSIONS = 1536
+
+app = Flask(__name__)
+
+config = {
+    "latency": defaultdict(float),
+    "throttle": defaultdict(float),
+    "failure": defaultdict(float),
+}
+
+lock = threading.Lock()
+calls = Counter()
+blobs = {}  # (container, name) -> (bytes, etag, last_modified)
+operations = {}  # operation id -> json result
+indexes, datasources, indexers, indexer_runs = {}, {}, {}, {}
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def simulate(service, operation):
+    """
+    Counts the call and applies the configured latency, throttling and failures for the service.
+    Returns an error response when the call should fail, otherwise None.
+    """
+    with lock:
+        calls[f"{service}.{operation}"] += 1
+        calls[f"{service}.total"] += 1
+
+    latency = config["latency"][service]
+    if latency:
+        time.sleep(random.uniform(0.8 * latency, 1.2 * latency))
+
+    if random.random() < config["throttle"][service]:
+        with lock:
+            calls[f"{service}.throttled"] += 1
+        return Response(json.dumps({"error": {"code": "429", "message": "Rate limit is exceeded."}}),
+                        status=429, mimetype="application/json", headers={"Retry-After": "1"})
+    if random.random() < config["failure"][service]:
+        with lock:
+            calls[f"{service}.failed"] += 1
+        return Response(json.dumps({"error": {"code": "InternalServerError", "message": "Injected failure"}}),
+                        status=500, mimetype="application/json")
+    return None
+
+
+# ---------------------------------------------------------------------------------------------
+# Blob Storage (path-style, like Azurite: http://host:port/devstoreaccount1/<container>/<blob>)
+# ---------------------------------------------------------------------------------------------
+
+def blob_headers(etag, last_modified):
+    return {
+        "ETag": etag,
+        "Last-Modified": formatdate(last_modified, usegmt=True),
+        "x-ms-blob-type": "BlockBlob",
+        "x-ms-version": "2021-12-02",
+        "x-ms-request-id": str(uuid.uuid4()),
+    }
+
+
+@app.route(f"/{ACCOUNT_NAME}/<container>", methods=["GET", "PUT", "POST"])
+def blob_container(container):
+    if request.method == "PUT":
+        return Response(status=201, headers={"ETag": '"0x1"', "Last-Modified": formatdate(usegmt=True)})
+
+    if request.method == "POST" and request.args.get("comp") == "batch":
+        return blob_batch(container)
+
+    if request.args.get("comp") != "list":
+        return Response(status=200, headers={"ETag": '"0x1"', "Last-Modified": formatdate(usegmt=True)})
+
+    error = simulate("blob", "list_blobs")
+    if error:
+        return error
+
+    prefix = request.args.get("prefix", "")
+    marker = request.args.get("marker", "")
+    max_results = int(request.args.get("maxresults", 5000))
+    with lock:
+        names = sorted(name for (c, name) in blobs if c == container and name.startswith(prefix) and name > marker)
+        page = [(name, blobs[(container, name)]) for name in names[:max_results]]
+    next_marker = page[-1][0] if len(names) > max_results else ""
+
+    items = "".join(
+        f"<Blob><Name>{escape(name)}</Name><Properties>"
+        f"<Last-Modified>{formatdate(last_modified, usegmt=True)}</Last-Modified><Etag>{etag}</Etag>"
+        f"<Content-Length>{len(content)}</Content-Length><Content-Type>application/octet-stream</Content-Type>"
+        f"<BlobType>BlockBlob</BlobType></Properties></Blob>"
+        for name, (content, etag, last_modified) in page
+    )
+    body = (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        f'<EnumerationResults ServiceEndpoint="{request.host_url}{ACCOUNT_NAME}" ContainerName="{escape(container)}">'
+        f"<Prefix>{escape(prefix)}</Prefix><MaxResults>{max_results}</MaxResults><Blobs>{items}</Blobs>"
+        f"<NextMarker>{escape(next_marker)}</NextMarker></EnumerationResults>"
+    )
+    return Response(body, status=200, mimetype="application/xml")
+
+
+def blob_batch(container):
+    """
+    Blob batch with delete sub-requests (ContainerClient.delete_blobs), answered as multipart/mixed
+    """
+    error = simulate("blob", "delete_blobs")
+    if error:
+        return error
+
+    paths = re.findall(r"^DELETE (\S+) HTTP/1\.1", request.get_data(as_text=True), flags=re.MULTILINE)
+    boundary = f"batchresponse_{uuid.uuid4()}"
+    parts = []
+    for content_id, path in enumerate(paths):
+        name = path.split("?", 1)[0].split(f"/{container}/", 1)[1]
+        with lock:
+            existed = blobs.pop((container, unquote(name)), None)
+        status = "202 Accepted" if existed is not None else "404 The specified blob does not exist."
+        error_code = "" if existed is not None else "x-ms-error-code: BlobNotFound\r\n"
+        parts.append(f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: {content_id}\r\n\r\n"
+                     f"HTTP/1.1 {status}\r\n{error_code}x-ms-request-id: {uuid.uuid4()}\r\nx-ms-version: 2021-12-02\r\n\r\n")
+    body = "".join(parts) + f"--{boundary}--\r\n"
+    return Response(body, status=202, headers={"Content-Type": f"multipart/mixed; boundary={boundary}",
+                                               "x-ms-request-id": str(uuid.uuid4()), "x-ms-version": "2021-12-02"})
+
+
+@app.route(f"/{ACCOUNT_NAME}/<container>/<path:name>", methods=["GET", "HEAD", "PUT", "DELETE"])
+def blob_item(container, name):
+    key = (container, name)
+
+    if request.method == "PUT":
+        error = simulate("blob", "upload_blob")
+        if error:
+            return error
+        content = request.get_data()
+        etag = f'"0x{hashlib.md5(content).hexdigest()[:16].upper()}"'
+        with lock:
+            blobs[key] = (content, etag, time.time())
+        headers = blob_headers(etag, time.time())
+        headers["x-ms-request-server-encrypted"] = "true"
+        return Response(status=201, headers=headers)
+
+    if request.method == "DELETE":
+        error = simulate("blob", "delete_blob")
+        if error:
+            return error
+        with lock:
+            existed = blobs.pop(key, None)
+        if existed is None:
+            return Response(status=404, headers={"x-ms-error-code": "BlobNotFound"})
+        return Response(status=202)
+
+    operation = "get_blob_properties" if request.method == "HEAD" else "download_blob"
+    error = simulate("blob", operation)
+    if error:
+        return error
+    with lock:
+        item = blobs.get(key)
+    if item is None:
+        return Response(status=404, headers={"x-ms-error-code": "BlobNotFound"})
+
+    content, etag, last_modified = item
+    headers = blob_headers(etag, last_modified)
+    if request.method == "HEAD":
+        headers["Content-Length"] = str(len(content))
+        return Response(status=200, headers=headers)
+
+    range_header = request.headers.get("x-ms-range") or request.headers.get("Range")
+    match = re.match(r"bytes=(\d+)-(\d*)", range_header or "")
+    if not match:
+        return Response(content, status=200, headers=headers, mimetype="application/octet-stream")
+
+    start = int(match.group(1))
+    end = min(int(match.group(2)) if match.group(2) else len(content) - 1, len(content) - 1)
+    if start >= len(content):
+        headers["Content-Range"] = f"bytes */{len(content)}"
+        return Response(status=416, headers=headers)
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+    return Response(content[start:end + 1], status=206, headers=headers, mimetype="application/octet-stream")
+
+
+# ---------------------------------------------------------------------------------------------
+# Form Recognizer prebuilt-layout. The "documents" are the JSON layouts written by corpus.py
+# ---------------------------------------------------------------------------------------------
+
+@app.route("/formrecognizer/documentModels/<model_id>:analyze", methods=["POST"])
+def form_recognizer_analyze(model_id):
+    error = simulate("form_recognizer", "analyze_document")
+    if error:
+        return error
+
+    try:
+        result = analyze_layout(json.loads(request.get_data()))
+    except (ValueError, KeyError) as e:
+        return jsonify(error={"code": "InvalidContent", "message": str(e)}), 400
+
+    operation_id = str(uuid.uuid4())
+    with lock:
+        operations[operation_id] = {
+            "status": "succeeded",
+            "createdDateTime": now_iso(),
+            "lastUpdatedDateTime": now_iso(),
+            "analyzeResult": result,
+        }
+    location = f"{request.host_url}formrecognizer/documentModels/{model_id}/analyzeResults/{operation_id}?api-version={request.args.get('api-version', '2023-07-31')}"
+    return Response(status=202, headers={"Operation-Location": location, "Retry-After": "0"})
+
+
+@app.route("/formrecognizer/documentModels/<model_id>/analyzeResults/<operation_id>", methods=["GET"])
+def form_recognizer_result(model_id, operation_id):
+    with lock:
+        result = operations.pop(operation_id, None)
+    if result is None:
+        return jsonify(error={"code": "NotFound", "message": "Unknown operation"}), 404
+    return jsonify(result)
+
+
+# ---------------------------------------------------------------------------------------------
+# Azure OpenAI embeddings
+# ---------------------------------------------------------------------------------------------
+
+def fake_embedding(text, dimensions):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    rng = random.Random(seed)
+    return [rng.uniform(-1, 1) for _ in range(dimensions)]
+
+
+@app.route("/openai/deployments/<deployment>/embeddings", methods=["POST"])
+def openai_embeddings(deployment):
+    error = simulate("openai", "embeddings")
+    if error:
+        return error
+
+    body = request.get_json()
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    # text-embedding-3 deployments are asked for the dimensions of the index
+    dimensions = body.get("dimensions", EMBEDDING_DIMENSIONS)
+    data = []
+    for index, text in enumerate(texts):
+        embedding = fake_embedding(text, dimensions)
+        if body.get("encoding_format") == "base64":
+            embedding = base64.b64encode(struct.pack(f"<{len(embedding)}f", *embedding)).decode("ascii")
+        data.append({"object": "embedding", "index": index, "embedding": embedding})
+
+    tokens = sum(len(text.split()) for text in texts)
+    return jsonify(object="list", data=data, model="text-embedding-ada-002",
+                   usage={"prompt_tokens": tokens, "total_tokens": tokens})
+
+
+# ---------------------------------------------------------------------------------------------
+# Azure AI Language: synchronous key phrases and long-running analyze jobs
+# ---------------------------------------------------------------------------------------------
+
+def language_document_result(kind, document):
+    words = [word.strip(".,;:!?()[]{}") for word in document["text"].split()]
+    if kind.startswith("KeyPhraseExtraction"):
+        return {"id": document["id"], "keyPhrases": sorted(set(w for w in words if len(w) > 7))[:10], "warnings": []}
+    if kind.startswith("ExtractiveSummarization"):
+        sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+", document["text"]) if s.strip()][:3]
+        return {
+            "id": document["id"],
+            "sentences": [{"text": s, "rankScore": 1.0, "offset": 0, "length": len(s)} for s in sentences],
+            "warnings": [],
+        }
+    raise ValueError(f"Unsupported task kind {kind}")
+
+
+def language_task_results(kind, documents):
+    return {
+        "documents": [language_document_result(kind, document) for document in documents],
+        "errors": [],
+        "modelVersion": "2022-10-01",
+    }
+
+
+@app.route("/language/:analyze-text", methods=["POST"])
+def language_analyze_text():
+    error = simulate("language", "analyze_text")
+    if error:
+        return error
+
+    body = request.get_json()
+    kind = body["kind"]
+    try:
+        results = language_task_results(kind, body["analysisInput"]["documents"])
+    except ValueError as e:
+        return jsonify(error={"code": "InvalidRequest", "message": str(e)}), 400
+    return jsonify(kind=f"{kind}Results", results=results)
+
+
+@app.route("/language/analyze-text/jobs", methods=["POST"])
+def language_submit_job():
+    error = simulate("language", "analyze_text_job")
+    if error:
+        return error
+
+    body = request.get_json()
+    documents = body["analysisInput"]["documents"]
+    items = [{
+        "kind": f"{task['kind']}LROResults",
+        "taskName": task.get("taskName", str(i)),
+        "lastUpdateDateTime": now_iso(),
+        "status": "succeeded",
+        "results": language_task_results(task["kind"], documents),
+    } for i, task in enumerate(body["tasks"])]
+
+    job_id = str(uuid.uuid4())
+    with lock:
+        operations[job_id] = {
+            "jobId": job_id,
+            "createdDateTime": now_iso(),
+            "lastUpdatedDateTime": now_iso(),
+            "expirationDateTime": now_iso(),
+            "status": "succeeded",
+            "errors": [],
+            "displayName": body.get("displayName"),
+            "tasks": {"completed": len(items), "failed": 0, "inProgress": 0, "total": len(items), "items": items},
+        }
+    location = f"{request.host_url}language/analyze-text/jobs/{job_id}?api-version={request.args.get('api-version', '2023-04-01')}"
+    return Response(status=202, headers={"Operation-Location": location, "Retry-After": "0"})
+
+
+@app.route("/language/analyze-text/jobs/<job_id>", methods=["GET"])
+def language_job_status(job_id):
+    with lock:
+        result = operations.get(job_id)
+    if result is None:
+        return jsonify(error={"code": "NotFound", "message": "Unknown job"}), 404
+    return jsonify(result)
+
+
+# ---------------------------------------------------------------------------------------------
+# Azure AI Search: datasources, indexes and indexers
+# ---------------------------------------------------------------------------------------------
+
+SEARCH_COLLECTIONS = {"datasources": datasources, "indexes": indexes, "indexers": indexers}
+
+
+@app.route("/search/<collection>('<name>')", methods=["GET", "PUT"])
+def search_resource(collection, name):
+    store = SEARCH_COLLECTIONS.get(collection)
+    if store is None:
+        return jsonify(error={"code": "NotFound", "message": collection}), 404
+    error = simulate("search", f"{request.method.lower()}_{collection}")
+    if error:
+        return error
+
+    if request.method == "PUT":
+        body = request.get_json()
+        with lock:
+            created = name not in store
+            store[name] = body
+        return jsonify(body), 201 if created else 200
+
+    with lock:
+        body = store.get(name)
+    if body is None:
+        return jsonify(error={"code": "ResourceNotFound", "message": f"No {collection} named '{name}'"}), 404
+    return jsonify(body)
+
+
+@app.route("/search/indexes", methods=["POST"])
+def search_create_index():
+    error = simulate("search", "create_index")
+    if error:
+        return error
+    body = request.get_json()
+    with lock:
+        indexes[body["name"]] = body
+    return jsonify(body), 201
+
+
+def indexer_item_count(name):
+    datasource = datasources.get(indexers[name]["dataSourceName"], {})
+    container = datasource.get("container", {})
+    prefix = container.get("query") or ""
+    count = 0
+    for (blob_container, blob_name), (content, _, _) in list(blobs.items()):
+        if blob_container != container.get("name") or not blob_name.startswith(prefix):
+            continue
+        text = content.decode("utf-8")
+        count += len(json.loads(text)) if text.lstrip().startswith("[") else len(text.splitlines())
+    return count
+
+
+@app.route("/search/indexers('<name>')/search.run", methods=["POST"])
+def search_run_indexer(name):
+    error = simulate("search", "run_indexer")
+    if error:
+        return error
+    with lock:
+        if name not in indexers:
+            return jsonify(error={"code": "ResourceNotFound", "message": name}), 404
+        indexer_runs[name] = {"started": time.time(), "items": indexer_item_count(name)}
+    return Response(status=202)
+
+
+@app.route("/search/indexers('<name>')/search.status", methods=["GET"])
+def search_indexer_status(name):
+    error = simulate("search", "get_indexer_status")
+    if error:
+        return error
+    with lock:
+        run = indexer_runs.get(name)
+    if run is None:
+        return jsonify(error={"code": "ResourceNotFound", "message": name}), 404
+    last_result = {
+        "status": "success",
+        "errorMessage": None,
+        "startTime": now_iso(),
+        "endTime": now_iso(),
+        "itemsProcessed": run["items"],
+        "itemsFailed": 0,
+        "initialTrackingState": None,
+        "finalTrackingState": None,
+        "errors": [],
+        "warnings": [],
+    }
+    return jsonify(status="running", lastResult=last_result, executionHistory=[last_result],
+                   limits={"maxRunTime": "PT2H", "maxDocumentExtractionSize": 0, "maxDocumentContentCharactersToExtract": 0})
+
+
+# ---------------------------------------------------------------------------------------------
+# Harness endpoints
+# ---------------------------------------------------------------------------------------------
+
+@app.route("/_fake/stats", methods=["GET", "DELETE"])
+def fake_stats():
+    with lock:
+        if request.method == "DELETE":
+            calls.clear()
+            indexer_runs.clear()
+        return jsonify(calls=dict(calls), indexer_runs=dict(indexer_runs), blobs=len(blobs))
+
+
+def parse_settings(values):
+    settings = {}
+    for value in values or []:
+        service, _, number = value.partition("=")
+        if service not in SERVICES:
+            raise argparse.ArgumentTypeError(f"Unknown service '{service}', expected one of {', '.join(SERVICES)}")
+        settings[service] = float(number)
+    return settings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=7000)
+    parser.add_argument("--tls-port", type=int, default=7443)
+    parser.add_argument("--latency", action="append", metavar="SERVICE=SECONDS", help="mean latency per call")
+    parser.add_argument("--throttle", action="append", metavar="SERVICE=RATE", help="fraction of calls answered with 429")
+    parser.add_argument("--failure", action="append", metavar="SERVICE=RATE", help="fraction of calls answered with 500")
+    args = parser.parse_args()
+
+    for setting in ("latency", "throttle", "failure"):
+        config[setting].update(parse_settings(getattr(args, setting)))
+
+    os.makedirs(CERT_DIR, exist_ok=True)
+    cert_file, key_file = make_ssl_devcert(os.path.join(CERT_DIR, "fake"), host="localhost")
+    tls_server = make_server("127.0.0.1", args.tls_port, app, threaded=True, ssl_context=(cert_file, key_file))
+    threading.Thread(target=tls_server.serve_forever, daemon=True).start()
+
+    app.run(port=args.port, threaded=True)
@@ -0,0 +1,252 @@
+"""
+End-to-end load test of the pipeline against the local stand-ins in fake_services.py.
+
+Start Redis (`dapr init` already runs one on localhost:6379), the fakes and the services:
+
+    python -m benchmarks.load_test.fake_services --latency openai=0.2 --latency language=0.5 &
+    dapr run -f benchmarks/load_test/dapr.yaml &
+    python -m benchmarks.load_test.run_load_test --documents 200 --pages 20
+
+The corpus is uploaded to the fake blob storage, an ingestion is triggered through the batcher and
+the run ends when document-completed starts the (fake) indexer. The report contains documents/min,
+handler latency percentiles per stage, Redis traffic, the number of external calls, the peak
+backlog per stage read from the batcher's /backlog during the run and how long each service took
+from its start to being ready and to handling its first event.
+"""
+import argparse
+import json
+import math
+import time
+import urllib.request
+from collections import defaultdict
+
+import redis
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmarks.corpus import generate_corpus
+
+FAKE_URL = "http://127.0.0.1:7000"
+BATCHER_URL = "http://127.0.0.1:6000/batcher-trigger"
+BACKLOG_URL = "http://127.0.0.1:6000/backlog"
+CONTAINER = "loadtest"
+APP_PORTS = {
+    "batcher": 6000,
+    "process-document": 6001,
+    "generate-embeddings": 6002,
+    "generate-keyphrases": 6003,
+    "generate-summaries": 6004,
+    "enrichment-completed": 6005,
+    "document-completed": 6006,
+    "enrich-batch": 6007,
+}
+PERCENTILES = (50, 90, 99)
+
+
+def http(method, url, body=None, headers=None):
+    request = urllib.request.Request(url, data=body, method=method, headers=headers or {})
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+def upload_corpus(fake_url, folder, documents, pages, seed, tables_per_page, unicode):
+    total_bytes = 0
+    for name, content in generate_corpus(documents, pages, seed=seed, tables_per_page=tables_per_page, unicode=unicode):
+        http("PUT", f"{fake_url}/devstoreaccount1/{CONTAINER}/{folder}{name}", content, {"x-ms-blob-type": "BlockBlob"})
+        total_bytes += len(content)
+    return total_bytes
+
+
+def scrape_histograms(port, metric):
+    """
+    Returns {(stage, label): {le: cumulative count}} for a histogram exposed by a service
+    """
+    try:
+        text = http("GET", f"http://127.0.0.1:{port}/metrics").decode("utf-8")
+    except OSError:
+        return {}
+
+    buckets = defaultdict(lambda: defaultdict(float))
+    for family in text_string_to_metric_families(text):
+        if family.name != metric:
+            continue
+        for sample in family.samples:
+            if sample.name.endswith("_bucket"):
+                label = sample.labels.get("dependency") or sample.labels.get("route", "")
+                buckets[(sample.labels["stage"], label)][float(sample.labels["le"])] += sample.value
+    return buckets
+
+
+def scrape_startup(port):
+    """
+    Returns {phase: seconds} of the pipeline_startup_seconds gauge of a service
+    """
+    try:
+        text = http("GET", f"http://127.0.0.1:{port}/metrics").decode("utf-8")
+    except OSError:
+        return {}
+
+    return {sample.labels["phase"]: sample.value
+            for family in text_string_to_metric_families(text) if family.name == "pipeline_startup_seconds"
+            for sample in family.samples}
+
+
+def scrape_all(metric):
+    buckets = {}
+    for port in APP_PORTS.values():
+        buckets.update(scrape_histograms(port, metric))
+    return buckets
+
+
+def percentile(buckets, p):
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]]
+    if not total:
+        return None
+    target = total * p / 100
+    previous_bound, previous_count = 0.0, 0.0
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= target:
+            if math.isinf(bound):
+                return previous_bound
+            fraction = (target - previous_count) / (count - previous_count) if count > previous_count else 0
+            return previous_bound + (bound - previous_bound) * fraction
+        previous_bound, previous_count = bound, count
+    return previous_bound
+
+
+def histogram_delta(before, after):
+    delta = {}
+    for key, buckets in after.items():
+        previous = before.get(key, {})
+        delta[key] = {le: count - previous.get(le, 0) for le, count in buckets.items()}
+    return delta
+
+
+def redis_stats(client):
+    info = client.info()
+    return {
+        "net_input_bytes": info["total_net_input_bytes"],
+        "net_output_bytes": info["total_net_output_bytes"],
+        "used_memory_peak": info["used_memory_peak"],
+    }
+
+
+def sample_backlog(backlog_url, peaks):
+    """
+    Keeps the most items and the oldest item age seen per stage
+    """
+    try:
+        backlog = json.loads(http("GET", backlog_url))
+    except (OSError, ValueError):
+        return
+    for stage, values in backlog["stages"].items():
+        peak = peaks.setdefault(stage, {"items": 0, "oldest_age_seconds": 0.0})
+        peak["items"] = max(peak["items"], values["items"])
+        peak["oldest_age_seconds"] = max(peak["oldest_age_seconds"], values["oldest_age_seconds"])
+
+
+def wait_for_indexer(fake_url, indexer_name, timeout, on_poll=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = json.loads(http("GET", f"{fake_url}/_fake/stats"))
+        run = stats["indexer_runs"].get(indexer_name)
+        if run:
+            return run
+        if on_poll:
+            on_poll()
+        time.sleep(1)
+    raise TimeoutError(f"Ingestion did not complete within {timeout} seconds")
+
+
+def print_latencies(title, histograms):
+    print(f"\n{title}")
+    print(f"{'stage':<22} {'':<26} {'count':>8} " + " ".join(f"{'p' + str(p):>9}" for p in PERCENTILES))
+    for (stage, label), buckets in sorted(histograms.items()):
+        count = buckets[max(buckets)]
+        if not count:
+            continue
+        values = " ".join(f"{percentile(buckets, p):>8.3f}s" for p in PERCENTILES)
+        print(f"{stage:<22} {label:<26} {int(count):>8} {values}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=10, help="pages per document")
+    parser.add_argument("--tables-per-page", type=int, default=1)
+    parser.add_argument("--unicode", action="store_true", help="mix non-ASCII words into the corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--priority", choices=("high", "normal", "low"), help="priority lane of the ingestion")
+    parser.add_argument("--fake-url", default=FAKE_URL)
+    parser.add_argument("--batcher-url", default=BATCHER_URL)
+    parser.add_argument("--backlog-url", default=BACKLOG_URL)
+    parser.add_argument("--redis", default="localhost:6379")
+    parser.add_argument("--timeout", type=int, default=3600)
+    args = parser.parse_args()
+
+    run_id = time.strftime("%Y%m%d%H%M%S")
+    source_folder = f"loadtest-{run_id}/source/"
+    searchitems_folder = f"loadtest-{run_id}/searchitems/"
+    indexer_name = f"loadtest-{run_id}"
+
+    print(f"Uploading {args.documents} documents of {args.pages} pages to {source_folder}", flush=True)
+    corpus_bytes = upload_corpus(args.fake_url, source_folder, args.documents, args.pages, args.seed,
+                                 args.tables_per_page, args.unicode)
+
+    host, _, port = args.redis.partition(":")
+    redis_client = redis.Redis(host=host, port=int(port or 6379))
+    redis_before = redis_stats(redis_client)
+    handlers_before = scrape_all("pipeline_handler_duration_seconds")
+    calls_before = scrape_all("pipeline_external_call_duration_seconds")
+    http("DELETE", f"{args.fake_url}/_fake/stats")
+
+    trigger = {
+        "source_folder_path": source_folder,
+        "searchitems_folder_path": searchitems_folder,
+        "searchindexer_name": indexer_name,
+    }
+    if args.priority:
+        trigger["priority"] = args.priority
+
+    started = time.time()
+    http("POST", args.batcher_url, json.dumps(trigger).encode("utf-8"), {"Content-Type": "application/json"})
+
+    backlog_peaks = {}
+    run = wait_for_indexer(args.fake_url, indexer_name, args.timeout, lambda: sample_backlog(args.backlog_url, backlog_peaks))
+    elapsed = run["started"] - started
+
+    redis_after = redis_stats(redis_client)
+    fake_stats = json.loads(http("GET", f"{args.fake_url}/_fake/stats"))
+    handlers = histogram_delta(handlers_before, scrape_all("pipeline_handler_duration_seconds"))
+    external_calls = histogram_delta(calls_before, scrape_all("pipeline_external_call_duration_seconds"))
+
+    print(f"\nCorpus: {args.documents} documents, {args.pages} pages each, {corpus_bytes / 1e6:.1f} MB")
+    print(f"Elapsed: {elapsed:.1f}s, {args.documents / elapsed * 60:.1f} documents/min, {run['items']} search items")
+    print_latencies("Handler latency", handlers)
+    print_latencies("External call latency", external_calls)
+
+    print("\nRedis")
+    print(f"  bytes in:      {redis_after['net_input_bytes'] - redis_before['net_input_bytes']:>14,}")
+    print(f"  bytes out:     {redis_after['net_output_bytes'] - redis_before['net_output_bytes']:>14,}")
+    print(f"  peak memory:   {redis_after['used_memory_peak']:>14,}")
+
+    print("\nExternal calls")
+    for name, count in sorted(fake_stats["calls"].items()):
+        print(f"  {name:<36} {count:>8}")
+
+    print("\nBacklog peak")
+    print(f"{'stage':<22} {'items':>8} {'oldest s':>9}")
+    for stage, peak in backlog_peaks.items():
+        print(f"{stage:<22} {peak['items']:>8} {peak['oldest_age_seconds']:>9.1f}")
+
+    print("\nStartup, seconds after the process started")
+    print(f"{'stage':<22} {'ready':>8} {'first event':>12}")
+    for stage, port in APP_PORTS.items():
+        phases = scrape_startup(port)
+        ready, first_event = (f"{phases[phase]:.2f}" if phase in phases else "-" for phase in ("ready", "first_event"))
+        print(f"{stage:<22} {ready:>8} {first_event:>12}")
+
+
+if __name__ == "__main__":
+    main()
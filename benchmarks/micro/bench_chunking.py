@@ -0,0 +1,188 @@
+"""
+Micro-benchmarks for the CPU-bound hot paths of the pipeline: page assembly (build_page_map),
+table_to_html, split_text/create_sections and the whole chunk_document worker in process-document
+and the section merge of enrichment-completed.
+
+    python -m benchmarks.micro.bench_chunking                  # benchmark and check the golden corpus
+    python -m benchmarks.micro.bench_chunking --update-golden  # accept changed outputs
+
+Every case runs on a generated layout result. Time and peak memory (tracemalloc) are reported per MB
+of layout content, and a digest of every output is compared against golden.json so optimizations
+can't silently change chunking behavior.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from benchmarks.corpus import analyze_layout, generate_document
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path[:0] = [os.path.join(ROOT, "src"), os.path.join(ROOT, "src", "process_document")]
+
+from common.search_items import merge_enrichments  # noqa: E402
+from document_chunker import build_page_map, chunk_document, create_sections, table_to_html, to_layout  # noqa: E402
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden.json")
+BATCH_SIZE = 8
+EMBEDDING_DIMENSIONS = 1536
+
+CASES = {
+    "table_heavy": dict(pages=20, paragraphs_per_page=2, tables_per_page=4, table_rows=12, table_columns=6),
+    "long_pages": dict(pages=5, paragraphs_per_page=120),
+    "many_small_pages": dict(pages=500, paragraphs_per_page=1, sentences_per_paragraph=1),
+    "unicode_heavy": dict(pages=30, paragraphs_per_page=8, tables_per_page=1, unicode=True),
+}
+
+
+def to_layout_result(analyze_result):
+    """
+    Wraps a REST analyzeResult in objects with the attribute names of the Form Recognizer SDK
+    """
+    def spans(items):
+        return [SimpleNamespace(offset=span["offset"], length=span["length"]) for span in items]
+
+    return SimpleNamespace(
+        content=analyze_result["content"],
+        pages=[SimpleNamespace(spans=spans(page["spans"])) for page in analyze_result["pages"]],
+        tables=[SimpleNamespace(
+            row_count=table["rowCount"],
+            column_count=table["columnCount"],
+            bounding_regions=[SimpleNamespace(page_number=region["pageNumber"]) for region in table["boundingRegions"]],
+            spans=spans(table["spans"]),
+            cells=[SimpleNamespace(
+                kind=cell["kind"],
+                row_index=cell["rowIndex"],
+                column_index=cell["columnIndex"],
+                row_span=cell["rowSpan"],
+                column_span=cell["columnSpan"],
+                content=cell["content"],
+            ) for cell in table["cells"]],
+        ) for table in analyze_result["tables"]],
+    )
+
+
+def enrichments_for(batch, rng):
+    embeddings = [[rng.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)] for _ in batch]
+    keyphrases = [sorted(set(section["content"].split()[:10])) for section in batch]
+    summaries = [section["content"][:200] for section in batch]
+    return embeddings, keyphrases, summaries
+
+
+def make_case(name, settings):
+    layout = to_layout_result(analyze_layout(generate_document(random.Random(name), **settings)))
+    page_map = build_page_map(layout)
+    sections = list(create_sections(f"{name}.pdf", page_map, "doc00001", "ing01"))
+    rng = random.Random(name)
+    batches = [sections[i:i + BATCH_SIZE] for i in range(0, len(sections), BATCH_SIZE)]
+    enrichments = [enrichments_for(batch, rng) for batch in batches]
+    return layout, page_map, batches, enrichments
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def bench_page_map(layout, page_map, batches, enrichments):
+    return build_page_map(layout)
+
+
+def bench_table_to_html(layout, page_map, batches, enrichments):
+    return [table_to_html(table) for table in layout.tables]
+
+
+def bench_sections(layout, page_map, batches, enrichments):
+    return list(create_sections("bench.pdf", page_map, "doc00001", "ing01"))
+
+
+def bench_chunk_document(layout, page_map, batches, enrichments):
+    # what a chunking worker of process-document runs on the layout it receives
+    return chunk_document("bench.pdf", to_layout(layout), "doc00001", "ing01")
+
+
+def bench_merge(layout, page_map, batches, enrichments):
+    # enrichment-completed merges and serializes one batch per event
+    uploads = []
+    for batch, (embeddings, keyphrases, summaries) in zip(batches, enrichments):
+        sections = [dict(section) for section in batch]
+        uploads.append(json.dumps(merge_enrichments(sections, embeddings, keyphrases, summaries)))
+    return uploads
+
+
+BENCHMARKS = {
+    "build_page_map": bench_page_map,
+    "table_to_html": bench_table_to_html,
+    "create_sections": bench_sections,
+    "chunk_document": bench_chunk_document,
+    "merge_batches": bench_merge,
+}
+
+
+def measure(benchmark, case, min_time):
+    timings = []
+    started = time.perf_counter()
+    while not timings or time.perf_counter() - started < min_time:
+        run_started = time.perf_counter()
+        result = benchmark(*case)
+        timings.append(time.perf_counter() - run_started)
+
+    tracemalloc.start()
+    benchmark(*case)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, timings, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--case", action="append", choices=sorted(CASES), help="run only the given case(s)")
+    parser.add_argument("--benchmark", action="append", choices=sorted(BENCHMARKS), help="run only the given benchmark(s)")
+    parser.add_argument("--min-time", type=float, default=1.0, help="minimum seconds to repeat each benchmark")
+    parser.add_argument("--update-golden", action="store_true", help="store the current outputs as golden")
+    args = parser.parse_args()
+
+    golden = {}
+    if os.path.exists(GOLDEN_FILE):
+        with open(GOLDEN_FILE) as f:
+            golden = json.load(f)
+
+    mismatches = []
+    print(f"{'case':<18} {'benchmark':<16} {'MB':>6} {'runs':>5} {'min':>9} {'mean':>9} {'stddev':>9} {'s/MB':>8} {'peak MB/MB':>11}")
+    for case_name in args.case or CASES:
+        case = make_case(case_name, CASES[case_name])
+        megabytes = len(case[0].content.encode("utf-8")) / 1e6
+
+        for benchmark_name in args.benchmark or BENCHMARKS:
+            result, timings, peak = measure(BENCHMARKS[benchmark_name], case, args.min_time)
+            print(f"{case_name:<18} {benchmark_name:<16} {megabytes:>6.2f} {len(timings):>5} "
+                  f"{min(timings) * 1e3:>7.1f}ms {statistics.mean(timings) * 1e3:>7.1f}ms "
+                  f"{statistics.pstdev(timings) * 1e3:>7.1f}ms {min(timings) / megabytes:>8.3f} "
+                  f"{peak / 1e6 / megabytes:>11.2f}", flush=True)
+
+            key = f"{case_name}/{benchmark_name}"
+            output = {"items": len(result), "sha256": digest(result)}
+            if args.update_golden:
+                golden[key] = output
+            elif golden.get(key) != output:
+                mismatches.append(key)
+
+    if args.update_golden:
+        with open(GOLDEN_FILE, "w") as f:
+            json.dump(golden, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"Updated {GOLDEN_FILE}")
+    elif mismatches:
+        print(f"Outputs differ from the golden corpus for: {', '.join(mismatches)}")
+        sys.exit(1)
+    else:
+        print("All outputs match the golden corpus")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Chunking throughput of process-document per number of chunking workers, on a table-heavy corpus.
+
+    python -m benchmarks.micro.bench_chunking_pool --documents 64 --workers 1 --workers 2 --workers 4
+
+Like the handler threads of process-document, 50 threads submit the documents. The "threads" row
+chunks in those threads directly, which is what the GIL limits to one core. The workers stream
+the sections back in groups of a batch, like process-document consumes them, and "first batch ms"
+is the median time from submitting a document to its first batch (for "threads": to all of it).
+Every run is checked against the output of chunking the documents one by one.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.corpus import analyze_layout, generate_document
+from benchmarks.micro.bench_chunking import CASES, to_layout_result
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path[:0] = [os.path.join(ROOT, "src"), os.path.join(ROOT, "src", "process_document")]
+
+from document_chunker import available_cpus, chunk_document, create_chunking_pool, stream_sections, to_layout  # noqa: E402
+
+HANDLER_THREADS = 50
+BATCH_SIZE = 8
+
+
+def make_layouts(documents, case):
+    rng = random.Random(case)
+    return [to_layout(to_layout_result(analyze_layout(generate_document(rng, **CASES[case]))))
+            for _ in range(documents)]
+
+
+def chunk_all(layouts, chunk):
+    with ThreadPoolExecutor(max_workers=HANDLER_THREADS) as handlers:
+        return list(handlers.map(lambda item: chunk(f"document-{item[0]:05d}.pdf", item[1], f"doc{item[0]:05d}", "ing01"),
+                                 enumerate(layouts)))
+
+
+def timed(chunk):
+    def run(*item):
+        started = time.perf_counter()
+        return chunk(*item), time.perf_counter() - started
+    return run
+
+
+def stream_document(pool):
+    def run(*item):
+        started = time.perf_counter()
+        sections, first_batch = [], None
+        for group, _ in pool.stream(stream_sections, *item, BATCH_SIZE):
+            first_batch = first_batch or time.perf_counter() - started
+            sections.extend(group)
+        return sections, first_batch
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=32)
+    parser.add_argument("--case", choices=sorted(CASES), default="table_heavy")
+    parser.add_argument("--workers", type=int, action="append", help="pool sizes to run, defaults to 1 up to the available cores")
+    args = parser.parse_args()
+
+    cpus = available_cpus()
+    worker_counts = args.workers or sorted({1, 2, 4, 8, 16, cpus} & set(range(1, cpus + 1)))
+    layouts = make_layouts(args.documents, args.case)
+    megabytes = sum(len(layout[0].encode("utf-8")) for layout in layouts) / 1e6
+
+    expected = [chunk_document(f"document-{i:05d}.pdf", layout, f"doc{i:05d}", "ing01") for i, layout in enumerate(layouts)]
+
+    print(f"{args.documents} {args.case} documents, {megabytes:.1f} MB of layout content, {cpus} cores available")
+    print(f"{'mode':<12} {'seconds':>8} {'docs/s':>8} {'MB/s':>8} {'speedup':>8} {'first batch ms':>15}")
+
+    started = time.perf_counter()
+    results = chunk_all(layouts, timed(chunk_document))
+    baseline = time.perf_counter() - started
+    assert [sections for sections, _ in results] == expected
+    first_batch = statistics.median(seconds for _, seconds in results) * 1000
+    print(f"{'threads':<12} {baseline:>8.2f} {args.documents / baseline:>8.1f} {megabytes / baseline:>8.2f} {1:>7.2f}x "
+          f"{first_batch:>15.1f}", flush=True)
+
+    for workers in worker_counts:
+        pool = create_chunking_pool(workers)
+        started = time.perf_counter()
+        results = chunk_all(layouts, stream_document(pool))
+        elapsed = time.perf_counter() - started
+        pool.shutdown()
+        assert [sections for sections, _ in results] == expected
+        first_batch = statistics.median(seconds for _, seconds in results) * 1000
+        print(f"{f'{workers} workers':<12} {elapsed:>8.2f} {args.documents / elapsed:>8.1f} {megabytes / elapsed:>8.2f} "
+              f"{baseline / elapsed:>7.2f}x {first_batch:>15.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Checks that the index definitions document-completed creates are consistent with the vectors the
+embedding stages produce, for a range of vector settings:
+
+    python -m benchmarks.micro.check_vector_schema
+
+For every setting the index definition is serialized to the JSON sent to Azure AI Search, and
+search items with shaped embeddings of text-embedding-3-large, asked for the dimensions of the
+setting, are checked against it: field type, dimensions, value range of the element type, normalization, the profile, algorithm and
+compression references and the HNSW parameters. Settings the model can't produce, or other models
+can't without shortening, have to be rejected. Also prints the size of the embeddings in a
+search item, which is what the indexer reads for every section.
+"""
+import json
+import math
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path[:0] = [os.path.join(ROOT, "src"), os.path.join(ROOT, "src", "document_completed")]
+
+from azure_search_index import create_index_definition  # noqa: E402
+from common.vector_config import parse_vector_config, shape_embeddings  # noqa: E402
+
+MODEL = "text-embedding-3-large"
+SECTIONS = 8
+
+CONFIGS = {
+    "default": None,
+    "shortened": {"dimensions": 256},
+    "half": {"dimensions": 1024, "element_type": "Half", "m": 8, "ef_construction": 800, "ef_search": 200},
+    "sbyte": {"dimensions": 1536, "element_type": "SByte", "stored": False},
+    "quantized": {"dimensions": 3072, "scalar_quantization": True, "metric": "dotProduct", "stored": False},
+}
+
+# the vector value each element type can hold
+VALUE_RANGES = {"Single": 3.4e38, "Half": 65504, "SByte": 127}
+
+
+def model_embeddings(rng, dimensions):
+    # the embeddings API returns normalized vectors of the requested dimensions
+    embeddings = []
+    for _ in range(SECTIONS):
+        vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+        norm = math.sqrt(sum(value * value for value in vector))
+        embeddings.append([value / norm for value in vector])
+    return embeddings
+
+
+def check(name, value):
+    errors = []
+    config = parse_vector_config(value, MODEL)
+    definition = create_index_definition(f"check-{name}-index", config)._to_generated().serialize()
+    embeddings = shape_embeddings(model_embeddings(random.Random(name), config["dimensions"]), config)
+
+    field = next(field for field in definition["fields"] if field["name"] == "embeddings")
+    vector_search = definition["vectorSearch"]
+    profiles = {profile["name"]: profile for profile in vector_search["profiles"]}
+    algorithms = {algorithm["name"]: algorithm for algorithm in vector_search["algorithms"]}
+    compressions = {compression["name"]: compression for compression in vector_search.get("compressions", [])}
+
+    if field["type"] != f"Collection(Edm.{config['element_type']})":
+        errors.append(f"field type {field['type']} does not match element type {config['element_type']}")
+    if field["dimensions"] != config["dimensions"]:
+        errors.append(f"field has {field['dimensions']} dimensions instead of {config['dimensions']}")
+    if field.get("stored", True) != config["stored"] or (not config["stored"] and field.get("retrievable", True)):
+        errors.append("stored or retrievable do not match the stored setting")
+
+    profile = profiles.get(field["vectorSearchProfile"])
+    if profile is None:
+        errors.append(f"field refers to missing profile {field['vectorSearchProfile']}")
+    else:
+        algorithm = algorithms.get(profile["algorithm"])
+        if algorithm is None or algorithm["kind"] != "hnsw":
+            errors.append(f"profile refers to missing HNSW algorithm {profile['algorithm']}")
+        else:
+            parameters = algorithm["hnswParameters"]
+            expected = {"m": config["m"], "efConstruction": config["ef_construction"], "efSearch": config["ef_search"], "metric": config["metric"]}
+            if {key: parameters.get(key) for key in expected} != expected:
+                errors.append(f"HNSW parameters {parameters} do not match {expected}")
+        compression = profile.get("compression")
+        if config["scalar_quantization"] != (compression is not None):
+            errors.append(f"profile compression {compression} does not match scalar_quantization")
+        elif compression is not None and compressions.get(compression, {}).get("kind") != "scalarQuantization":
+            errors.append(f"profile refers to missing scalar quantization {compression}")
+
+    for embedding in embeddings:
+        if len(embedding) != config["dimensions"]:
+            errors.append(f"embedding has {len(embedding)} dimensions instead of {config['dimensions']}")
+            break
+        if config["element_type"] == "SByte":
+            if not all(isinstance(value, int) for value in embedding) or max(abs(value) for value in embedding) != 127:
+                errors.append("SByte embedding is not scaled to the int8 range")
+                break
+        else:
+            if max(abs(value) for value in embedding) > VALUE_RANGES[config["element_type"]]:
+                errors.append(f"embedding values exceed the {config['element_type']} range")
+                break
+            norm = math.sqrt(sum(value * value for value in embedding))
+            if abs(norm - 1) > 1e-3:
+                errors.append(f"embedding is not normalized, norm {norm:.4f}")
+                break
+
+    item_bytes = len(json.dumps(embeddings[0]))
+    return errors, item_bytes
+
+
+def main():
+    print(f"{'config':<10} {'type':<8} {'dims':>5} {'SQ':>3} {'stored':>6} {'bytes/item':>11}  result")
+    failed = False
+    for name, value in CONFIGS.items():
+        config = parse_vector_config(value, MODEL)
+        errors, item_bytes = check(name, value)
+        failed = failed or bool(errors)
+        print(f"{name:<10} {config['element_type']:<8} {config['dimensions']:>5} {'yes' if config['scalar_quantization'] else 'no':>3} "
+              f"{str(config['stored']).lower():>6} {item_bytes:>11}  {'; '.join(errors) or 'ok'}", flush=True)
+
+    invalid_settings = [(MODEL, {"dimensions": 8192}), (MODEL, {"element_type": "SByte", "metric": "euclidean"}),
+                        (MODEL, {"m": 12}), (MODEL, {"dims": 256}), (MODEL, {"dimensions": 4096}),
+                        ("text-embedding-ada-002", {"dimensions": 256})]
+    for model, invalid in invalid_settings:
+        try:
+            parse_vector_config(invalid, model)
+            print(f"invalid settings accepted for {model}: {invalid}")
+            failed = True
+        except ValueError:
+            pass
+
+    if failed:
+        sys.exit(1)
+    print("All index definitions match the produced vectors")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ kubectl delete -f "$script_dir/../components-k8s"
 components=(
     "batcher"
     "document_completed"
+    "enrich_batch"
     "enrichment_completed"
     "generate_embeddings"
     "generate_keyphrases"
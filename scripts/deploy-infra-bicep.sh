@@ -69,6 +69,7 @@ if [[ $? -eq 0 ]]; then
             OPENAI_ENDPOINT: .properties.outputs.openai_service_endpoint.value,
             OPENAI_DEPLOYMENT: .properties.outputs.openai_service_deployment_name.value,
             OPENAI_KEY: .properties.outputs.openai_service_key.value,
+            OPENAI_EMBEDDING_MODEL: .properties.outputs.openai_service_model_name.value,
             AZURE_LANGUAGE_ENDPOINT: .properties.outputs.cognitive_service_endpoint.value,
             AZURE_LANGUAGE_KEY: .properties.outputs.cognitive_service_key.value,
             SEARCH_SERVICE: .properties.outputs.search_name.value,
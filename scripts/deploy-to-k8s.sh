@@ -16,6 +16,7 @@ kubectl apply -f "$script_dir/../components-k8s"
 components=(
     "batcher"
     "document_completed"
+    "enrich_batch"
     "enrichment_completed"
     "generate_embeddings"
     "generate_keyphrases"
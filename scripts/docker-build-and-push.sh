@@ -22,6 +22,7 @@ az acr login --name "$acr_name"
 components=(
     "batcher"
     "document_completed"
+    "enrich_batch"
     "enrichment_completed"
     "generate_embeddings"
     "generate_keyphrases"
@@ -31,7 +32,8 @@ components=(
 
 # Iterate over components and use the build_and_push function for each
 for component in "${components[@]}"; do
-    docker build --platform linux/amd64  -t "$acr_login_server/$component" src/$component
+    # build from src/ so the shared common package can be copied into each image
+    docker build --platform linux/amd64 -f src/$component/Dockerfile -t "$acr_login_server/$component" src
     docker push "$acr_login_server/$component"
 done
 
@@ -1,13 +1,19 @@
 import json
 from flask import Flask, request, jsonify
-from azure.storage.blob import BlobServiceClient
-from dapr.clients import DaprClient
 from nanoid import generate
 import os
+from common.backlog import expose_backlog, start_ingestion
+from common.blob_storage import get_container_client
+from common.lanes import PRIORITIES, default_priority, lane_pubsub, lane_topic
+from common.search_items import OUTPUT_COMPACTIONS, OUTPUT_FORMATS
+from common.startup import start_up, when_ready
+from common.telemetry import create_dapr_client, instrument_app, observe_handler, track_call
+from common.vector_config import embedding_model, parse_vector_config
 
 # Initialize Flask app and Dapr client
 app = Flask(__name__)
-dapr_client = DaprClient()
+dapr_client = create_dapr_client()
+instrument_app(app, "batcher")
 
 # Configuration
 APP_PORT = os.getenv("APP_PORT", "6000")
@@ -16,33 +22,36 @@ SECRET_STORE = 'secretstore'
 DESTINATION_TOPIC_NAME = 'process-document'
 
 # Helper functions
+def warm_up_clients():
+    get_container_client(dapr_client)
+
 def get_required_data(request_data, *keys):
     return (request_data.get(key) for key in keys)
 
-def publish_event_for_blob(blob, ingestion_id):
-    doc_id = generate(size=8)
+def publish_event_for_blob(blob, doc_id, ingestion_id, priority, vector_config):
     dapr_client.publish_event(
-        pubsub_name=PUBSUB_NAME,
-        topic_name=DESTINATION_TOPIC_NAME,
+        pubsub_name=lane_pubsub(priority, PUBSUB_NAME),
+        topic_name=lane_topic(DESTINATION_TOPIC_NAME, priority),
         data=json.dumps({
             'ingestion_id': ingestion_id,
             'doc_id': doc_id,
-            'blob_name': blob.name
+            'blob_name': blob.name,
+            'priority': priority,
+            'vector_config': vector_config,
+            # version of the document the work of all stages on it is recorded under
+            'content_version': blob.etag.strip('"')
         }),
         data_content_type='application/json',
     )
 
     print(f'Published filename ({blob.name}) with document ID ({doc_id})', flush=True)
-    return doc_id
 
 @app.route('/batcher-trigger', methods=['POST'])
+@observe_handler
+@when_ready
 def batcher_trigger():
     print('HTTP trigger received!', flush=True)
 
-    # get blob connection string
-    blob_secret = dapr_client.get_secret(store_name=SECRET_STORE, key="secretstore").secret["AZURE_BLOB_CONNECTION_STRING"]
-    blob_container_name = dapr_client.get_secret(store_name=SECRET_STORE, key="secretstore").secret["BLOB_CONTAINER_NAME"]
-
     # Extract required data from request
     request_data = request.get_json()
     if not request_data:
@@ -58,31 +67,63 @@ def batcher_trigger():
     if not all([source_folder_path, searchitems_folder_path, searchindexer_name]):
         return jsonify(success=False, error="All required fields must be provided."), 400
 
-    # Initialize Azure Blob Service Client
-    blob_service_client = BlobServiceClient.from_connection_string(blob_secret)
-    container_client = blob_service_client.get_container_client(blob_container_name)
-    blob_list = list(container_client.list_blobs(name_starts_with=source_folder_path))
+    priority = request_data.get('priority')
+    if priority is not None and priority not in PRIORITIES:
+        return jsonify(success=False, error=f"priority must be one of: {', '.join(PRIORITIES)}"), 400
+
+    # index schema of the ingestion, the embedding model has to produce vectors that fit it
+    try:
+        vector_config = parse_vector_config(request_data.get('vector_config'), embedding_model(dapr_client))
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+
+    # many small batch blobs can be rolled up into larger blobs for the indexer
+    output_compaction = request_data.get('output_compaction', 'off')
+    output_format = request_data.get('output_format', 'jsonArray')
+    if output_compaction not in OUTPUT_COMPACTIONS:
+        return jsonify(success=False, error=f"output_compaction must be one of: {', '.join(OUTPUT_COMPACTIONS)}"), 400
+    if output_format not in OUTPUT_FORMATS:
+        return jsonify(success=False, error=f"output_format must be one of: {', '.join(OUTPUT_FORMATS)}"), 400
+    if output_format != 'jsonArray' and output_compaction == 'off':
+        return jsonify(success=False, error="output_format jsonLines requires output_compaction"), 400
+
+    container_client = get_container_client(dapr_client)
+    with track_call("blob", "list_blobs"):
+        blob_list = list(container_client.list_blobs(name_starts_with=source_folder_path))
 
     # Generate ingestion ID
     ingestion_id = generate(size=5, alphabet='abcdefghijklmnopqrstuvwxyz0123456789')
     document_size = len(blob_list)
-    doc_ids = []
+    doc_ids = [generate(size=8) for _ in blob_list]
 
-    print(f'Started ingestion on {source_folder_path} with Ingestion ID: {ingestion_id} with total documents: {document_size}', flush=True)
+    # large ingestions (backfills) go to the low priority lane unless a priority is given
+    priority = priority or default_priority(document_size)
 
-    # Publish events for each blob
-    for blob in blob_list:
-        doc_id = publish_event_for_blob(blob, ingestion_id)
-        doc_ids.append(doc_id)
+    print(f'Started ingestion on {source_folder_path} with Ingestion ID: {ingestion_id} with total documents: {document_size} and priority: {priority}', flush=True)
 
-    # Save the state of the ingestion
+    # Save the state of the ingestion, the stages read it while they handle the documents
     state_key = f'ingestion-{ingestion_id}'
     dapr_client.save_state(store_name='statestore', key=state_key, value=json.dumps({
         'doc_ids': doc_ids,
         'searchitems_folder_path': searchitems_folder_path,
-        'searchindexer_name': searchindexer_name
+        'searchindexer_name': searchindexer_name,
+        'priority': priority,
+        'vector_config': vector_config,
+        'output_compaction': output_compaction,
+        'output_format': output_format
     }))
 
+    # the documents are in the backlog of process-document before their events can be handled
+    start_ingestion(dapr_client, ingestion_id, doc_ids)
+
+    # Publish events for each blob
+    for blob, doc_id in zip(blob_list, doc_ids):
+        publish_event_for_blob(blob, doc_id, ingestion_id, priority, vector_config)
+
     return jsonify(success=True), 200
 
+# the backlog of all stages, for the autoscaler
+expose_backlog(app, dapr_client)
+
+start_up(app, dapr_client, modules=("azure.storage.blob",), clients=(warm_up_clients,))
 app.run(port=APP_PORT)
\ No newline at end of file
@@ -0,0 +1,276 @@
+import json
+import os
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+from dapr.clients.grpc._request import TransactionalStateOperation, TransactionOperationType
+from dapr.clients.grpc._state import StateItem
+from flask import request
+from prometheus_client import REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+from common.startup import ready
+from common.state import STATE_CONFLICT_ERRORS, increment_fields, save_state_if_unchanged, update_counter, update_fields
+
+# Work waiting for each stage, kept in the state store so an autoscaler can size every stage to its
+# own backlog. An item is enqueued for a stage when its event is published and dequeued when the
+# stage is done with it: documents for process-document and batches for the enrichers.
+#
+# Only counts are kept: the items enqueued per minute they were enqueued in and the items dequeued,
+# in separate keys, so publishers and stages don't update the same keys and the values stay small.
+# Stages take items about in the order they were published, so the oldest item waiting is taken to
+# be in the first minute that has more items enqueued up to it than were dequeued.
+store_name = "statestore"
+BACKLOG_STAGES = ("process-document", "generate-embeddings", "generate-keyphrases", "generate-summaries", "enrich-batch")
+
+# The counts of a stage and ingestion are spread over shards by item, so the replicas of a stage
+# rarely update the same key, also when they work on batches of the same document. Has to be the
+# same for all services.
+BACKLOG_SHARDS = int(os.getenv("BACKLOG_SHARDS", "8"))
+BACKLOG_BUCKET_SECONDS = 60
+BACKLOG_TTL_IN_SECONDS = 24 * 60 * 60
+# the backlog is read at most once per interval, however many scrapers and scalers ask for it
+BACKLOG_CACHE_SECONDS = float(os.getenv("BACKLOG_CACHE_SECONDS", "5"))
+
+INGESTIONS_KEY = "backlog-ingestions"
+
+_cache = {"backlog": None, "read_at": 0.0}
+_lock = threading.Lock()
+
+
+def enqueued_key(stage, ingestion_id, shard):
+    return f"backlog-{stage}-{ingestion_id}-{shard}"
+
+
+def dequeued_key(stage, ingestion_id, shard):
+    return f"backlog-done-{stage}-{ingestion_id}-{shard}"
+
+
+def dequeued_item_key(stage, ingestion_id, item):
+    return f"backlog-dequeued-{stage}-{ingestion_id}-{item}"
+
+
+def parked_batches_key(ingestion_id):
+    return f"parked-batches-{ingestion_id}"
+
+
+def item_shard(item):
+    return zlib.crc32(item.encode("utf-8")) % BACKLOG_SHARDS
+
+
+def batch_item(doc_id, batch_nr):
+    return f"{doc_id}-batch-{batch_nr}"
+
+
+def enqueue_bucket(now):
+    return str(int(now // BACKLOG_BUCKET_SECONDS * BACKLOG_BUCKET_SECONDS))
+
+
+def start_ingestion(dapr_client, ingestion_id, doc_ids):
+    """
+    Registers an ingestion and enqueues all of its documents for process-document. Call it before
+    the documents are published.
+    """
+    now = time.time()
+    update_fields(dapr_client, store_name, INGESTIONS_KEY, {ingestion_id: now}, ttl_in_seconds=BACKLOG_TTL_IN_SECONDS)
+
+    shards = defaultdict(int)
+    for doc_id in doc_ids:
+        shards[item_shard(doc_id)] += 1
+    if shards:
+        dapr_client.save_bulk_state(store_name=store_name, states=[
+            StateItem(key=enqueued_key("process-document", ingestion_id, shard), value=json.dumps({enqueue_bucket(now): count}),
+                      metadata={"ttlInSeconds": str(BACKLOG_TTL_IN_SECONDS)})
+            for shard, count in shards.items()
+        ])
+
+
+def enqueue(dapr_client, stages, ingestion_id, item):
+    """
+    Adds an item to the backlog of the stages. Call it before the item's events are published.
+    """
+    bucket = enqueue_bucket(time.time())
+    for stage in stages:
+        _update(increment_fields, dapr_client, enqueued_key(stage, ingestion_id, item_shard(item)), {bucket: 1})
+
+
+def dequeue(dapr_client, stage, ingestion_id, item):
+    """
+    Takes an item out of the backlog of the stage, once per item: a first-write marker of the item
+    guards the count, so a redelivery that does the work again doesn't take it out twice. A failure
+    between the two leaves the item counted as waiting, which only errs towards more replicas.
+    """
+    try:
+        save_state_if_unchanged(dapr_client, store_name, dequeued_item_key(stage, ingestion_id, item), "1", None,
+                                {"ttlInSeconds": str(BACKLOG_TTL_IN_SECONDS)})
+    except STATE_CONFLICT_ERRORS:
+        return
+    except Exception as e:
+        print(f"Could not dequeue {item} from backlog of {stage}: {str(e)}", flush=True)
+        return
+    _update(update_counter, dapr_client, dequeued_key(stage, ingestion_id, item_shard(item)), 1)
+
+
+def _update(update, dapr_client, key, change):
+    # the backlog only steers scaling, failing to track an item doesn't fail the work on it
+    try:
+        update(dapr_client, store_name, key, change, ttl_in_seconds=BACKLOG_TTL_IN_SECONDS)
+    except Exception as e:
+        print(f"Could not update backlog {key}: {str(e)}", flush=True)
+
+
+def count_parked_batches(dapr_client, ingestion_id, delta):
+    try:
+        update_counter(dapr_client, store_name, parked_batches_key(ingestion_id), delta, ttl_in_seconds=BACKLOG_TTL_IN_SECONDS)
+    except Exception as e:
+        print(f"Could not count parked batches of {ingestion_id}: {str(e)}", flush=True)
+
+
+def finish_ingestion(dapr_client, ingestion_id):
+    """
+    Removes what is left of the backlog of a completed ingestion
+    """
+    keys = [key(stage, ingestion_id, shard) for key in (enqueued_key, dequeued_key) for stage in BACKLOG_STAGES for shard in range(BACKLOG_SHARDS)]
+    dapr_client.execute_state_transaction(store_name=store_name, operations=[
+        TransactionalStateOperation(key=key, data="", operation_type=TransactionOperationType.delete)
+        for key in keys + [parked_batches_key(ingestion_id)]
+    ])
+    try:
+        update_fields(dapr_client, store_name, INGESTIONS_KEY, removals=(ingestion_id,), ttl_in_seconds=BACKLOG_TTL_IN_SECONDS)
+    except Exception as e:
+        print(f"Could not remove ingestion {ingestion_id} from the backlog: {str(e)}", flush=True)
+
+
+def read_backlog(dapr_client):
+    """
+    Returns the number of items and the age of the oldest item per stage and, per ingestion, its
+    documents pending, batches in flight (published, not yet completed), slots leaked by batches
+    that never completed and batches parked
+    """
+    now = time.time()
+    ingestions = json.loads(dapr_client.get_state(store_name=store_name, key=INGESTIONS_KEY).data or "{}")
+    # ingestions that never completed are left out once their backlog expired
+    ingestions = {ingestion_id: started for ingestion_id, started in ingestions.items() if now - started < BACKLOG_TTL_IN_SECONDS}
+
+    keys = []
+    for ingestion_id in ingestions:
+        keys += [f"ingestion-{ingestion_id}", f"inflight-batches-{ingestion_id}", f"inflight-leaked-{ingestion_id}", parked_batches_key(ingestion_id)]
+        keys += [key(stage, ingestion_id, shard) for key in (enqueued_key, dequeued_key) for stage in BACKLOG_STAGES for shard in range(BACKLOG_SHARDS)]
+    values = {}
+    if keys:
+        values = {item.key: item.data for item in dapr_client.get_bulk_state(store_name=store_name, keys=keys, parallelism=10).items if item.data}
+
+    stages = {stage: {"items": 0, "oldest_age_seconds": 0.0} for stage in BACKLOG_STAGES}
+    report = {}
+    for ingestion_id, started in ingestions.items():
+        ingestion = json.loads(values.get(f"ingestion-{ingestion_id}") or "{}")
+        report[ingestion_id] = {
+            "age_seconds": round(now - started, 1),
+            "documents_pending": len(ingestion.get("doc_ids", [])),
+            "inflight_batches": int(values.get(f"inflight-batches-{ingestion_id}") or 0),
+            "leaked_batches": int(values.get(f"inflight-leaked-{ingestion_id}") or 0),
+            "parked_batches": int(values.get(parked_batches_key(ingestion_id)) or 0),
+            "stages": {},
+        }
+        for stage in BACKLOG_STAGES:
+            buckets = defaultdict(int)
+            for shard in range(BACKLOG_SHARDS):
+                for bucket, count in json.loads(values.get(enqueued_key(stage, ingestion_id, shard)) or "{}").items():
+                    buckets[int(bucket)] += count
+            done = sum(int(values.get(dequeued_key(stage, ingestion_id, shard)) or 0) for shard in range(BACKLOG_SHARDS))
+
+            items = max(sum(buckets.values()) - done, 0)
+            report[ingestion_id]["stages"][stage] = items
+            stages[stage]["items"] += items
+            if items:
+                stages[stage]["oldest_age_seconds"] = round(max(stages[stage]["oldest_age_seconds"], now - oldest_bucket(buckets, done)), 1)
+
+    return {"stages": stages, "ingestions": report}
+
+
+def oldest_bucket(buckets, dequeued):
+    """
+    Start of the first bucket of enqueued items that the dequeued items don't cover
+    """
+    for bucket in sorted(buckets):
+        dequeued -= buckets[bucket]
+        if dequeued < 0:
+            return bucket
+    return max(buckets)
+
+
+def cached_backlog(dapr_client):
+    with _lock:
+        if _cache["backlog"] is None or time.monotonic() - _cache["read_at"] > BACKLOG_CACHE_SECONDS:
+            _cache["backlog"] = read_backlog(dapr_client)
+            _cache["read_at"] = time.monotonic()
+        return _cache["backlog"]
+
+
+class BacklogCollector:
+    """
+    Exposes the backlog on /metrics, read from the state store when it is scraped
+    """
+    def __init__(self, dapr_client):
+        self.dapr_client = dapr_client
+
+    def describe(self):
+        return self.metric_families()
+
+    def collect(self):
+        families = self.metric_families()
+        if not ready.is_set():
+            return families
+        try:
+            backlog = cached_backlog(self.dapr_client)
+        except Exception as e:
+            print(f"Could not read the backlog: {str(e)}", flush=True)
+            return families
+
+        stage_items, stage_age, documents, inflight, leaked, parked = families
+        for stage, values in backlog["stages"].items():
+            stage_items.add_metric([stage], values["items"])
+            stage_age.add_metric([stage], values["oldest_age_seconds"])
+        for ingestion_id, values in backlog["ingestions"].items():
+            documents.add_metric([ingestion_id], values["documents_pending"])
+            inflight.add_metric([ingestion_id], values["inflight_batches"])
+            leaked.add_metric([ingestion_id], values["leaked_batches"])
+            parked.add_metric([ingestion_id], values["parked_batches"])
+        return families
+
+    @staticmethod
+    def metric_families():
+        return [
+            GaugeMetricFamily("pipeline_backlog_items", "Items published to a stage that it has not finished", labels=["stage"]),
+            GaugeMetricFamily("pipeline_backlog_oldest_age_seconds", "Age of the oldest item in the backlog of a stage", labels=["stage"]),
+            GaugeMetricFamily("pipeline_ingestion_documents_pending", "Documents of an ingestion that are not completed", labels=["ingestion_id"]),
+            GaugeMetricFamily("pipeline_ingestion_inflight_batches", "Batches of an ingestion published and not yet completed", labels=["ingestion_id"]),
+            GaugeMetricFamily("pipeline_ingestion_leaked_batches", "In-flight slots of an ingestion taken over after their batch never released them", labels=["ingestion_id"]),
+            GaugeMetricFamily("pipeline_ingestion_parked_batches", "Batches of an ingestion parked until enrichment catches up", labels=["ingestion_id"]),
+        ]
+
+
+def expose_backlog(app, dapr_client):
+    """
+    Adds /backlog to the app and the backlog gauges to /metrics. /backlog?stage=<stage> returns the
+    backlog of one stage, for the metrics-api trigger of a KEDA ScaledObject.
+    """
+    @app.route("/backlog", methods=["GET"])
+    def backlog():
+        if not ready.is_set():
+            return json.dumps({"status": "warming-up"}), 503, {"ContentType": "application/json"}
+        try:
+            report = cached_backlog(dapr_client)
+        except Exception as e:
+            return json.dumps({"success": False, "error": str(e)}), 503, {"ContentType": "application/json"}
+
+        stage = request.args.get("stage")
+        if stage is None:
+            return json.dumps(report), 200, {"ContentType": "application/json"}
+        if stage not in report["stages"]:
+            return json.dumps({"success": False, "error": f"stage must be one of: {', '.join(BACKLOG_STAGES)}"}), 404, {"ContentType": "application/json"}
+        return json.dumps(dict(report["stages"][stage], stage=stage)), 200, {"ContentType": "application/json"}
+
+    REGISTRY.register(BacklogCollector(dapr_client))
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import threading
+
+from common.secrets import get_secrets
+
+# Blobs are downloaded in parallel ranged reads of at most this size, so a large scan is never held
+# in a single response buffer. Every read in flight costs a multiple of this in transient buffers.
+BLOB_CHUNK_SIZE = int(os.getenv("BLOB_CHUNK_SIZE", str(1024 * 1024)))
+BLOB_DOWNLOAD_CONCURRENCY = int(os.getenv("BLOB_DOWNLOAD_CONCURRENCY", "4"))
+# Downloads up to this size stay in memory, larger ones are spooled to a temporary file
+BLOB_SPOOL_MAX_BYTES = int(os.getenv("BLOB_SPOOL_MAX_BYTES", str(8 * 1024 * 1024)))
+
+
+_container_clients = {}
+_lock = threading.Lock()
+
+
+def create_blob_service_client(connection_string):
+    # imported on first use, it is one of the slower SDKs to import
+    from azure.storage.blob import BlobServiceClient
+    return BlobServiceClient.from_connection_string(
+        connection_string,
+        max_single_get_size=BLOB_CHUNK_SIZE,
+        max_chunk_get_size=BLOB_CHUNK_SIZE
+    )
+
+
+def get_container_client(dapr_client):
+    """
+    Client of the pipeline's blob container. It is created once per connection string, so events
+    share its connection pool instead of connecting for every event.
+    """
+    secrets = get_secrets(dapr_client)
+    key = (secrets["AZURE_BLOB_CONNECTION_STRING"], secrets["BLOB_CONTAINER_NAME"])
+    with _lock:
+        if key not in _container_clients:
+            _container_clients[key] = create_blob_service_client(key[0]).get_container_client(key[1])
+        return _container_clients[key]
+
+
+def download_to_spool(blob_client, max_concurrency=BLOB_DOWNLOAD_CONCURRENCY, spool_max_bytes=BLOB_SPOOL_MAX_BYTES):
+    """
+    Downloads a blob with parallel ranged reads into a SpooledTemporaryFile and returns it rewound
+    together with the blob size. Memory use is bounded by spool_max_bytes plus one chunk per
+    concurrent read, whatever the size of the blob. Close the returned file when done.
+    """
+    stream = tempfile.SpooledTemporaryFile(max_size=spool_max_bytes)
+    try:
+        size = blob_client.download_blob(max_concurrency=max_concurrency).readinto(stream)
+        stream.seek(0)
+    except Exception:
+        stream.close()
+        raise
+    return stream, size
@@ -0,0 +1,38 @@
+import os
+
+# Enrichment modes:
+#   split              every enrichment has its own service and topic
+#   language-combined  generate-keyphrases extracts key phrases and summaries with one Language
+#                      analyze job per batch, generate-summaries receives no events
+#   fused              enrich-batch runs all enrichments of a batch concurrently in one handler and
+#                      uploads the search items itself, the batch travels in the event
+# Only process-document reads ENRICHMENT_MODE, it sends the mode along in every batch event so the
+# enrichers always handle a batch the way it was published.
+ENRICHMENT_MODES = ("split", "language-combined", "fused")
+ENRICHMENT_MODE = os.getenv("ENRICHMENT_MODE", "split")
+
+if ENRICHMENT_MODE not in ENRICHMENT_MODES:
+    raise ValueError(f"ENRICHMENT_MODE must be one of: {', '.join(ENRICHMENT_MODES)}")
+
+
+def event_enrichment_mode(data):
+    # events published before the mode was part of them are split
+    return data.get("enrichment_mode") or "split"
+
+
+def enrichment_topics(mode=ENRICHMENT_MODE):
+    """
+    Returns the topics process-document publishes every batch to
+    """
+    if mode == "fused":
+        return ["enrich-batch"]
+    if mode == "language-combined":
+        return ["generate-embeddings", "generate-keyphrases"]
+    return ["generate-embeddings", "generate-keyphrases", "generate-summaries"]
+
+
+def enrichment_calls_per_batch(mode=ENRICHMENT_MODE):
+    """
+    Returns the number of calls to enrichment services made for every batch
+    """
+    return 2 if mode == "language-combined" else 3
@@ -0,0 +1,165 @@
+import json
+import os
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+
+from common.state import STATE_CONFLICT_ERRORS, save_state_if_unchanged
+from common.telemetry import count_redelivery_skipped
+
+# Ledger of processed events in the state store. Service Bus redelivers events whose handler runs
+# past the lock duration, the ledger makes sure the expensive work of an event is done once.
+store_name = "statestore"
+
+# Done entries are kept until redeliveries are no longer expected
+IDEMPOTENCY_TTL_IN_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_IN_SECONDS", str(24 * 60 * 60)))
+# A lease is renewed while its replica works and expires soon after the replica dies, so the work
+# is picked up again by a redelivery
+IDEMPOTENCY_LEASE_IN_SECONDS = int(os.getenv("IDEMPOTENCY_LEASE_IN_SECONDS", "60"))
+
+CLAIMED = "claimed"
+DONE = "done"
+LEASED = "leased"
+
+replica_id = os.getenv("HOSTNAME") or socket.gethostname()
+
+# leases held by this replica, key -> (lease, event that stops the renewal, renewal thread)
+_leases = {}
+_leases_lock = threading.Lock()
+
+
+def ledger_key(stage, doc_id, batch_nr=None, content_version=None):
+    """
+    Key of the work of a stage on a document or batch of it. The content version (the etag of the
+    source blob) keeps work on a changed document apart from work on an earlier version.
+    """
+    return f"processed-{stage}-{doc_id}-{'document' if batch_nr is None else batch_nr}-{content_version or 'none'}"
+
+
+def claim(dapr_client, key):
+    """
+    Takes a lease on the work of an event. Returns CLAIMED when the caller should do the work and
+    then call complete or release, DONE when it was done before and LEASED when another replica
+    is doing it. The handler doesn't wait for a lease, the event is retried with the broker's
+    backoff instead of holding a handler thread.
+    """
+    item = dapr_client.get_state(store_name=store_name, key=key)
+    if item.data:
+        status = json.loads(item.data)["status"]
+    elif take_lease(dapr_client, key):
+        return CLAIMED
+    else:
+        status = LEASED
+
+    count_redelivery_skipped(status)
+    return status
+
+
+@contextmanager
+def once(dapr_client, key):
+    """
+    Claims the work of an event for the with block and yields the claim. When it is CLAIMED the
+    work is completed at the end of the block, or released when the block raises so a redelivery
+    does it again. Otherwise the block should skip the work, see skipped_response.
+    """
+    status = claim(dapr_client, key)
+    if status != CLAIMED:
+        yield status
+        return
+
+    try:
+        yield status
+    except BaseException:
+        release(dapr_client, key)
+        raise
+    complete(dapr_client, key)
+
+
+def run_detached(dapr_client, key, work):
+    """
+    Claims the work of an event and, when CLAIMED, runs it on a thread of its own while the lease
+    is renewed, for work that takes longer than the lock of the event. Returns the handler
+    response: the event is retried until the work is done, and when the replica dies or the work
+    fails a redelivery claims it again.
+    """
+    status = claim(dapr_client, key)
+    if status != CLAIMED:
+        return skipped_response(status)
+
+    def run():
+        try:
+            work()
+        except Exception as e:
+            print(f"Failed the work of {key}: {str(e)}", flush=True)
+            release(dapr_client, key)
+            return
+        complete(dapr_client, key)
+
+    threading.Thread(target=run, name=f"work-{key}", daemon=True).start()
+    return skipped_response(LEASED)
+
+
+def take_lease(dapr_client, key):
+    lease = json.dumps({"status": LEASED, "replica": replica_id, "lease": uuid.uuid4().hex})
+    try:
+        # only the first replica to write the lease gets it
+        save_state_if_unchanged(dapr_client, store_name, key, lease, None, {"ttlInSeconds": str(IDEMPOTENCY_LEASE_IN_SECONDS)})
+    except STATE_CONFLICT_ERRORS:
+        return False
+
+    stop = threading.Event()
+    renewal = threading.Thread(target=renew_lease, args=(dapr_client, key, lease, stop), name=f"lease-{key}", daemon=True)
+    with _leases_lock:
+        _leases[key] = (lease, stop, renewal)
+    renewal.start()
+    return True
+
+
+def renew_lease(dapr_client, key, lease, stop):
+    while not stop.wait(IDEMPOTENCY_LEASE_IN_SECONDS / 3):
+        try:
+            item = dapr_client.get_state(store_name=store_name, key=key)
+            if item.data and item.data.decode("utf-8") != lease:
+                print(f"Lost lease {key} to another replica", flush=True)
+                return
+            save_state_if_unchanged(dapr_client, store_name, key, lease, item.etag, {"ttlInSeconds": str(IDEMPOTENCY_LEASE_IN_SECONDS)})
+        except Exception as e:
+            # the next renewal tries again, the lease only expires after missing all of them
+            print(f"Could not renew lease {key}: {str(e)}", flush=True)
+
+
+def stop_renewal(key):
+    with _leases_lock:
+        _, stop, renewal = _leases.pop(key, (None, None, None))
+    if stop:
+        stop.set()
+        renewal.join()
+
+
+def complete(dapr_client, key):
+    stop_renewal(key)
+    dapr_client.save_state(store_name=store_name, key=key, value=json.dumps({"status": DONE, "replica": replica_id}),
+                           state_metadata={"ttlInSeconds": str(IDEMPOTENCY_TTL_IN_SECONDS)})
+
+
+def release(dapr_client, key):
+    """
+    Gives up the lease after a failure, so the redelivery of the event does the work again
+    """
+    stop_renewal(key)
+    try:
+        dapr_client.delete_state(store_name=store_name, key=key)
+    except Exception as e:
+        # the lease expires by itself
+        print(f"Could not release lease {key}: {str(e)}", flush=True)
+
+
+def skipped_response(status):
+    """
+    Handler response for an event that was not processed again: acknowledged when the work is
+    done, retried later by Dapr when another replica still holds the lease
+    """
+    if status == DONE:
+        return json.dumps({"success": True}), 200, {"ContentType": "application/json"}
+    return json.dumps({"success": False, "status": "RETRY"}), 200, {"ContentType": "application/json"}
@@ -0,0 +1,33 @@
+import os
+
+# Priority lanes. Each lane has its own topics on its own pub/sub component, so the handler
+# concurrency configured on the component (maxConcurrentHandlers) is reserved per lane and a
+# backfill in the low lane never queues in front of an interactive ingestion in the high lane.
+PRIORITIES = ("high", "normal", "low")
+DEFAULT_PRIORITY = "normal"
+
+# Ingestions with more documents than this default to the low lane
+LARGE_INGESTION_THRESHOLD = int(os.getenv("LARGE_INGESTION_THRESHOLD", "1000"))
+
+
+def default_priority(document_count):
+    return "low" if document_count > LARGE_INGESTION_THRESHOLD else DEFAULT_PRIORITY
+
+
+def event_priority(data):
+    return data.get("priority") or DEFAULT_PRIORITY
+
+
+def lane_pubsub(priority, pubsub_name="pubsub"):
+    return pubsub_name if priority == DEFAULT_PRIORITY else f"{pubsub_name}-{priority}"
+
+
+def lane_topic(topic, priority):
+    return topic if priority == DEFAULT_PRIORITY else f"{topic}-{priority}"
+
+
+def lane_subscriptions(topic, route, pubsub_name="pubsub"):
+    return [
+        {"pubsubname": lane_pubsub(priority, pubsub_name), "topic": lane_topic(topic, priority), "route": route}
+        for priority in PRIORITIES
+    ]
@@ -0,0 +1,99 @@
+import threading
+
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import AzureError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from common.secrets import get_secret
+from common.telemetry import count_retry, track_call
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def create_language_client(dapr_client):
+    """
+    Language client of the configured endpoint, created once so its connections are reused
+    """
+    # imported on first use, the warm-up of the service calls this before events arrive
+    from azure.ai.textanalytics import TextAnalyticsClient
+
+    key = (get_secret(dapr_client, "AZURE_LANGUAGE_ENDPOINT"), get_secret(dapr_client, "AZURE_LANGUAGE_KEY"))
+    with _lock:
+        if key not in _clients:
+            _clients[key] = TextAnalyticsClient(endpoint=key[0], credential=AzureKeyCredential(key[1]))
+        return _clients[key]
+
+
+def summary_text(result):
+    return " ".join([sentence.text for sentence in result.sentences])
+
+
+@retry(retry=retry_if_exception_type(AzureError), wait=wait_random_exponential(min=15, max=60), stop=stop_after_attempt(40), before_sleep=count_retry("language"))
+def compute_keyphrases(text_analytics_client, texts, batch_nr):
+    with track_call("language", "extract_key_phrases"):
+        result = text_analytics_client.extract_key_phrases(texts)
+    if result and len(result) == len(texts) and not any([resp.is_error for resp in result]):
+        return [data.key_phrases for data in result]
+    else:
+        error_message = f"Error occurred in keyphrases batch_nr: {batch_nr}"
+        print(error_message, flush=True)
+        raise AzureError(error_message)
+
+
+@retry(retry=retry_if_exception_type(AzureError), wait=wait_random_exponential(min=15, max=60), stop=stop_after_attempt(40), before_sleep=count_retry("language"))
+def compute_summaries(text_analytics_client, texts, batch_nr):
+    with track_call("language", "extract_summary"):
+        poller = text_analytics_client.begin_extract_summary(texts)
+        summaries_result = poller.result()
+
+    # get summaries extraced for summaries_result:
+    summaries = []
+
+    for result in summaries_result:
+        if result.kind == "ExtractiveSummarization":
+            summaries.append(summary_text(result))
+
+        elif result.is_error is True:
+            raise AzureError(result.error.message)
+
+    if len(summaries) != len(texts):
+        error_message = f"Error occurred in summaries batch_nr: {batch_nr}"
+        print(error_message, flush=True)
+        raise AzureError(error_message)
+
+    return summaries
+
+
+@retry(retry=retry_if_exception_type(AzureError), wait=wait_random_exponential(min=15, max=60), stop=stop_after_attempt(40), before_sleep=count_retry("language"))
+def compute_keyphrases_and_summaries(text_analytics_client, texts, batch_nr):
+    """
+    Extracts key phrases and summaries with a single analyze job, uploading the texts once
+    """
+    from azure.ai.textanalytics import ExtractKeyPhrasesAction, ExtractiveSummaryAction
+
+    with track_call("language", "analyze_actions"):
+        poller = text_analytics_client.begin_analyze_actions(
+            texts,
+            actions=[ExtractKeyPhrasesAction(), ExtractiveSummaryAction()]
+        )
+        document_results = list(poller.result())
+
+    keyphrases = []
+    summaries = []
+
+    for action_results in document_results:
+        for result in action_results:
+            if result.is_error is True:
+                raise AzureError(result.error.message)
+            elif result.kind == "KeyPhraseExtraction":
+                keyphrases.append(result.key_phrases)
+            elif result.kind == "ExtractiveSummarization":
+                summaries.append(summary_text(result))
+
+    if len(keyphrases) != len(texts) or len(summaries) != len(texts):
+        error_message = f"Error occurred in keyphrases and summaries batch_nr: {batch_nr}"
+        print(error_message, flush=True)
+        raise AzureError(error_message)
+
+    return keyphrases, summaries
@@ -0,0 +1,70 @@
+import time
+from functools import lru_cache
+
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from common.secrets import get_secret
+from common.telemetry import count_retry, track_call
+
+
+@lru_cache(maxsize=None)
+def load_openai():
+    """
+    Imports and sets up the OpenAI SDK on first use, it is one of the slower SDKs to import
+    """
+    import openai
+
+    # OpenAI setup
+    openai.api_type = "azure"
+    openai.api_version = "2023-05-15"
+    return openai
+
+
+# first API version of Azure OpenAI with the dimensions parameter of embeddings
+DIMENSIONS_API_VERSION = "2024-02-01"
+
+
+def is_rate_limit_error(exception):
+    return isinstance(exception, load_openai().error.RateLimitError)
+
+CACHE_KEY_TOKEN_TYPE = "token_type"  # Define the missing constant
+open_ai_token_cache = {}  # Define the missing variable
+CACHE_KEY_TOKEN_CRED = "token_cred"  # Define the missing constant
+CACHE_KEY_CREATED_TIME = "created_time"  # Define the missing constant
+
+def refresh_openai_token():
+    """
+    Refresh OpenAI token every 5 minutes
+    """
+    openai = load_openai()
+    if openai.api_type == 'azure_ad' and CACHE_KEY_TOKEN_TYPE in open_ai_token_cache and open_ai_token_cache[CACHE_KEY_TOKEN_TYPE] == 'azure_ad' and open_ai_token_cache[CACHE_KEY_CREATED_TIME] + 300 < time.time():
+        token_cred = open_ai_token_cache[CACHE_KEY_TOKEN_CRED]
+        openai.api_key = token_cred.get_token("https://cognitiveservices.azure.com/.default").token
+        open_ai_token_cache[CACHE_KEY_CREATED_TIME] = time.time()
+
+@retry(retry=retry_if_exception(is_rate_limit_error), wait=wait_random_exponential(min=15, max=60), stop=stop_after_attempt(30), before_sleep=count_retry("openai"))
+def compute_embedding_in_batch(dapr_client, texts, dimensions=None):
+    """
+    Embeddings of the texts, shortened by the model itself to the given dimensions
+    """
+    openai = load_openai()
+    refresh_openai_token()
+    try:
+        OPENAI_ENDPOINT = get_secret(dapr_client, "OPENAI_ENDPOINT")
+        OPENAI_DEPLOYMENT = get_secret(dapr_client, "OPENAI_DEPLOYMENT")
+        OPENAI_KEY = get_secret(dapr_client, "OPENAI_KEY")
+        openai.api_key = OPENAI_KEY
+        openai.api_base = OPENAI_ENDPOINT
+        with track_call("openai", "embeddings"):
+            if dimensions:
+                emb_response = openai.Embedding.create(engine=OPENAI_DEPLOYMENT, input=texts, dimensions=dimensions,
+                                                       api_version=DIMENSIONS_API_VERSION)
+            else:
+                emb_response = openai.Embedding.create(engine=OPENAI_DEPLOYMENT, input=texts)
+        
+        if not emb_response["data"][0]["embedding"]:
+            raise ValueError("Empty embedding returned")
+        return [data.embedding for data in emb_response.data]
+    except openai.error.OpenAIError as e:
+        print(f"OpenAI API error: {e}", flush=True)
+        raise  # Reraise the exception to trigger the retry mechanism
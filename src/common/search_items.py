@@ -0,0 +1,381 @@
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from common import idempotency
+from common.lanes import lane_pubsub
+from common.state import update_counter
+from common.telemetry import observe_payload, track_call
+
+store_name = "statestore"
+pubsub_name = "pubsub"
+document_completed_topic = "document-completed"
+release_topic = "batch-released"
+
+# Output compaction: with "document" or "ingestion" the batches are staged outside the indexed
+# folder and rolled up into a few large blobs when the document or the whole ingestion is complete
+OUTPUT_COMPACTIONS = ("off", "document", "ingestion")
+OUTPUT_FORMATS = ("jsonArray", "jsonLines")
+SEARCHITEMS_STAGING_FOLDER = os.getenv("SEARCHITEMS_STAGING_FOLDER", "searchitems-staging/")
+# stay well below the blob size the indexer extracts on the smaller search tiers
+OUTPUT_MAX_BLOB_BYTES = int(os.getenv("OUTPUT_MAX_BLOB_BYTES", str(16 * 1024 * 1024)))
+ROLL_UP_DOWNLOAD_WORKERS = int(os.getenv("ROLL_UP_DOWNLOAD_WORKERS", "16"))
+# the "ingestion" roll-up deletes its batches after every round, a replica that takes it over goes
+# on from there
+ROLL_UP_ROUND_BATCHES = int(os.getenv("ROLL_UP_ROUND_BATCHES", "1000"))
+# maximum number of sub-requests of a blob batch request
+BLOB_BATCH_SIZE = 256
+
+# Near duplicate sections that reuse the enrichments of their canonical section instead of being
+# enriched, recorded per document by process-document and turned into search items by
+# document-completed once all batches of the ingestion are uploaded
+NEAR_DUPLICATES_FOLDER = os.getenv("NEAR_DUPLICATES_FOLDER", "near-duplicates/")
+ENRICHMENT_FIELDS = ("embeddings", "keyphrases", "summaries")
+
+# process-document publishes the batches of a document while it is still chunking it and seals the
+# document with its number of batches once the last one is published
+SEAL_TTL_IN_SECONDS = 24 * 60 * 60
+
+
+def merge_enrichments(sections, embeddings, keyphrases, summaries):
+    """
+    Adds the enrichments of a batch to its sections, in place, turning them into search items
+    """
+    for (i, section) in enumerate(sections):
+        section['embeddings'] = embeddings[i]
+        section['keyphrases'] = keyphrases[i]
+        section['summaries'] = summaries[i]
+    return sections
+
+
+def sealed_key(doc_id):
+    return f"document-sealed-{doc_id}"
+
+
+def rolled_up_key(doc_id):
+    return f"document-rolled-up-{doc_id}"
+
+
+def completed_batches_key(doc_id, content_version):
+    return f"document-completed-batches-{doc_id}-{content_version or 'none'}"
+
+
+def complete_batch(dapr_client, container_client, ingestion, ingestion_id, doc_id, batch_nr, content_version, search_items):
+    """
+    Uploads the search items of an enriched batch, completes the document when it is sealed and all
+    of its batches are uploaded and releases the batch's in-flight slot in process-document
+    """
+    ## upload json to blob storage
+    blob_name = f"{batch_folder(ingestion, ingestion_id)}{doc_id}-batch-{batch_nr}.json"
+    uploaded_blob_client = container_client.get_blob_client(blob=blob_name)
+
+    ## convert sections to json and upload to blob
+    with track_call("blob", "upload_blob"):
+        uploaded_blob_client.upload_blob(serialize_batch(ingestion, search_items), overwrite=True)
+
+    update_counter(dapr_client, store_name, completed_batches_key(doc_id, content_version), 1, ttl_in_seconds=SEAL_TTL_IN_SECONDS)
+    check_document_completion(dapr_client, container_client, ingestion, ingestion_id, doc_id, content_version)
+
+    ## let process-document publish another batch of this ingestion
+    dapr_client.publish_event(
+        pubsub_name=lane_pubsub("high", pubsub_name),
+        topic_name=release_topic,
+        data=json.dumps({
+            "ingestion_id": ingestion_id,
+            "doc_id": doc_id,
+            "batch_nr": batch_nr,
+            "content_version": content_version
+        })
+    )
+
+
+def seal_document(dapr_client, container_client, ingestion, ingestion_id, doc_id, total_batch_size, content_version):
+    """
+    Records the number of batches of a document once process-document published the last one. The
+    batches may all be uploaded already, so the completion is checked here as well.
+    """
+    dapr_client.save_state(store_name=store_name, key=sealed_key(doc_id), value=str(total_batch_size),
+                           state_metadata={"ttlInSeconds": str(SEAL_TTL_IN_SECONDS)})
+    check_document_completion(dapr_client, container_client, ingestion, ingestion_id, doc_id, content_version)
+
+
+def check_document_completion(dapr_client, container_client, ingestion, ingestion_id, doc_id, content_version):
+    """
+    Publishes document-completed once the document is sealed and as many batches are uploaded as
+    it was sealed with. The uploads are counted, the batch blobs are only listed once the count
+    reaches the seal. The last batch and the seal may both find the document complete, only one
+    of them completes it. With the "document" output compaction the roll-up deletes the batches,
+    it is recorded before, so a retry after a failed publish still finds the document complete.
+    """
+    sealed = dapr_client.get_state(store_name=store_name, key=sealed_key(doc_id)).data
+    if not sealed:
+        print(f"Document ID: {doc_id} is not sealed yet, more batches may follow", flush=True)
+        return
+    total_batch_size = int(sealed)
+
+    compact = ingestion.get("output_compaction") == "document"
+    rolled_up = compact and dapr_client.get_state(store_name=store_name, key=rolled_up_key(doc_id)).data
+
+    blob_path = f"{batch_folder(ingestion, ingestion_id)}{doc_id}-batch-"
+    if not rolled_up:
+        completed_batches = int(dapr_client.get_state(store_name=store_name, key=completed_batches_key(doc_id, content_version)).data or 0)
+        if completed_batches < total_batch_size:
+            print(f"Completed batches: {completed_batches} of {total_batch_size}", flush=True)
+            return
+
+        ## a retried batch handler may have counted its batch twice, the blobs tell for sure
+        with track_call("blob", "list_blobs"):
+            blob_count = len(list(container_client.list_blobs(name_starts_with=blob_path)))
+        if blob_count != total_batch_size:
+            print(f"Completed sections: {blob_count} of {total_batch_size}", flush=True)
+            return
+
+    ledger_key = idempotency.ledger_key("complete-document", doc_id, content_version=content_version)
+    with idempotency.once(dapr_client, ledger_key) as claim:
+        if claim != idempotency.CLAIMED:
+            return
+
+        if compact and not rolled_up:
+            ## the document is complete, roll its batches up before document-completed can start the indexer
+            def record_roll_up():
+                dapr_client.save_state(store_name=store_name, key=rolled_up_key(doc_id), value=str(total_batch_size),
+                                       state_metadata={"ttlInSeconds": str(SEAL_TTL_IN_SECONDS)})
+            roll_up(container_client, blob_path, f"{ingestion['searchitems_folder_path']}{doc_id}-part-",
+                    ingestion.get("output_format", "jsonArray"), on_written=record_roll_up)
+
+        print(f"✅✅✅ Document fully processed with document ID: {doc_id}", flush=True)
+        dapr_client.publish_event(
+            pubsub_name=pubsub_name,
+            topic_name=document_completed_topic,
+            data=json.dumps({
+                "ingestion_id": ingestion_id,
+                "doc_id": doc_id
+            })
+        )
+
+    dapr_client.delete_state(store_name=store_name, key=sealed_key(doc_id))
+    dapr_client.delete_state(store_name=store_name, key=completed_batches_key(doc_id, content_version))
+    if compact:
+        dapr_client.delete_state(store_name=store_name, key=rolled_up_key(doc_id))
+
+
+def batch_folder(ingestion, ingestion_id):
+    """
+    Folder the search items of each batch are uploaded to, the indexed folder unless they are
+    rolled up later
+    """
+    if ingestion.get("output_compaction", "off") == "off":
+        return ingestion["searchitems_folder_path"]
+    return f"{SEARCHITEMS_STAGING_FOLDER}{ingestion_id}/"
+
+
+def serialize_batch(ingestion, search_items):
+    if ingestion.get("output_compaction", "off") == "off":
+        return json.dumps(search_items)
+    # staged batches are JSON lines, so the roll-up can split and join them without parsing
+    return "\n".join(json.dumps(item) for item in search_items)
+
+
+def pack_search_items(items, output_format, max_blob_bytes):
+    """
+    Packs serialized search items into blob contents of at most max_blob_bytes, as JSON arrays or
+    JSON lines. An item larger than the limit gets a blob of its own.
+    """
+    separator, start, end = (b"\n", b"", b"\n") if output_format == "jsonLines" else (b",", b"[", b"]")
+    blob_items, blob_size = [], len(start) + len(end)
+    for item in items:
+        if blob_items and blob_size + len(separator) + len(item) > max_blob_bytes:
+            yield start + separator.join(blob_items) + end
+            blob_items, blob_size = [], len(start) + len(end)
+        blob_size += len(item) + (len(separator) if blob_items else 0)
+        blob_items.append(item)
+    if blob_items:
+        yield start + separator.join(blob_items) + end
+
+
+def roll_up(container_client, source_prefix, destination_prefix, output_format, max_blob_bytes=OUTPUT_MAX_BLOB_BYTES, on_written=None):
+    """
+    Combines the batch blobs under source_prefix into blobs of at most max_blob_bytes named
+    destination_prefix + a sequence number, then deletes the batch blobs. on_written is called
+    once the blobs are written, before the batches are deleted. Returns the number of blobs read
+    and written, or None when another replica rolled the batches up first.
+
+    The batches are packed while they are downloaded, so at most one blob to write and the
+    downloads in flight are held in memory, however many batches there are.
+    """
+    with track_call("blob", "list_blobs"):
+        names = sorted(blob.name for blob in container_client.list_blobs(name_starts_with=source_prefix))
+    return roll_up_blobs(container_client, names, destination_prefix, output_format, max_blob_bytes, on_written)
+
+
+def roll_up_in_rounds(container_client, source_prefix, destination_prefix, output_format, round_batches=ROLL_UP_ROUND_BATCHES):
+    """
+    Rolls the batch blobs under source_prefix up round_batches at a time, each round deleting the
+    batches it read. A replica that takes over after a crash rolls up what is left instead of
+    starting over. The blobs of a round are named after its first batch, so a round that is done
+    again overwrites its own blobs. Returns the number of blobs read and written.
+    """
+    with track_call("blob", "list_blobs"):
+        names = sorted(blob.name for blob in container_client.list_blobs(name_starts_with=source_prefix))
+
+    read, written = 0, 0
+    for start in range(0, len(names), round_batches):
+        round_names = names[start:start + round_batches]
+        first_batch = round_names[0][len(source_prefix):].rsplit(".", 1)[0]
+        counts = roll_up_blobs(container_client, round_names, f"{destination_prefix}{first_batch}-", output_format)
+        if counts:
+            read, written = read + counts[0], written + counts[1]
+    return read, written
+
+
+def roll_up_blobs(container_client, names, destination_prefix, output_format, max_blob_bytes=OUTPUT_MAX_BLOB_BYTES, on_written=None):
+    items = (item for batch in download_blobs(container_client, names) for item in batch.split(b"\n") if item)
+    extension = "jsonl" if output_format == "jsonLines" else "json"
+    written = 0
+    try:
+        for written, content in enumerate(pack_search_items(items, output_format, max_blob_bytes), start=1):
+            with track_call("blob", "upload_blob"):
+                container_client.upload_blob(f"{destination_prefix}{written:05d}.{extension}", content, overwrite=True)
+            observe_payload("rolled_up_search_items", len(content))
+    except ResourceNotFoundError:
+        # the other replica writes the same blobs from the same batches
+        print(f"Batches for {destination_prefix} were rolled up by another replica", flush=True)
+        return None
+
+    if on_written:
+        on_written()
+    delete_blobs(container_client, names)
+    print(f"Rolled up {len(names)} batches into {written} blobs under {destination_prefix}", flush=True)
+    return len(names), written
+
+
+def download_blobs(container_client, names):
+    """
+    Yields the contents of the blobs in order, with at most ROLL_UP_DOWNLOAD_WORKERS downloads in
+    flight
+    """
+    def download(name):
+        with track_call("blob", "download_blob"):
+            return container_client.get_blob_client(name).download_blob().readall()
+
+    names = iter(names)
+    with ThreadPoolExecutor(max_workers=ROLL_UP_DOWNLOAD_WORKERS) as executor:
+        downloads = deque(executor.submit(download, name) for _, name in zip(range(ROLL_UP_DOWNLOAD_WORKERS), names))
+        while downloads:
+            content = downloads.popleft().result()
+            for name in names:
+                downloads.append(executor.submit(download, name))
+                break
+            yield content
+
+
+def near_duplicates_folder(ingestion_id):
+    return f"{NEAR_DUPLICATES_FOLDER}{ingestion_id}/"
+
+
+def save_near_duplicates(container_client, ingestion_id, doc_id, duplicates):
+    """
+    Records the near duplicate sections of a document as (section, canonical) pairs, canonical
+    being the {"id", "doc_id", "batch_nr"} of the section whose enrichments it reuses
+    """
+    records = [{"section": section, "canonical": canonical} for section, canonical in duplicates]
+    with track_call("blob", "upload_blob"):
+        container_client.upload_blob(f"{near_duplicates_folder(ingestion_id)}{doc_id}.json", json.dumps(records), overwrite=True)
+
+
+def parse_search_items(content):
+    """
+    Parses a blob of search items written as a JSON array or as JSON lines
+    """
+    if content.lstrip().startswith(b"["):
+        return json.loads(content)
+    return [json.loads(line) for line in content.split(b"\n") if line.strip()]
+
+
+def canonical_blobs(container_client, ingestion, ingestion_id, doc_id, batch_nr):
+    """
+    Names of the blobs the search items of a batch are in once all batches are uploaded
+    """
+    if ingestion.get("output_compaction", "off") == "document":
+        # rolled up with the rest of its document, in a part that isn't known up front
+        with track_call("blob", "list_blobs"):
+            return sorted(blob.name for blob in container_client.list_blobs(
+                name_starts_with=f"{ingestion['searchitems_folder_path']}{doc_id}-part-"))
+    return [f"{batch_folder(ingestion, ingestion_id)}{doc_id}-batch-{batch_nr}.json"]
+
+
+def reuse_enrichments(container_client, ingestion, ingestion_id):
+    """
+    Writes a search item for every recorded near duplicate section, with its own id and source
+    fields and the enrichments of its canonical section. Runs once all batches of the ingestion
+    are uploaded, so every canonical section is enriched, and before the staged batches are
+    rolled up. The records of a document are deleted once its search items are written, so a
+    replica that takes over goes on with the rest. Returns the number of search items written.
+    """
+    with track_call("blob", "list_blobs"):
+        records_names = [blob.name for blob in container_client.list_blobs(name_starts_with=near_duplicates_folder(ingestion_id))]
+
+    written = 0
+    for records_name in records_names:
+        with track_call("blob", "download_blob"):
+            records = json.loads(container_client.get_blob_client(records_name).download_blob().readall())
+        doc_id = records_name[len(near_duplicates_folder(ingestion_id)):-len(".json")]
+
+        # the canonical sections of a document are read per blob, one document's worth at a time
+        wanted = {}
+        for record in records:
+            canonical = record["canonical"]
+            for name in canonical_blobs(container_client, ingestion, ingestion_id, canonical["doc_id"], canonical["batch_nr"]):
+                wanted.setdefault(name, set()).add(canonical["id"])
+        enrichments = {}
+        for name, section_ids in wanted.items():
+            if section_ids <= enrichments.keys():
+                continue
+            try:
+                with track_call("blob", "download_blob"):
+                    content = container_client.get_blob_client(name).download_blob().readall()
+            except ResourceNotFoundError:
+                continue
+            enrichments.update({item["id"]: {field: item.get(field) for field in ENRICHMENT_FIELDS}
+                                for item in parse_search_items(content) if item["id"] in section_ids})
+
+        search_items = []
+        for record in records:
+            canonical_enrichments = enrichments.get(record["canonical"]["id"])
+            if canonical_enrichments is None:
+                # e.g. the canonical batch was dead-lettered, there is nothing to reuse
+                print(f"No search item found for canonical section {record['canonical']['id']} of {record['section']['id']}", flush=True)
+                continue
+            search_items.append(dict(record["section"], **canonical_enrichments))
+
+        if search_items and ingestion.get("output_compaction", "off") == "document":
+            output_format = ingestion.get("output_format", "jsonArray")
+            extension = "jsonl" if output_format == "jsonLines" else "json"
+            items = (json.dumps(item).encode("utf-8") for item in search_items)
+            for part, content in enumerate(pack_search_items(items, output_format, OUTPUT_MAX_BLOB_BYTES), start=1):
+                with track_call("blob", "upload_blob"):
+                    container_client.upload_blob(f"{ingestion['searchitems_folder_path']}{doc_id}-duplicates-{part:05d}.{extension}",
+                                                 content, overwrite=True)
+        elif search_items:
+            # next to the batches, so the "ingestion" roll-up packs them with the rest
+            with track_call("blob", "upload_blob"):
+                container_client.upload_blob(f"{batch_folder(ingestion, ingestion_id)}{doc_id}-duplicates.json",
+                                             serialize_batch(ingestion, search_items), overwrite=True)
+        written += len(search_items)
+        delete_blobs(container_client, [records_name])
+
+    if written:
+        print(f"Wrote {written} near duplicate search items with the enrichments of their canonical sections", flush=True)
+    return written
+
+
+def delete_blobs(container_client, names):
+    """
+    Deletes blobs with batch requests of up to 256 blobs, blobs that are already gone are skipped
+    """
+    for i in range(0, len(names), BLOB_BATCH_SIZE):
+        with track_call("blob", "delete_blobs"):
+            container_client.delete_blobs(*names[i:i + BLOB_BATCH_SIZE], raise_on_any_failure=False)
@@ -0,0 +1,26 @@
+import os
+import threading
+import time
+
+secret_store = "secretstore"
+
+# The secrets are read once per TTL instead of on every call, rotated secrets are picked up after it
+SECRET_CACHE_TTL_IN_SECONDS = int(os.getenv("SECRET_CACHE_TTL_IN_SECONDS", "300"))
+
+_cache = {"secrets": None, "loaded_at": 0.0}
+_lock = threading.Lock()
+
+
+def get_secrets(dapr_client):
+    """
+    All secrets of the pipeline's secret store, from the cache while it is fresh
+    """
+    with _lock:
+        if _cache["secrets"] is None or time.monotonic() - _cache["loaded_at"] > SECRET_CACHE_TTL_IN_SECONDS:
+            _cache["secrets"] = dict(dapr_client.get_secret(store_name=secret_store, key="secretstore").secret)
+            _cache["loaded_at"] = time.monotonic()
+        return _cache["secrets"]
+
+
+def get_secret(dapr_client, name):
+    return get_secrets(dapr_client)[name]
@@ -0,0 +1,91 @@
+import importlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from common.secrets import get_secrets
+from common.telemetry import observe_startup
+
+# A replica only handles events once the warm-up imported the SDKs, connected to the sidecar and
+# created its clients, so replicas added during a burst don't take events while they are cold.
+# The app opens its port right away, /healthz answers from the start and /readyz once warm.
+READY_TIMEOUT_IN_SECONDS = int(os.getenv("READY_TIMEOUT_IN_SECONDS", "60"))
+WARM_UP_RETRY_SECONDS = 5
+
+ready = threading.Event()
+_first_event = threading.Event()
+
+
+def start_up(app, dapr_client, modules=(), clients=(), health_checks=()):
+    """
+    Adds /healthz and /readyz to the app and warms the replica up in the background: the SDK
+    modules are imported while the Dapr client waits for the sidecar and loads the secrets, then
+    the clients are created. Every step is retried until it succeeds. A health check returns why
+    the replica can't handle events anymore, or None. Both endpoints fail once one does, so the
+    replica stops taking events and Kubernetes restarts it.
+    """
+    def failed_check():
+        return next((problem for problem in (check() for check in health_checks) if problem), None)
+
+    @app.route("/healthz", methods=["GET"])
+    def healthz():
+        problem = failed_check()
+        if problem:
+            return json.dumps({"status": "unhealthy", "error": problem}), 503, {"ContentType": "application/json"}
+        return json.dumps({"status": "ok"}), 200, {"ContentType": "application/json"}
+
+    @app.route("/readyz", methods=["GET"])
+    def readyz():
+        problem = failed_check()
+        if problem:
+            return json.dumps({"status": "unhealthy", "error": problem}), 503, {"ContentType": "application/json"}
+        if ready.is_set():
+            return json.dumps({"status": "ready"}), 200, {"ContentType": "application/json"}
+        return json.dumps({"status": "warming-up"}), 503, {"ContentType": "application/json"}
+
+    def connect():
+        dapr_client.connect()
+        get_secrets(dapr_client)
+
+    imports = [partial(importlib.import_module, module) for module in modules]
+    threading.Thread(target=warm_up, args=([connect] + imports, list(clients)), name="warm-up", daemon=True).start()
+
+
+def warm_up(connections, clients):
+    for steps in (connections, clients):
+        if steps:
+            with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+                list(executor.map(run_until_done, steps))
+
+    ready.set()
+    print(f"🚀 Ready to handle events {observe_startup('ready'):.2f}s after start", flush=True)
+
+
+def run_until_done(step):
+    while True:
+        try:
+            return step()
+        except Exception as e:
+            print(f"Warm-up step {getattr(step, '__name__', step)} failed, retrying: {e}", flush=True)
+            time.sleep(WARM_UP_RETRY_SECONDS)
+
+
+def when_ready(handler):
+    """
+    Decorator for event handlers: an event that arrives during the warm-up waits for it, or is
+    handed back to Dapr to retry. Records the time to the first event handled.
+    """
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        if not ready.wait(READY_TIMEOUT_IN_SECONDS):
+            return json.dumps({"success": False, "status": "RETRY"}), 200, {"ContentType": "application/json"}
+
+        response = handler(*args, **kwargs)
+        if not _first_event.is_set():
+            _first_event.set()
+            print(f"🚀 Handled first event {observe_startup('first_event'):.2f}s after start", flush=True)
+        return response
+    return wrapper
@@ -0,0 +1,79 @@
+import json
+
+from dapr.clients.exceptions import DaprGrpcError, DaprInternalError
+from dapr.clients.grpc._state import Concurrency, StateOptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from common.telemetry import count_retry
+
+# Errors raised by the Dapr client when an etag no longer matches
+STATE_CONFLICT_ERRORS = (DaprInternalError, DaprGrpcError)
+
+
+def save_state_if_unchanged(dapr_client, store_name, key, value, etag, state_metadata=None):
+    """
+    Saves the value only when the key still has the given etag. Without an etag the
+    save only succeeds when the key doesn't exist yet.
+    """
+    if etag:
+        dapr_client.save_state(store_name=store_name, key=key, value=value, etag=etag,
+                               state_metadata=state_metadata or {})
+    else:
+        dapr_client.save_state(store_name=store_name, key=key, value=value,
+                               options=StateOptions(concurrency=Concurrency.first_write),
+                               state_metadata=state_metadata or {})
+
+
+@retry(stop=stop_after_attempt(10), wait=wait_random_exponential(multiplier=0.05, max=2),
+       retry=retry_if_exception_type(STATE_CONFLICT_ERRORS), before_sleep=count_retry("statestore"))
+def update_counter(dapr_client, store_name, key, delta, limit=None, ttl_in_seconds=None):
+    """
+    Adds delta to a counter in the state store using optimistic concurrency. Returns the new value,
+    or None when the counter would go over the limit, in which case it is left unchanged.
+    """
+    item = dapr_client.get_state(store_name=store_name, key=key)
+    value = int(item.data or 0)
+    if limit is not None and delta > 0 and value + delta > limit:
+        return None
+
+    new_value = max(value + delta, 0)
+    state_metadata = {"ttlInSeconds": str(ttl_in_seconds)} if ttl_in_seconds else None
+    save_state_if_unchanged(dapr_client, store_name, key, str(new_value), item.etag, state_metadata)
+    return new_value
+
+
+@retry(stop=stop_after_attempt(10), wait=wait_random_exponential(multiplier=0.05, max=2),
+       retry=retry_if_exception_type(STATE_CONFLICT_ERRORS), before_sleep=count_retry("statestore"))
+def increment_fields(dapr_client, store_name, key, increments, ttl_in_seconds=None):
+    """
+    Adds the increments to the numeric fields of a JSON object in the state store using optimistic
+    concurrency. Returns the updated object.
+    """
+    item = dapr_client.get_state(store_name=store_name, key=key)
+    value = json.loads(item.data) if item.data else {}
+    for field, increment in increments.items():
+        value[field] = value.get(field, 0) + increment
+
+    state_metadata = {"ttlInSeconds": str(ttl_in_seconds)} if ttl_in_seconds else None
+    save_state_if_unchanged(dapr_client, store_name, key, json.dumps(value), item.etag, state_metadata)
+    return value
+
+
+@retry(stop=stop_after_attempt(10), wait=wait_random_exponential(multiplier=0.05, max=2),
+       retry=retry_if_exception_type(STATE_CONFLICT_ERRORS), before_sleep=count_retry("statestore"))
+def update_fields(dapr_client, store_name, key, updates=None, removals=(), ttl_in_seconds=None):
+    """
+    Sets and removes fields of a JSON object in the state store using optimistic concurrency.
+    Returns the updated object.
+    """
+    item = dapr_client.get_state(store_name=store_name, key=key)
+    value = json.loads(item.data) if item.data else {}
+    updated = dict(value, **(updates or {}))
+    for field in removals:
+        updated.pop(field, None)
+    if item.data and updated == value:
+        return value
+
+    state_metadata = {"ttlInSeconds": str(ttl_in_seconds)} if ttl_in_seconds else None
+    save_state_if_unchanged(dapr_client, store_name, key, json.dumps(updated), item.etag, state_metadata)
+    return updated
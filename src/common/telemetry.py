@@ -0,0 +1,255 @@
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+import grpc
+from dapr.clients import DaprClient
+from flask import Response, has_request_context, request
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Name of the pipeline stage this process runs, set by instrument_app()
+STAGE = "unknown"
+
+# W3C trace context headers that Dapr passes to the app and expects back on outgoing calls
+TRACE_HEADERS = ("traceparent", "tracestate")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456)
+
+# Dapr gRPC methods mapped to the dependency they talk to
+DAPR_DEPENDENCIES = {
+    "GetState": "statestore",
+    "GetBulkState": "statestore",
+    "SaveState": "statestore",
+    "DeleteState": "statestore",
+    "ExecuteStateTransaction": "statestore",
+    "PublishEvent": "pubsub",
+    "GetSecret": "secretstore",
+    "GetBulkSecret": "secretstore",
+}
+
+handler_latency = Histogram(
+    "pipeline_handler_duration_seconds",
+    "Time spent handling a pub/sub event or HTTP trigger",
+    ["stage", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+external_call_latency = Histogram(
+    "pipeline_external_call_duration_seconds",
+    "Latency of calls to external services (Form Recognizer, OpenAI, Language, Blob, Dapr building blocks)",
+    ["stage", "dependency", "operation", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+retry_count = Counter(
+    "pipeline_retries_total",
+    "Number of retried calls to external services",
+    ["stage", "dependency"],
+)
+near_duplicates_removed = Counter(
+    "pipeline_near_duplicates_removed_total",
+    "Near duplicate sections removed before enrichment, as index documents and enrichment calls saved",
+    ["stage", "kind"],
+)
+redeliveries_skipped = Counter(
+    "pipeline_redeliveries_skipped_total",
+    "Redelivered events not processed again, because the work was done or is leased by another replica",
+    ["stage", "outcome"],
+)
+payload_size = Histogram(
+    "pipeline_payload_bytes",
+    "Size of payloads received, stored and published",
+    ["stage", "payload"],
+    buckets=SIZE_BUCKETS,
+)
+startup_seconds = Gauge(
+    "pipeline_startup_seconds",
+    "Seconds from the start of the process until it was ready to handle events and until it handled its first event",
+    ["stage", "phase"],
+)
+queue_lag = Histogram(
+    "pipeline_queue_lag_seconds",
+    "Time between an event being published and its handler starting",
+    ["stage", "topic"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def instrument_app(app, stage):
+    """
+    Label all metrics of this process with the given stage and expose them on /metrics
+    """
+    global STAGE
+    STAGE = stage
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def trace_headers():
+    if not has_request_context():
+        return {}
+    return {header: request.headers[header] for header in TRACE_HEADERS if header in request.headers}
+
+
+class _ClientCallDetails(
+        namedtuple("_ClientCallDetails", ("method", "timeout", "metadata", "credentials", "wait_for_ready", "compression")),
+        grpc.ClientCallDetails):
+    pass
+
+
+class DaprCallInterceptor(grpc.UnaryUnaryClientInterceptor):
+    """
+    Times every call to the Dapr sidecar and forwards the trace context of the current request,
+    so events published while handling an event continue the same trace
+    """
+    def intercept_unary_unary(self, continuation, client_call_details, request_message):
+        method = client_call_details.method.rsplit("/", 1)[-1]
+        metadata = list(client_call_details.metadata or []) + list(trace_headers().items())
+        details = _ClientCallDetails(
+            client_call_details.method,
+            client_call_details.timeout,
+            metadata,
+            client_call_details.credentials,
+            getattr(client_call_details, "wait_for_ready", None),
+            getattr(client_call_details, "compression", None),
+        )
+
+        if method in ("SaveState", "PublishEvent", "ExecuteStateTransaction"):
+            payload_size.labels(STAGE, method).observe(request_message.ByteSize())
+
+        started = time.perf_counter()
+        response = continuation(details, request_message)
+        status = "error" if response.exception() else "ok"
+        external_call_latency.labels(STAGE, DAPR_DEPENDENCIES.get(method, "dapr"), method, status).observe(time.perf_counter() - started)
+
+        if method == "GetState" and status == "ok":
+            payload_size.labels(STAGE, method).observe(response.result().ByteSize())
+        return response
+
+
+class LazyDaprClient:
+    """
+    DaprClient that connects on first use. Creating a DaprClient waits for the sidecar, which at
+    import time would keep the app from opening its port and answering health probes until then.
+    """
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._client = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = DaprClient(**self._kwargs)
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.connect(), name)
+
+
+def create_dapr_client():
+    return LazyDaprClient(interceptors=[DaprCallInterceptor()])
+
+
+@contextmanager
+def track_call(dependency, operation):
+    started = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        external_call_latency.labels(STAGE, dependency, operation, status).observe(time.perf_counter() - started)
+
+
+def count_retry(dependency):
+    """
+    Returns a tenacity before_sleep callback that counts retries for the given dependency
+    """
+    def before_sleep(retry_state):
+        retry_count.labels(STAGE, dependency).inc()
+    return before_sleep
+
+
+def count_near_duplicates(index_documents, enrichment_calls):
+    near_duplicates_removed.labels(STAGE, "index_documents").inc(index_documents)
+    near_duplicates_removed.labels(STAGE, "enrichment_calls").inc(enrichment_calls)
+
+
+def count_redelivery_skipped(outcome):
+    redeliveries_skipped.labels(STAGE, outcome).inc()
+
+
+def process_started_at():
+    """
+    Start time of this process, so startup times include the interpreter and the imports
+    """
+    try:
+        with open("/proc/self/stat") as stat:
+            start_ticks = int(stat.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as stat:
+            boot_time = next(int(line.split()[1]) for line in stat if line.startswith("btime"))
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+PROCESS_STARTED_AT = process_started_at()
+
+
+def observe_startup(phase):
+    """
+    Records the seconds since the process started for a startup phase and returns them
+    """
+    elapsed = time.time() - PROCESS_STARTED_AT
+    startup_seconds.labels(STAGE, phase).set(elapsed)
+    return elapsed
+
+
+def observe_payload(payload, size):
+    payload_size.labels(STAGE, payload).observe(size)
+
+
+def _observe_queue_lag():
+    # Dapr wraps published data in a CloudEvent carrying the topic and the publish time
+    envelope = request.get_json(silent=True)
+    if not isinstance(envelope, dict) or not envelope.get("time"):
+        return
+    try:
+        published_at = datetime.fromisoformat(envelope["time"].replace("Z", "+00:00"))
+    except ValueError:
+        return
+    lag = time.time() - published_at.timestamp()
+    queue_lag.labels(STAGE, envelope.get("topic", "")).observe(max(lag, 0))
+
+
+def _status_code(response):
+    if isinstance(response, tuple) and len(response) > 1:
+        return response[1]
+    return getattr(response, "status_code", 200)
+
+
+def observe_handler(handler):
+    """
+    Decorator for Flask routes that records handler latency, request size and queue lag
+    """
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        observe_payload("event", request.content_length or 0)
+        _observe_queue_lag()
+
+        status = 500
+        try:
+            response = handler(*args, **kwargs)
+            status = _status_code(response)
+            return response
+        finally:
+            handler_latency.labels(STAGE, request.path.strip("/"), str(status)).observe(time.perf_counter() - started)
+    return wrapper
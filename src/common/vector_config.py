@@ -0,0 +1,120 @@
+from common.secrets import get_secrets
+
+# Vector settings of the search index of an ingestion. The embedding stages shape the vectors to
+# match (dimensions, element type), document-completed creates the index from them.
+ELEMENT_TYPES = ("Single", "Half", "SByte")
+METRICS = ("cosine", "dotProduct", "euclidean")
+
+DEFAULT_VECTOR_CONFIG = {
+    "dimensions": 1536,
+    "element_type": "Single",
+    "metric": "cosine",
+    "m": 4,
+    "ef_construction": 400,
+    "ef_search": 500,
+    "scalar_quantization": False,
+    "stored": True,
+}
+
+# Limits of Azure AI Search
+INTEGER_RANGES = {
+    "dimensions": (2, 4096),
+    "m": (4, 10),
+    "ef_construction": (100, 1000),
+    "ef_search": (100, 1000),
+}
+
+
+# Embedding model of the OpenAI deployment, from the OPENAI_EMBEDDING_MODEL secret. Models trained
+# for shorter embeddings (Matryoshka representation learning) return fewer dimensions when the
+# embeddings API is asked for them, the others always return their full size.
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+MODEL_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+SHORTENABLE_MODELS = ("text-embedding-3-small", "text-embedding-3-large")
+
+
+def embedding_model(dapr_client):
+    return get_secrets(dapr_client).get("OPENAI_EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL)
+
+
+def parse_vector_config(value, model=DEFAULT_EMBEDDING_MODEL):
+    """
+    Validates vector settings given for an ingestion and completes them with the defaults.
+    Raises a ValueError when they are invalid or when the embedding model can't produce vectors
+    of the dimensions.
+    """
+    if value is None:
+        return dict(DEFAULT_VECTOR_CONFIG)
+    if not isinstance(value, dict):
+        raise ValueError("vector_config must be an object")
+
+    unknown = set(value) - set(DEFAULT_VECTOR_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown vector_config settings: {', '.join(sorted(unknown))}")
+
+    config = dict(DEFAULT_VECTOR_CONFIG, **value)
+    for name, (low, high) in INTEGER_RANGES.items():
+        if not isinstance(config[name], int) or isinstance(config[name], bool) or not low <= config[name] <= high:
+            raise ValueError(f"vector_config.{name} must be an integer from {low} to {high}")
+    if config["element_type"] not in ELEMENT_TYPES:
+        raise ValueError(f"vector_config.element_type must be one of: {', '.join(ELEMENT_TYPES)}")
+    if config["metric"] not in METRICS:
+        raise ValueError(f"vector_config.metric must be one of: {', '.join(METRICS)}")
+    for name in ("scalar_quantization", "stored"):
+        if not isinstance(config[name], bool):
+            raise ValueError(f"vector_config.{name} must be true or false")
+
+    if config["element_type"] == "SByte":
+        if config["scalar_quantization"]:
+            raise ValueError("vector_config.scalar_quantization only applies to Single and Half vectors")
+        if config["metric"] != "cosine":
+            # every vector is scaled to the int8 range on its own, which only preserves angles
+            raise ValueError("SByte vectors require the cosine metric")
+
+    model_dimensions = MODEL_DIMENSIONS.get(model)
+    if model_dimensions and model in SHORTENABLE_MODELS and config["dimensions"] > model_dimensions:
+        raise ValueError(f"vector_config.dimensions can be at most {model_dimensions} for {model}")
+    if model_dimensions and model not in SHORTENABLE_MODELS and config["dimensions"] != model_dimensions:
+        # cutting the embeddings of other models short would lose most of their meaning
+        raise ValueError(f"vector_config.dimensions must be {model_dimensions} for {model}, "
+                         f"only {' and '.join(SHORTENABLE_MODELS)} produce shorter embeddings")
+
+    return config
+
+
+def event_vector_config(data):
+    return data.get("vector_config") or DEFAULT_VECTOR_CONFIG
+
+
+def request_dimensions(vector_config, model):
+    """
+    Dimensions to ask the embeddings API for, None for models that only return their full size
+    """
+    return vector_config["dimensions"] if model in SHORTENABLE_MODELS else None
+
+
+def shape_embedding(embedding, vector_config):
+    """
+    Converts an embedding to the element type of the index. The embedding API already returns it
+    with the dimensions of the index, see request_dimensions.
+    """
+    dimensions = vector_config["dimensions"]
+    if len(embedding) != dimensions:
+        raise ValueError(f"Embedding has {len(embedding)} dimensions, the index expects {dimensions}")
+
+    element_type = vector_config["element_type"]
+    if element_type == "Half":
+        # half precision keeps about 3 significant digits, more only makes the search items bigger
+        return [float(f"{value:.4g}") for value in embedding]
+    if element_type == "SByte":
+        scale = 127 / (max(abs(value) for value in embedding) or 1.0)
+        return [round(value * scale) for value in embedding]
+    return embedding
+
+
+def shape_embeddings(embeddings, vector_config):
+    return [shape_embedding(embedding, vector_config) for embedding in embeddings]
@@ -1,16 +1,21 @@
 import time
 import json
 import os
-from azure_search_index import AzureSearchIndex
 from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type, before_sleep_log
 from flask import Flask, request, jsonify
-from azure.storage.blob import BlobServiceClient
 from cloudevents.http import from_http
-from dapr.clients import DaprClient, DaprInternalError
+from dapr.clients import DaprInternalError
+from common import backlog, idempotency
+from common.blob_storage import get_container_client
+from common.secrets import get_secret
+from common.search_items import SEARCHITEMS_STAGING_FOLDER, delete_blobs, near_duplicates_folder, reuse_enrichments, roll_up_in_rounds
+from common.startup import start_up, when_ready
+from common.telemetry import count_retry, create_dapr_client, instrument_app, observe_handler, track_call
 
 
-dapr_client = DaprClient()
+dapr_client = create_dapr_client()
 app = Flask(__name__)
+instrument_app(app, "document-completed")
 app_port = os.getenv("APP_PORT", "6006")
 
 source_topic = "document-completed"
@@ -18,42 +23,49 @@ pubsub_name = "pubsub"
 store_name = "statestore"
 secret_store = "secretstore"
 
+def warm_up_clients():
+    get_container_client(dapr_client)
+
 # update state with transactions/etag to avoid conflicts
 @retry(stop=stop_after_attempt(3), wait=wait_random_exponential(multiplier=1, max=10),
-            retry=retry_if_exception_type(DaprInternalError))
+            retry=retry_if_exception_type(DaprInternalError), before_sleep=count_retry("statestore"))
 def save_state_with_retry(state_key, ingestion_data, etag):
     dapr_client.save_state(store_name=store_name, key=state_key, value=json.dumps(ingestion_data), etag=etag)
 
 
 def delete_blobs_with_prefix(container_client, prefix):
-    blob_list = container_client.list_blobs(name_starts_with=prefix)
-    blob_count = 0
-    for blob in blob_list:
-        try:
-            blob_count += 1
-            container_client.delete_blob(blob.name)
-        except Exception as e:
-            print(f"Error deleting blob {blob.name}: {e}")
-    
-    print(f"🗑️ Deleted {blob_count} blobs with prefix {prefix}", flush=True)
+    names = [blob.name for blob in container_client.list_blobs(name_starts_with=prefix)]
+    try:
+        delete_blobs(container_client, names)
+    except Exception as e:
+        print(f"Error deleting blobs with prefix {prefix}: {e}")
 
+    print(f"🗑️ Deleted {len(names)} blobs with prefix {prefix}", flush=True)
 
-def cleanup_blob(status, azure_blob_connection_string, blob_container_name, searchitems_folder_path):
+
+def cleanup_blob(status, container_client, prefixes):
     print("Indexing completed with status:", status.last_result.status)
 
-    blob_service_client = BlobServiceClient.from_connection_string(azure_blob_connection_string)
-    container_client = blob_service_client.get_container_client(blob_container_name)
-    
     print("Indexer completed. Deleting all blobs now..", flush=True)
-    delete_blobs_with_prefix(container_client, searchitems_folder_path)
+    with track_call("blob", "delete_blobs"):
+        for prefix in prefixes:
+            delete_blobs_with_prefix(container_client, prefix)
 
     print("🏁🏁🏁Successfully indexed and cleaned up.", flush=True)
 
-def start_indexer(searchitems_folder_path, searchindexer_name):
-    blob_connection_string = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["AZURE_BLOB_CONNECTION_STRING"]
-    blob_container_name = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["BLOB_CONTAINER_NAME"]
-    search_service = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["SEARCH_SERVICE"]
-    search_key = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["SEARCH_KEY"]
+def start_indexer(ingestion_id, ingestion_data):
+    searchitems_folder_path = ingestion_data['searchitems_folder_path']
+    searchindexer_name = ingestion_data['searchindexer_name']
+    output_compaction = ingestion_data.get('output_compaction', 'off')
+    output_format = ingestion_data.get('output_format', 'jsonArray')
+
+    # imported by the warm-up, the Search SDK is only needed at the end of an ingestion
+    from azure_search_index import AzureSearchIndex
+
+    blob_connection_string = get_secret(dapr_client, "AZURE_BLOB_CONNECTION_STRING")
+    blob_container_name = get_secret(dapr_client, "BLOB_CONTAINER_NAME")
+    search_service = get_secret(dapr_client, "SEARCH_SERVICE")
+    search_key = get_secret(dapr_client, "SEARCH_KEY")
 
     # Create an instance of AzureSearchIndex
     azure_search_index = AzureSearchIndex(
@@ -64,15 +76,37 @@ def start_indexer(searchitems_folder_path, searchindexer_name):
         blob_items_folder = searchitems_folder_path
     )
 
+    container_client = get_container_client(dapr_client)
+    staging_folder = f"{SEARCHITEMS_STAGING_FOLDER}{ingestion_id}/"
+
+    # all batches are uploaded, near duplicate sections get the enrichments of their canonical section
+    reuse_enrichments(container_client, ingestion_data, ingestion_id)
+
+    if output_compaction == 'ingestion':
+        # the indexer reads a few large shards instead of a blob per batch
+        roll_up_in_rounds(container_client, staging_folder, f"{searchitems_folder_path}shard-{ingestion_id}-", output_format)
+
     # Call the methods to create the datasource, index, and indexer
     azure_search_index.create_datasource(f"{searchindexer_name}-ds")
-    azure_search_index.create_index(f"{searchindexer_name}-index")
-    azure_search_index.create_indexer(searchindexer_name, f"{searchindexer_name}-ds", f"{searchindexer_name}-index")
+    azure_search_index.create_index(f"{searchindexer_name}-index", ingestion_data.get('vector_config'))
+    azure_search_index.create_indexer(searchindexer_name, f"{searchindexer_name}-ds", f"{searchindexer_name}-index", output_format)
 
     def cleanup_blob_wrapper(status):
-        cleanup_blob(status, blob_connection_string, blob_container_name, searchitems_folder_path)
-
-    azure_search_index.run_indexer(searchindexer_name, cleanup_blob_wrapper)
+        # batches staged for a roll-up that never completed are removed as well
+        prefixes = [searchitems_folder_path, near_duplicates_folder(ingestion_id)]
+        if output_compaction != 'off':
+            prefixes.append(staging_folder)
+        cleanup_blob(status, container_client, prefixes)
+
+    with track_call("search", "run_indexer"):
+        azure_search_index.run_indexer(searchindexer_name, cleanup_blob_wrapper)
+
+def print_near_duplicate_report(ingestion_id):
+    report = dapr_client.get_state(store_name=store_name, key=f"near-duplicates-{ingestion_id}").data
+    if report:
+        stats = json.loads(report)
+        print(f"♻️ Near duplicate sections: {stats['duplicates']} of {stats['sections']}, "
+              f"saving {stats['enrichment_calls_removed']} enrichment calls and {stats['index_documents_removed']} index documents", flush=True)
 
 # This route subscribes to the pub/sub topic
 @app.route("/dapr/subscribe", methods=["GET"])
@@ -85,6 +119,8 @@ def subscribe():
 
 # This route is triggered when a service publishes a message to the topic
 @app.route("/document-completed", methods=["POST"])
+@observe_handler
+@when_ready
 def document_completed_subscriber():
     event = from_http(request.headers, request.get_data())
     data = json.loads(event.data)
@@ -117,11 +153,19 @@ def document_completed_subscriber():
     # if document size is 0, then we are done
     if document_size == 0:
         print(f"🏁Fully processed document: {doc_id}, total remaining documents {document_size}", flush=True)
-        # start indexer
-        start_indexer(
-            ingestion_data['searchitems_folder_path'], 
-            ingestion_data['searchindexer_name']
-        )
+        # no more batches will be published for this ingestion
+        dapr_client.delete_state(store_name=store_name, key=f"inflight-batches-{ingestion_id}")
+        backlog.finish_ingestion(dapr_client, ingestion_id)
+        print_near_duplicate_report(ingestion_id)
+
+        # the roll-up and the indexer run take longer than the lock of the event, they run on a
+        # thread of their own under a renewed lease and the event is retried until they are done
+        ledger_key = idempotency.ledger_key("start-indexer", ingestion_id)
+        try:
+            return idempotency.run_detached(dapr_client, ledger_key, lambda: start_indexer(ingestion_id, ingestion_data))
+        except Exception as e:
+            print(f"An error occurred while indexing: {str(e)}", flush=True)
+            return json.dumps({"success": False, "error": str(e)}), 500, {"ContentType": "application/json"}
 
     else :
         print(f"Total remaining documents {document_size}", flush=True)
@@ -129,4 +173,5 @@ def document_completed_subscriber():
     return json.dumps({"success": True}), 200, {"ContentType": "application/json"}
 
 
+start_up(app, dapr_client, modules=("azure.storage.blob", "azure_search_index"), clients=(warm_up_clients,))
 app.run(port=app_port)
\ No newline at end of file
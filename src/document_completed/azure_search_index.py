@@ -3,10 +3,73 @@ from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.indexes import SearchIndexClient, SearchIndexerClient
 from azure.core.exceptions import ResourceNotFoundError
 from azure.search.documents.indexes.models import (
-    SearchIndex, SearchIndexer, HnswParameters, SearchField, SearchFieldDataType,
-    SearchIndexerDataSourceConnection, SearchIndexerDataContainer, VectorSearch,
-    VectorSearchAlgorithmConfiguration
+    SearchIndex, SearchIndexer, HnswAlgorithmConfiguration, HnswParameters, ScalarQuantizationCompression,
+    SearchField, SearchFieldDataType, SearchIndexerDataSourceConnection, SearchIndexerDataContainer,
+    VectorSearch, VectorSearchProfile
 )
+from common.vector_config import DEFAULT_VECTOR_CONFIG
+
+VECTOR_PROFILE_NAME = "default"
+VECTOR_ALGORITHM_NAME = "default-hnsw"
+VECTOR_COMPRESSION_NAME = "default-scalar-quantization"
+
+def create_index_definition(index_name, vector_config):
+    """
+    Index of the search items, with the embeddings field and vector search set up from the
+    vector settings of the ingestion
+    """
+    compressions = []
+    if vector_config["scalar_quantization"]:
+        # int8 copy of the vectors for the graph, the original vectors rerank the results
+        compressions.append(ScalarQuantizationCompression(compression_name=VECTOR_COMPRESSION_NAME, rerank_with_original_vectors=True))
+
+    return SearchIndex(
+        name=index_name,
+        fields=[
+            SearchField(name="id", type=SearchFieldDataType.String, key=True),
+            SearchField(name="content", type=SearchFieldDataType.String, filterable=True, sortable=True),
+            SearchField(name="category", type=SearchFieldDataType.String, filterable=True, sortable=True, facetable=True),
+            SearchField(name="sourcepage", type=SearchFieldDataType.String, filterable=True, facetable=True),
+            SearchField(name="sourcefile", type=SearchFieldDataType.String, filterable=True, facetable=True),
+            SearchField(name="summaries", type=SearchFieldDataType.String, filterable=True),
+            SearchField(name="keyphrases", type=SearchFieldDataType.Collection(SearchFieldDataType.String)),
+            SearchField(
+                name="embeddings",
+                # the SDK has no constant for Edm.Half
+                type=SearchFieldDataType.Collection(f"Edm.{vector_config['element_type']}"),
+                # vectors that are not stored can't be retrieved either
+                hidden=not vector_config["stored"],
+                stored=vector_config["stored"],
+                searchable=True,
+                filterable=False,
+                sortable=False,
+                facetable=False,
+                vector_search_dimensions=vector_config["dimensions"],
+                vector_search_profile_name=VECTOR_PROFILE_NAME,
+            )
+        ],
+        vector_search=VectorSearch(
+            profiles=[
+                VectorSearchProfile(
+                    name=VECTOR_PROFILE_NAME,
+                    algorithm_configuration_name=VECTOR_ALGORITHM_NAME,
+                    compression_name=VECTOR_COMPRESSION_NAME if compressions else None
+                )
+            ],
+            algorithms=[
+                HnswAlgorithmConfiguration(
+                    name=VECTOR_ALGORITHM_NAME,
+                    parameters=HnswParameters(
+                        m=vector_config["m"],
+                        ef_construction=vector_config["ef_construction"],
+                        ef_search=vector_config["ef_search"],
+                        metric=vector_config["metric"]
+                    )
+                )
+            ],
+            compressions=compressions
+        )
+    )
 
 class AzureSearchIndex:
     def __init__(self, service_name, search_key, blob_connection_string, blob_container, blob_items_folder):
@@ -16,12 +79,14 @@ class AzureSearchIndex:
         self.blob_container = blob_container
         self.blob_items_folder = blob_items_folder
         self.creds = AzureKeyCredential(self.search_key)
+        # service_name may also be a full endpoint, e.g. to point at a local stand-in
+        self.endpoint = service_name if service_name.startswith("http") else f"https://{self.service_name}.search.windows.net/"
         self.search_index_client = SearchIndexClient(
-            endpoint=f"https://{self.service_name}.search.windows.net/",
+            endpoint=self.endpoint,
             credential=self.creds
         )
         self.search_indexer_client = SearchIndexerClient(
-            endpoint=f"https://{self.service_name}.search.windows.net/",
+            endpoint=self.endpoint,
             credential=self.creds
         )
 
@@ -41,51 +106,20 @@ class AzureSearchIndex:
             self.search_indexer_client.create_or_update_data_source_connection(data_source_connection=data_source)
             print(f"Datasource '{data_source_name}' created.", flush=True)
 
-    def create_index(self, index_name):
+    def create_index(self, index_name, vector_config=None):
         try:
             # Try to get the index to check if it already exists
             self.search_index_client.get_index(index_name)
             print(f"Index '{index_name}' already exists.", flush=True)
         except ResourceNotFoundError:
             # If not found, define and create the index
-            index_definition = SearchIndex(
-                name=index_name,
-                fields=[
-                    SearchField(name="id", type=SearchFieldDataType.String, key=True),
-                    SearchField(name="content", type=SearchFieldDataType.String, filterable=True, sortable=True),
-                    SearchField(name="category", type=SearchFieldDataType.String, filterable=True, sortable=True, facetable=True),
-                    SearchField(name="sourcepage", type=SearchFieldDataType.String, filterable=True, facetable=True),
-                    SearchField(name="sourcefile", type=SearchFieldDataType.String, filterable=True, facetable=True),
-                    SearchField(name="summaries", type=SearchFieldDataType.String, filterable=True),
-                    SearchField(name="keyphrases", type=SearchFieldDataType.Collection(SearchFieldDataType.String)),
-                    SearchField(
-                        name="embeddings",
-                        type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-                        hidden=False,
-                        searchable=True,
-                        filterable=False,
-                        sortable=False,
-                        facetable=False,
-                        vector_search_dimensions=1536,
-                        vector_search_configuration="default",
-                    )
-                ],
-                vector_search=VectorSearch(
-                    algorithm_configurations=[
-                        VectorSearchAlgorithmConfiguration(
-                            name="default",
-                            kind="hnsw",
-                            hnsw_parameters=HnswParameters(metric="cosine")
-                        )
-                    ]
-                )
-            )
+            index_definition = create_index_definition(index_name, vector_config or DEFAULT_VECTOR_CONFIG)
 
             # Create the index
             self.search_index_client.create_index(index=index_definition)
             print(f"Index '{index_name}' created.", flush=True)
 
-    def create_indexer(self, indexer_name, data_source_name, index_name):
+    def create_indexer(self, indexer_name, data_source_name, index_name, parsing_mode="jsonArray"):
         try:
             # Try to get the indexer to check if it already exists
             self.search_indexer_client.get_indexer(indexer_name)
@@ -98,7 +132,7 @@ class AzureSearchIndex:
                 target_index_name=index_name,
                 field_mappings=[],
                 output_field_mappings=[],
-                parameters={"configuration": {"parsingMode": "jsonArray"}}
+                parameters={"configuration": {"parsingMode": parsing_mode}}
             )
             # Create or update the indexer
             self.search_indexer_client.create_or_update_indexer(indexer=indexer)
@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify
+from cloudevents.http import from_http
+import json
+import os
+from common import backlog, idempotency
+from common.blob_storage import get_container_client
+from common.language import compute_keyphrases, compute_summaries, create_language_client
+from common.lanes import lane_subscriptions
+from common.openai_embeddings import compute_embedding_in_batch, load_openai
+from common.search_items import complete_batch, merge_enrichments
+from common.startup import start_up, when_ready
+from common.telemetry import create_dapr_client, instrument_app, observe_handler
+from common.vector_config import embedding_model, event_vector_config, request_dimensions, shape_embeddings
+
+dapr_client = create_dapr_client()
+app = Flask(__name__)
+instrument_app(app, "enrich-batch")
+app_port = os.getenv("APP_PORT", "6007")
+
+source_topic = "enrich-batch"
+pubsub_name = "pubsub"
+store_name = "statestore"
+secret_store = "secretstore"
+
+# Every batch runs its three enrichments in parallel, so the pool is shared by all handlers
+MAX_ENRICHMENT_WORKERS = int(os.getenv("MAX_ENRICHMENT_WORKERS", "48"))
+executor = ThreadPoolExecutor(max_workers=MAX_ENRICHMENT_WORKERS)
+
+def warm_up_clients():
+    get_container_client(dapr_client)
+    create_language_client(dapr_client)
+    load_openai()
+
+@app.route("/dapr/subscribe", methods=["GET"])
+def subscribe():
+    subscriptions = lane_subscriptions(source_topic, "enrich-batch", pubsub_name)
+    print("Dapr pub/sub is subscribed to: " + json.dumps(subscriptions), flush=True)
+    return jsonify(subscriptions)
+
+@app.route("/enrich-batch", methods=["POST"])
+@observe_handler
+@when_ready
+def enrich_batch_subscriber():
+    event = from_http(request.headers, request.get_data())
+    data = json.loads(event.data)
+
+    ingestion_id = data["ingestion_id"]
+    doc_id = data["doc_id"]
+    batch_nr = data["batch_nr"]
+    sections = data["sections"]
+    content_version = data.get("content_version")
+
+    # a redelivered batch is not enriched and uploaded again
+    ledger_key = idempotency.ledger_key(source_topic, doc_id, batch_nr, content_version)
+    try:
+        with idempotency.once(dapr_client, ledger_key) as claim:
+            if claim != idempotency.CLAIMED:
+                print(f"Skipped redelivered batch {batch_nr} for document ID: {doc_id}, {claim}", flush=True)
+                return idempotency.skipped_response(claim)
+
+            ingestion_response = dapr_client.get_state(store_name=store_name, key=f"ingestion-{ingestion_id}").data
+            if not ingestion_response:
+                raise ValueError(f"No ingestion found with ID: {ingestion_id}")
+            ingestion = json.loads(ingestion_response)
+
+            texts = [section["content"] for section in sections]
+            text_analytics_client = create_language_client(dapr_client)
+
+            ## the enrichments are independent, so the batch waits for the slowest one instead of the sum
+            vector_config = event_vector_config(data)
+            embeddings_future = executor.submit(compute_embedding_in_batch, dapr_client, texts,
+                                                request_dimensions(vector_config, embedding_model(dapr_client)))
+            keyphrases_future = executor.submit(compute_keyphrases, text_analytics_client, texts, batch_nr)
+            summaries_future = executor.submit(compute_summaries, text_analytics_client, texts, batch_nr)
+            embeddings = shape_embeddings(embeddings_future.result(), vector_config)
+            keyphrases = keyphrases_future.result()
+            summaries = summaries_future.result()
+
+            merge_enrichments(sections, embeddings, keyphrases, summaries)
+
+            container_client = get_container_client(dapr_client)
+
+            complete_batch(dapr_client, container_client, ingestion, ingestion_id, doc_id, batch_nr, content_version, sections)
+            print(f"Enriched batch {batch_nr} for document ID: {doc_id}", flush=True)
+            backlog.dequeue(dapr_client, source_topic, ingestion_id, backlog.batch_item(doc_id, batch_nr))
+
+    except Exception as e:
+        print(f"An error occurred: {str(e)}", flush=True)
+        return json.dumps({"success": False, "error": str(e)}), 500, {"ContentType": "application/json"}
+
+    return json.dumps({"success": True}), 200, {"ContentType": "application/json"}
+
+start_up(app, dapr_client, modules=("azure.storage.blob", "azure.ai.textanalytics", "openai"), clients=(warm_up_clients,))
+app.run(port=app_port)
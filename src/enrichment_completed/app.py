@@ -1,32 +1,39 @@
 from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type, before_sleep_log
 from flask import Flask, request, jsonify
-from azure.storage.blob import BlobServiceClient
 from cloudevents.http import from_http
-from dapr.clients import DaprClient
 import json
 import os
-
-dapr_client = DaprClient()
+from common import idempotency
+from common.blob_storage import get_container_client
+from common.lanes import lane_subscriptions
+from common.search_items import complete_batch, merge_enrichments
+from common.startup import start_up, when_ready
+from common.telemetry import create_dapr_client, instrument_app, observe_handler
+
+dapr_client = create_dapr_client()
 app = Flask(__name__)
+instrument_app(app, "enrichment-completed")
 app_port = os.getenv("APP_PORT", "6005")
 
 source_topic = "enrichment-completed"
 pubsub_name = "pubsub"
-destination_topic = "document-completed"
 store_name = "statestore"  
 secret_store = "secretstore"
 
+def warm_up_clients():
+    get_container_client(dapr_client)
+
 # This route subscribes to the pub/sub topic
 @app.route("/dapr/subscribe", methods=["GET"])
 def subscribe():
-    subscriptions = [
-        {"pubsubname": pubsub_name, "topic": source_topic, "route": "/enrichment-completed"}
-    ]
+    subscriptions = lane_subscriptions(source_topic, "/enrichment-completed", pubsub_name)
     print("Dapr pub/sub is subscribed to: " + json.dumps(subscriptions), flush=True)
     return jsonify(subscriptions)
 
 # This route is triggered when a service publishes a message to the topic
 @app.route("/enrichment-completed", methods=["POST"])
+@observe_handler
+@when_ready
 def enrichment_completed_subscriber():
     event = from_http(request.headers, request.get_data())
     data = json.loads(event.data)
@@ -36,7 +43,7 @@ def enrichment_completed_subscriber():
     service_name = data["service_name"]
     result_key = data["result_key"]
     batch_nr = data["batch_nr"]
-    total_batch_size = data["total_batch_size"]
+    content_version = data.get("content_version")
     # print(f"Received {service_name} statestore reference: {result_key} with document ID: {doc_id}", flush=True)
 
     ingestion_response = dapr_client.get_state(store_name=store_name, key=f"ingestion-{ingestion_id}").data
@@ -72,33 +79,27 @@ def enrichment_completed_subscriber():
         print(f"Number of sections: {len(sections)}", flush=True)
         return json.dumps({"success": False}), 500, {"ContentType": "application/json"}
 
-    ## append embeddings and keyphrases in sections
-    for (i, section) in enumerate(sections):
-        section['embeddings'] = embeddings[i]
-        section['keyphrases'] = keyphrases[i]
-        section['summaries'] = summaries[i]
+    ## the completion events of the enrichers may all find the batch complete, and may be redelivered,
+    ## only one of them uploads the batch and releases its slot
+    ledger_key = idempotency.ledger_key(source_topic, doc_id, batch_nr, content_version)
+    try:
+        with idempotency.once(dapr_client, ledger_key) as claim:
+            if claim != idempotency.CLAIMED:
+                return idempotency.skipped_response(claim)
 
-    # print(f"Ingestion data: {ingestion}", flush=True)
+            ## append embeddings and keyphrases in sections
+            merge_enrichments(sections, embeddings, keyphrases, summaries)
 
-    ## initialize blob
-    azure_blob_connection_string = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["AZURE_BLOB_CONNECTION_STRING"]
-    blob_container_name = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["BLOB_CONTAINER_NAME"]
-    blob_service_client = BlobServiceClient.from_connection_string(azure_blob_connection_string)
-    container_client = blob_service_client.get_container_client(blob_container_name)
+            # print(f"Ingestion data: {ingestion}", flush=True)
 
-    ## upload json to blob storage
-    blob_name = f"{ingestion['searchitems_folder_path']}{doc_id}-batch-{batch_nr}.json"
-    uploaded_blob_client = container_client.get_blob_client(blob=blob_name)
-    
-    ## convert sections to json and upload to blob
-    uploaded_blob_client.upload_blob(json.dumps(sections), overwrite=True)
+            ## initialize blob
+            container_client = get_container_client(dapr_client)
 
-    ## check in blob storage how many other blobs are uploaded with wildcard for the section number:
-    blob_path = f"{ingestion['searchitems_folder_path']}{doc_id}-batch-"
-    blob_list = container_client.list_blobs(name_starts_with=blob_path)
-    blob_count = len(list(blob_list))
+            complete_batch(dapr_client, container_client, ingestion, ingestion_id, doc_id, batch_nr, content_version, sections)
 
-    check_section_completion(ingestion_id, doc_id, blob_count, total_batch_size)
+    except Exception as e:
+        print(f"Error occurred: {e}", flush=True)
+        return json.dumps({"success": False}), 500, {"ContentType": "application/json"}
 
     ## delete the keys from redis
     dapr_client.delete_state(store_name=store_name, key=f"embedding-output-{doc_id}-batch-{batch_nr}")
@@ -108,20 +109,5 @@ def enrichment_completed_subscriber():
 
     return json.dumps({"success": True}), 200, {"ContentType": "application/json"}
 
-def check_section_completion(ingestion_id, doc_id, blob_count, section_length):
-    # Check if all sections are completed
-    if section_length and blob_count == int(section_length):
-        print(f"✅✅✅ Document fully processed with document ID: {doc_id}", flush=True)
-        
-        dapr_client.publish_event(
-            pubsub_name=pubsub_name,
-            topic_name=destination_topic,
-            data=json.dumps({
-                "ingestion_id": ingestion_id,
-                "doc_id": doc_id
-            })
-        )
-    else:
-        print(f"Completed sections: {blob_count} of {section_length}", flush=True)
-
+start_up(app, dapr_client, modules=("azure.storage.blob",), clients=(warm_up_clients,))
 app.run(port=app_port)
\ No newline at end of file
@@ -1,14 +1,17 @@
 from flask import Flask, request, jsonify
 from cloudevents.http import from_http
-from dapr.clients import DaprClient
 import json
 import os
-import openai
-import time
-from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception_type
-
-dapr_client = DaprClient()
+from common import backlog, idempotency
+from common.lanes import event_priority, lane_pubsub, lane_subscriptions, lane_topic
+from common.openai_embeddings import compute_embedding_in_batch, load_openai
+from common.startup import start_up, when_ready
+from common.telemetry import create_dapr_client, instrument_app, observe_handler
+from common.vector_config import embedding_model, event_vector_config, request_dimensions, shape_embeddings
+
+dapr_client = create_dapr_client()
 app = Flask(__name__)
+instrument_app(app, "generate-embeddings")
 app_port = os.getenv("APP_PORT", "6002")
 
 source_topic = "generate-embeddings"
@@ -16,51 +19,15 @@ destination_topic = "messages"
 pubsub_name = "pubsub"
 secret_store = "secretstore"
 
-# OpenAI setup
-openai.api_type = "azure"
-openai.api_version = "2023-05-15"
-
-CACHE_KEY_TOKEN_TYPE = "token_type"  # Define the missing constant
-open_ai_token_cache = {}  # Define the missing variable
-CACHE_KEY_TOKEN_CRED = "token_cred"  # Define the missing constant
-CACHE_KEY_CREATED_TIME = "created_time"  # Define the missing constant
-
-def refresh_openai_token():
-    """
-    Refresh OpenAI token every 5 minutes
-    """
-    if openai.api_type == 'azure_ad' and CACHE_KEY_TOKEN_TYPE in open_ai_token_cache and open_ai_token_cache[CACHE_KEY_TOKEN_TYPE] == 'azure_ad' and open_ai_token_cache[CACHE_KEY_CREATED_TIME] + 300 < time.time():
-        token_cred = open_ai_token_cache[CACHE_KEY_TOKEN_CRED]
-        openai.api_key = token_cred.get_token("https://cognitiveservices.azure.com/.default").token
-        open_ai_token_cache[CACHE_KEY_CREATED_TIME] = time.time()
-
-@retry(retry=retry_if_exception_type(openai.error.RateLimitError), wait=wait_random_exponential(min=15, max=60), stop=stop_after_attempt(30))
-def compute_embedding_in_batch(texts):
-    refresh_openai_token()
-    try:
-        OPENAI_ENDPOINT = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["OPENAI_ENDPOINT"]
-        OPENAI_DEPLOYMENT = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["OPENAI_DEPLOYMENT"]
-        OPENAI_KEY = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["OPENAI_KEY"]
-        openai.api_key = OPENAI_KEY
-        openai.api_base = OPENAI_ENDPOINT
-        emb_response = openai.Embedding.create(engine=OPENAI_DEPLOYMENT, input=texts)
-        
-        if not emb_response["data"][0]["embedding"]:
-            raise ValueError("Empty embedding returned")
-        return [data.embedding for data in emb_response.data]
-    except openai.error.OpenAIError as e:
-        print(f"OpenAI API error: {e}", flush=True)
-        raise  # Reraise the exception to trigger the retry mechanism
-
 @app.route("/dapr/subscribe", methods=["GET"])
 def subscribe():
-    subscriptions = [
-        {"pubsubname": pubsub_name, "topic": source_topic, "route": "generate-embeddings"}
-    ]
+    subscriptions = lane_subscriptions(source_topic, "generate-embeddings", pubsub_name)
     print("Dapr pub/sub is subscribed to: " + json.dumps(subscriptions), flush=True)
     return jsonify(subscriptions)
 
 @app.route("/generate-embeddings", methods=["POST"])
+@observe_handler
+@when_ready
 def generate_embeddings_subscriber():
     event = from_http(request.headers, request.get_data())
     data = json.loads(event.data)
@@ -69,38 +36,53 @@ def generate_embeddings_subscriber():
     doc_id = data["doc_id"]
     batch_key = data["batch_key"]
     batch_nr = data["batch_nr"]
-    total_batch_size = data["total_batch_size"]
+    priority = event_priority(data)
+    content_version = data.get("content_version")
     # print(f"Received form recognizer statestore reference: {batch_key} with document ID: {doc_id}", flush=True)
 
+    # a redelivered batch is not enriched again
+    ledger_key = idempotency.ledger_key(source_topic, doc_id, batch_nr, content_version)
     try:
-        # Retrieve the Form Recognizer result from Redis using Dapr state store
-        state_item = dapr_client.get_state(store_name="statestore", key=batch_key)
-        batch_result = json.loads(state_item.data) if state_item.data else None
-
-        if batch_result is None:
-            raise ValueError("No section result found for the provided result key")
-
-        embeddings = compute_embedding_in_batch([section["content"] for section in batch_result])
-
-        # Store the embedding result in Redis
-        embedding_result_key = f"embedding-output-{doc_id}-batch-{batch_nr}"
-        dapr_client.save_state(store_name="statestore", key=embedding_result_key, value=json.dumps(embeddings))
-        # print(f"Stored embedding result with key: {embedding_result_key}", flush=True)
-
-        # Publish the completion event to the enrichment-completed topic
-        dapr_client.publish_event(
-            pubsub_name=pubsub_name,
-            topic_name="enrichment-completed",
-            data=json.dumps({
-                "ingestion_id": ingestion_id,
-                "doc_id": doc_id, 
-                "service_name": "generate-embeddings", 
-                "result_key": embedding_result_key,
-                "batch_nr": batch_nr,
-                "total_batch_size": total_batch_size
-            }),
-        )
-        print(f"Published completion event for embeddings with document ID: {doc_id}", flush=True)
+        with idempotency.once(dapr_client, ledger_key) as claim:
+            if claim != idempotency.CLAIMED:
+                print(f"Skipped redelivered batch {batch_nr} for document ID: {doc_id}, {claim}", flush=True)
+                return idempotency.skipped_response(claim)
+
+            # Retrieve the Form Recognizer result from Redis using Dapr state store
+            state_item = dapr_client.get_state(store_name="statestore", key=batch_key)
+            batch_result = json.loads(state_item.data) if state_item.data else None
+
+            if batch_result is None:
+                raise ValueError("No section result found for the provided result key")
+
+            # the model returns vectors of the dimensions of the ingestion's index, they are converted to its element type
+            vector_config = event_vector_config(data)
+            embeddings = compute_embedding_in_batch(dapr_client, [section["content"] for section in batch_result],
+                                                    request_dimensions(vector_config, embedding_model(dapr_client)))
+            embeddings = shape_embeddings(embeddings, vector_config)
+
+            # Store the embedding result in Redis
+            embedding_result_key = f"embedding-output-{doc_id}-batch-{batch_nr}"
+            dapr_client.save_state(store_name="statestore", key=embedding_result_key, value=json.dumps(embeddings))
+            # print(f"Stored embedding result with key: {embedding_result_key}", flush=True)
+
+            # Publish the completion event to the enrichment-completed topic
+            dapr_client.publish_event(
+                pubsub_name=lane_pubsub(priority, pubsub_name),
+                topic_name=lane_topic("enrichment-completed", priority),
+                data=json.dumps({
+                    "ingestion_id": ingestion_id,
+                    "doc_id": doc_id, 
+                    "service_name": "generate-embeddings", 
+                    "result_key": embedding_result_key,
+                    "batch_nr": batch_nr,
+                    "priority": priority,
+                    "content_version": content_version
+                }),
+            )
+            print(f"Published completion event for embeddings with document ID: {doc_id}", flush=True)
+
+            backlog.dequeue(dapr_client, source_topic, ingestion_id, backlog.batch_item(doc_id, batch_nr))
 
     except Exception as e:
         print(f"An error occurred: {str(e)}", flush=True)
@@ -109,4 +91,5 @@ def generate_embeddings_subscriber():
     return json.dumps({"success": True}), 200, {"ContentType": "application/json"}
 
 
+start_up(app, dapr_client, modules=("openai",), clients=(load_openai,))
 app.run(port=app_port)
@@ -1,16 +1,19 @@
 import time
-from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception_type
 from flask import Flask, request, jsonify
 from cloudevents.http import from_http
-from dapr.clients import DaprClient
+from dapr.clients.grpc._state import StateItem
 import json
 import os
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.textanalytics import TextAnalyticsClient
-from azure.core.exceptions import AzureError
+from common import backlog, idempotency
+from common.enrichment import event_enrichment_mode
+from common.language import compute_keyphrases, compute_keyphrases_and_summaries, create_language_client
+from common.lanes import event_priority, lane_pubsub, lane_subscriptions, lane_topic
+from common.startup import start_up, when_ready
+from common.telemetry import create_dapr_client, instrument_app, observe_handler
 
-dapr_client = DaprClient()
+dapr_client = create_dapr_client()
 app = Flask(__name__)
+instrument_app(app, "generate-keyphrases")
 app_port = os.getenv("APP_PORT", "6003")
 
 source_topic = "generate-keyphrases"
@@ -18,69 +21,89 @@ destination_topic = "enrichment-completed"
 pubsub_name = "pubsub"
 secret_store = "secretstore"
 
-@retry(retry=retry_if_exception_type(AzureError), wait=wait_random_exponential(min=15, max=60), stop=stop_after_attempt(40))
-def compute_keyphrases(texts, batch_nr):
-    language_endpoint = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["AZURE_LANGUAGE_ENDPOINT"]
-    language_key = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["AZURE_LANGUAGE_KEY"]
-    text_analytics_client = TextAnalyticsClient(endpoint=language_endpoint, credential=AzureKeyCredential(language_key))
+def warm_up_clients():
+    create_language_client(dapr_client)
 
-    result = text_analytics_client.extract_key_phrases(texts)
-    if result and len(result) == len(texts) and not any([resp.is_error for resp in result]):
-        return [data.key_phrases for data in result]
-    else:
-        error_message = f"Error occurred in keyphrases batch_nr: {batch_nr}"
-        print(error_message, flush=True)
-        raise AzureError(error_message)  
+def publish_completion(service_name, result_key, data):
+    dapr_client.publish_event(
+        pubsub_name=lane_pubsub(data["priority"], pubsub_name),
+        topic_name=lane_topic(destination_topic, data["priority"]),
+        data=json.dumps({
+            "ingestion_id": data["ingestion_id"],
+            "doc_id": data["doc_id"], 
+            "service_name": service_name, 
+            "result_key": result_key,
+            "batch_nr": data["batch_nr"],
+            "priority": data["priority"],
+            "content_version": data.get("content_version")
+        }),
+    )
 
 @app.route("/dapr/subscribe", methods=["GET"])
 def subscribe():
-    subscriptions = [
-        {"pubsubname": pubsub_name, "topic": source_topic, "route": "generate-keyphrases"}
-    ]
+    subscriptions = lane_subscriptions(source_topic, "generate-keyphrases", pubsub_name)
     print("Dapr pub/sub is subscribed to: " + json.dumps(subscriptions), flush=True)
     return jsonify(subscriptions)
 
 @app.route("/generate-keyphrases", methods=["POST"])
+@observe_handler
+@when_ready
 def generate_keyphrases_subscriber():
     event = from_http(request.headers, request.get_data())
     data = json.loads(event.data)
 
-    ingestion_id = data["ingestion_id"]
     doc_id = data["doc_id"]
     batch_key = data["batch_key"]
     batch_nr = data["batch_nr"]
-    total_batch_size = data["total_batch_size"]
+    data["priority"] = event_priority(data)
+    content_version = data.get("content_version")
 
     # print(f"Received form recognizer statestore reference: {batch_key} with document ID: {doc_id}", flush=True)
 
+    # a redelivered batch is not enriched again
+    ledger_key = idempotency.ledger_key(source_topic, doc_id, batch_nr, content_version)
     try:
-        # Retrieve the Form Recognizer result from Redis using Dapr state store
-        state_item = dapr_client.get_state(store_name="statestore", key=batch_key)
-        batch_result = json.loads(state_item.data) if state_item.data else None
-        keyphrases = compute_keyphrases([section["content"] for section in batch_result], batch_nr)
-
-        # show the keyphrases
-        # print(f"Keyphrases extracted: {json.dumps(keyphrases)}", flush=True)
-        
-        # Store the keyphrases result in Redis
-        keyphrases_result_key = f"keyphrases-output-{doc_id}-batch-{batch_nr}"
-        dapr_client.save_state(store_name="statestore", key=keyphrases_result_key, value=json.dumps(keyphrases))
-        # print(f"Stored keyphrases result with key: {keyphrases_result_key}", flush=True)
-
-        # Publish the completion event to the enrichment-completed topic
-        dapr_client.publish_event(
-            pubsub_name=pubsub_name,
-            topic_name=destination_topic,
-            data=json.dumps({
-                "ingestion_id": ingestion_id,
-                "doc_id": doc_id, 
-                "service_name": "generate-keyphrases", 
-                "result_key": keyphrases_result_key,
-                "batch_nr": batch_nr,
-                "total_batch_size": total_batch_size
-            }),
-        )
-        print(f"Published completion event for keyphrases with document ID: {doc_id}", flush=True)
+        with idempotency.once(dapr_client, ledger_key) as claim:
+            if claim != idempotency.CLAIMED:
+                print(f"Skipped redelivered batch {batch_nr} for document ID: {doc_id}, {claim}", flush=True)
+                return idempotency.skipped_response(claim)
+
+            # Retrieve the Form Recognizer result from Redis using Dapr state store
+            state_item = dapr_client.get_state(store_name="statestore", key=batch_key)
+            batch_result = json.loads(state_item.data) if state_item.data else None
+            texts = [section["content"] for section in batch_result]
+            text_analytics_client = create_language_client(dapr_client)
+            keyphrases_result_key = f"keyphrases-output-{doc_id}-batch-{batch_nr}"
+
+            if event_enrichment_mode(data) == "language-combined":
+                # one analyze job extracts both, generate-summaries doesn't receive the batch
+                keyphrases, summaries = compute_keyphrases_and_summaries(text_analytics_client, texts, batch_nr)
+                summaries_result_key = f"summaries-output-{doc_id}-batch-{batch_nr}"
+                dapr_client.save_bulk_state(store_name="statestore", states=[
+                    StateItem(key=keyphrases_result_key, value=json.dumps(keyphrases)),
+                    StateItem(key=summaries_result_key, value=json.dumps(summaries)),
+                ])
+
+                # enrichment-completed waits for both enrichers, so signal completion for each of them
+                publish_completion("generate-keyphrases", keyphrases_result_key, data)
+                publish_completion("generate-summaries", summaries_result_key, data)
+                print(f"Published completion events for keyphrases and summaries with document ID: {doc_id}", flush=True)
+
+            else:
+                keyphrases = compute_keyphrases(text_analytics_client, texts, batch_nr)
+
+                # show the keyphrases
+                # print(f"Keyphrases extracted: {json.dumps(keyphrases)}", flush=True)
+
+                # Store the keyphrases result in Redis
+                dapr_client.save_state(store_name="statestore", key=keyphrases_result_key, value=json.dumps(keyphrases))
+                # print(f"Stored keyphrases result with key: {keyphrases_result_key}", flush=True)
+
+                # Publish the completion event to the enrichment-completed topic
+                publish_completion("generate-keyphrases", keyphrases_result_key, data)
+                print(f"Published completion event for keyphrases with document ID: {doc_id}", flush=True)
+
+            backlog.dequeue(dapr_client, source_topic, data["ingestion_id"], backlog.batch_item(doc_id, batch_nr))
 
     except Exception as e:
         print(f"An error occurred: {str(e)}", flush=True)
@@ -88,4 +111,5 @@ def generate_keyphrases_subscriber():
 
     return json.dumps({"success": True}), 200, {"ContentType": "application/json"}
 
+start_up(app, dapr_client, modules=("azure.ai.textanalytics",), clients=(warm_up_clients,))
 app.run(port=app_port)
@@ -1,16 +1,17 @@
 import time
-from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception_type
 from flask import Flask, request, jsonify
 from cloudevents.http import from_http
-from dapr.clients import DaprClient
 import json
 import os
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.textanalytics import TextAnalyticsClient
-from azure.core.exceptions import AzureError
+from common import backlog, idempotency
+from common.language import compute_summaries, create_language_client
+from common.lanes import event_priority, lane_pubsub, lane_subscriptions, lane_topic
+from common.startup import start_up, when_ready
+from common.telemetry import create_dapr_client, instrument_app, observe_handler
 
-dapr_client = DaprClient()
+dapr_client = create_dapr_client()
 app = Flask(__name__)
+instrument_app(app, "generate-summaries")
 app_port = os.getenv("APP_PORT", "6004")
 
 source_topic = "generate-summaries"
@@ -18,42 +19,18 @@ destination_topic = "enrichment-completed"
 pubsub_name = "pubsub"
 secret_store = "secretstore"
 
-@retry(retry=retry_if_exception_type(AzureError), wait=wait_random_exponential(min=15, max=60), stop=stop_after_attempt(40))
-def compute_summaries(texts, batch_nr):
-    language_endpoint = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["AZURE_LANGUAGE_ENDPOINT"]
-    language_key = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["AZURE_LANGUAGE_KEY"]
-    text_analytics_client = TextAnalyticsClient(endpoint=language_endpoint, credential=AzureKeyCredential(language_key))
-
-    poller = text_analytics_client.begin_extract_summary(texts)
-    summaries_result = poller.result()
-
-    # get summaries extraced for summaries_result:
-    summaries = []
-
-    for result in summaries_result:
-        if result.kind == "ExtractiveSummarization":
-            summaries.append(" ".join([sentence.text for sentence in result.sentences]))
-
-        elif result.is_error is True:
-            raise AzureError(result.error.message)
-    
-
-    if len(summaries) != len(texts):
-        error_message = f"Error occurred in summaries batch_nr: {batch_nr}"
-        print(error_message, flush=True)
-        raise AzureError(error_message)
-
-    return summaries
+def warm_up_clients():
+    create_language_client(dapr_client)
 
 @app.route("/dapr/subscribe", methods=["GET"])
 def subscribe():
-    subscriptions = [
-        {"pubsubname": pubsub_name, "topic": source_topic, "route": "generate-summaries"}
-    ]
+    subscriptions = lane_subscriptions(source_topic, "generate-summaries", pubsub_name)
     print("Dapr pub/sub is subscribed to: " + json.dumps(subscriptions), flush=True)
     return jsonify(subscriptions)
 
 @app.route("/generate-summaries", methods=["POST"])
+@observe_handler
+@when_ready
 def generate_summaries_subscriber():
     event = from_http(request.headers, request.get_data())
     data = json.loads(event.data)
@@ -62,38 +39,49 @@ def generate_summaries_subscriber():
     doc_id = data["doc_id"]
     batch_key = data["batch_key"]
     batch_nr = data["batch_nr"]
-    total_batch_size = data["total_batch_size"]
+    priority = event_priority(data)
+    content_version = data.get("content_version")
 
     # print(f"Received form recognizer statestore reference: {batch_key} with document ID: {doc_id}", flush=True)
 
+    # a redelivered batch is not enriched again
+    ledger_key = idempotency.ledger_key(source_topic, doc_id, batch_nr, content_version)
     try:
-        # Retrieve the Form Recognizer result from Redis using Dapr state store
-        state_item = dapr_client.get_state(store_name="statestore", key=batch_key)
-        batch_result = json.loads(state_item.data) if state_item.data else None
-        summaries = compute_summaries([section["content"] for section in batch_result], batch_nr)
-
-        # show the summaries
-        # print(f"summaries extracted: {json.dumps(summaries)}", flush=True)
+        with idempotency.once(dapr_client, ledger_key) as claim:
+            if claim != idempotency.CLAIMED:
+                print(f"Skipped redelivered batch {batch_nr} for document ID: {doc_id}, {claim}", flush=True)
+                return idempotency.skipped_response(claim)
+
+            # Retrieve the Form Recognizer result from Redis using Dapr state store
+            state_item = dapr_client.get_state(store_name="statestore", key=batch_key)
+            batch_result = json.loads(state_item.data) if state_item.data else None
+            summaries = compute_summaries(create_language_client(dapr_client), [section["content"] for section in batch_result], batch_nr)
+
+            # show the summaries
+            # print(f"summaries extracted: {json.dumps(summaries)}", flush=True)
         
-        # Store the summaries result in Redis
-        summaries_result_key = f"summaries-output-{doc_id}-batch-{batch_nr}"
-        dapr_client.save_state(store_name="statestore", key=summaries_result_key, value=json.dumps(summaries))
-        # print(f"Stored summaries result with key: {summaries_result_key}", flush=True)
-
-        # Publish the completion event to the enrichment-completed topic
-        dapr_client.publish_event(
-            pubsub_name=pubsub_name,
-            topic_name=destination_topic,
-            data=json.dumps({
-                "ingestion_id": ingestion_id,
-                "doc_id": doc_id, 
-                "service_name": "generate-summaries", 
-                "result_key": summaries_result_key,
-                "batch_nr": batch_nr,
-                "total_batch_size": total_batch_size
-            }),
-        )
-        print(f"Published completion event for summaries with document ID: {doc_id}", flush=True)
+            # Store the summaries result in Redis
+            summaries_result_key = f"summaries-output-{doc_id}-batch-{batch_nr}"
+            dapr_client.save_state(store_name="statestore", key=summaries_result_key, value=json.dumps(summaries))
+            # print(f"Stored summaries result with key: {summaries_result_key}", flush=True)
+
+            # Publish the completion event to the enrichment-completed topic
+            dapr_client.publish_event(
+                pubsub_name=lane_pubsub(priority, pubsub_name),
+                topic_name=lane_topic(destination_topic, priority),
+                data=json.dumps({
+                    "ingestion_id": ingestion_id,
+                    "doc_id": doc_id, 
+                    "service_name": "generate-summaries", 
+                    "result_key": summaries_result_key,
+                    "batch_nr": batch_nr,
+                    "priority": priority,
+                    "content_version": content_version
+                }),
+            )
+            print(f"Published completion event for summaries with document ID: {doc_id}", flush=True)
+
+            backlog.dequeue(dapr_client, source_topic, ingestion_id, backlog.batch_item(doc_id, batch_nr))
 
     except Exception as e:
         print(f"An error occurred: {str(e)}", flush=True)
@@ -101,4 +89,5 @@ def generate_summaries_subscriber():
 
     return json.dumps({"success": True}), 200, {"ContentType": "application/json"}
 
+start_up(app, dapr_client, modules=("azure.ai.textanalytics",), clients=(warm_up_clients,))
 app.run(port=app_port)
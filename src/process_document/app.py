@@ -1,109 +1,447 @@
 import math
+import time
+import traceback
+import zlib
 from flask import Flask, request, jsonify
 from cloudevents.http import from_http
-from dapr.clients import DaprClient
 import json
 import os
-from azure.storage.blob import BlobServiceClient
-from document_chunker import create_sections, process_with_form_recognizer
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError
+from common.blob_storage import download_to_spool, get_container_client
+from common import backlog, idempotency
+from common.enrichment import ENRICHMENT_MODE, enrichment_calls_per_batch, enrichment_topics, event_enrichment_mode
+from common.lanes import event_priority, lane_pubsub, lane_subscriptions, lane_topic
+from common.search_items import save_near_duplicates, seal_document
+from common.secrets import get_secret
+from common.startup import start_up, when_ready
+from common.state import STATE_CONFLICT_ERRORS, increment_fields, save_state_if_unchanged, update_counter
+from common.telemetry import count_near_duplicates, create_dapr_client, instrument_app, observe_handler, observe_payload, track_call
+from common.vector_config import event_vector_config
+from document_chunker import create_chunking_pool, create_form_recognizer_client, process_with_form_recognizer, stream_sections
+from near_duplicates import remove_near_duplicates, section_signatures
 
-dapr_client = DaprClient()
+# Number of processes that chunk documents, defaults to the number of cores available to the container.
+# The pool is forked before the Dapr client and the handler threads are started.
+CHUNKING_WORKERS = int(os.getenv("CHUNKING_WORKERS", "0"))
+chunking_pool = create_chunking_pool(CHUNKING_WORKERS)
+
+dapr_client = create_dapr_client()
 app = Flask(__name__)
+instrument_app(app, "process-document")
 app_port = os.getenv("APP_PORT", "6001")
 
 source_topic = "process-document"
 secret_store = "secretstore"
 pubsub_name = "pubsub"
+release_topic = "batch-released"
+completed_topic = "document-completed"
+# releases are small control events, the high lane keeps them from waiting behind documents
+release_priority = "high"
 
 BATCH_SIZE = 8
 
-def save_and_publish_batch(ingestion_id, doc_id, batch_nr, batch_content, total_batch_size):
-    batch_key = f"section-output-{doc_id}-batch-{batch_nr}"
-    dapr_client.save_state(store_name="statestore", key=batch_key, value=json.dumps(batch_content))
+# Maximum number of batches per ingestion that are stored in Redis and waiting for enrichment.
+# Batches over this limit are parked in blob storage until enrichment-completed releases a slot.
+MAX_INFLIGHT_BATCHES = int(os.getenv("MAX_INFLIGHT_BATCHES", "200"))
+PENDING_BATCHES_FOLDER = os.getenv("PENDING_BATCHES_FOLDER", "pending-batches/")
+INFLIGHT_TTL_IN_SECONDS = 24 * 60 * 60
+# A batch holds its slot for at most this long. A batch that never completes, e.g. because it was
+# dead-lettered or expired in the queue, leaks its slot, it is taken over once the lease expired.
+INFLIGHT_SLOT_LEASE_IN_SECONDS = int(os.getenv("INFLIGHT_SLOT_LEASE_IN_SECONDS", "3600"))
+
+# Sections whose estimated Jaccard similarity (of word shingles) with a section seen before in the
+# ingestion is at least this threshold are not enriched. 0 disables the deduplication.
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0"))
+# "reuse" indexes the near duplicates with the enrichments of their canonical section, "drop" leaves
+# them out of the index as well
+NEAR_DUPLICATE_MODE = os.getenv("NEAR_DUPLICATE_MODE", "reuse")
+NEAR_DUPLICATE_TTL_IN_SECONDS = 24 * 60 * 60
+# The chunking worker sends the sections back in groups of a batch, so the first batches are
+# published while the rest of the document is chunked. With the deduplication on, a group spans
+# this many batches to keep the lookups in the LSH index per group down.
+NEAR_DUPLICATE_GROUP_BATCHES = int(os.getenv("NEAR_DUPLICATE_GROUP_BATCHES", "8"))
+
+def chunking_pool_health():
+    # a worker that died (e.g. out of memory) breaks the pool for good, it can't be forked again
+    # once the handler threads run, so the replica is restarted instead
+    if chunking_pool.broken:
+        return "a chunking worker died, the chunking pool can't be used anymore"
+
+def warm_up_clients():
+    get_container_client(dapr_client)
+    create_form_recognizer_client(get_secret(dapr_client, "FORM_RECOGNIZER_ENDPOINT"), get_secret(dapr_client, "FORM_RECOGNIZER_KEY"))
+
+def save_and_publish_batch(batch_event, batch_content):
+    # a parked batch keeps the mode it was created with, its enrichers follow the event
+    mode = event_enrichment_mode(batch_event)
+    if mode == "fused":
+        # enrich-batch handles the whole batch in one handler, skip the round trip through Redis
+        batch_event = dict(batch_event, sections=batch_content)
+    else:
+        dapr_client.save_state(store_name="statestore", key=batch_event["batch_key"], value=json.dumps(batch_content),
+                               state_metadata={"ttlInSeconds": str(INFLIGHT_TTL_IN_SECONDS)})
+
+    # the batch is in the backlog of the enrichers before their events can be handled
+    backlog.enqueue(dapr_client, enrichment_topics(mode), batch_event["ingestion_id"],
+                    backlog.batch_item(batch_event["doc_id"], batch_event["batch_nr"]))
 
     # Publish events for the batch
-    for topic in ["generate-embeddings", "generate-keyphrases", "generate-summaries"]:
+    priority = batch_event["priority"]
+    for topic in enrichment_topics(mode):
         dapr_client.publish_event(
-            pubsub_name=pubsub_name,
-            topic_name=topic,
-            data=json.dumps({
-                "ingestion_id": ingestion_id,
-                "doc_id": doc_id,
-                "batch_key": batch_key,
-                "batch_nr": batch_nr,
-                "total_batch_size": total_batch_size
-            }),
+            pubsub_name=lane_pubsub(priority, pubsub_name),
+            topic_name=lane_topic(topic, priority),
+            data=json.dumps(batch_event),
         )
 
+def batch_slot_key(ingestion_id, slot):
+    return f"inflight-slot-{ingestion_id}-{slot}"
+
+def read_batch_slots(ingestion_id):
+    """
+    Returns {slot: (lease, etag)} of the slots of the ingestion that are taken, the lease being
+    {"batch", "expires_at"}
+    """
+    keys = [batch_slot_key(ingestion_id, slot) for slot in range(MAX_INFLIGHT_BATCHES)]
+    items = dapr_client.get_bulk_state(store_name="statestore", keys=keys, parallelism=10).items
+    return {int(item.key.rsplit("-", 1)[1]): (json.loads(item.data), item.etag) for item in items if item.data}
+
+def save_inflight_count(ingestion_id, count):
+    # a snapshot for the backlog gauges, the slots themselves are the limit
+    dapr_client.save_state(store_name="statestore", key=f"inflight-batches-{ingestion_id}", value=str(count),
+                           state_metadata={"ttlInSeconds": str(INFLIGHT_TTL_IN_SECONDS)})
+
+def acquire_batch_slot(ingestion_id, batch):
+    """
+    Takes one of the MAX_INFLIGHT_BATCHES slots of the ingestion for the batch, a free one or one
+    whose lease expired. Returns False when all slots are held.
+    """
+    if not MAX_INFLIGHT_BATCHES:
+        return True
+    now = time.time()
+    slots = read_batch_slots(ingestion_id)
+    if any(lease["batch"] == batch for lease, _ in slots.values()):
+        # taken by an earlier delivery that failed before it published the batch
+        return True
+    held = sum(1 for lease, _ in slots.values() if lease["expires_at"] > now)
+
+    # batches start looking at different slots, so replicas seldom race for the same one
+    start = zlib.crc32(batch.encode("utf-8")) % MAX_INFLIGHT_BATCHES
+    for slot in ((start + offset) % MAX_INFLIGHT_BATCHES for offset in range(MAX_INFLIGHT_BATCHES)):
+        lease, etag = slots.get(slot, (None, None))
+        if lease and lease["expires_at"] > now:
+            continue
+        try:
+            save_state_if_unchanged(dapr_client, "statestore", batch_slot_key(ingestion_id, slot),
+                                    json.dumps({"batch": batch, "expires_at": now + INFLIGHT_SLOT_LEASE_IN_SECONDS}), etag,
+                                    {"ttlInSeconds": str(INFLIGHT_TTL_IN_SECONDS)})
+        except STATE_CONFLICT_ERRORS:
+            # another replica took the slot first
+            continue
+        if lease:
+            print(f"Took over the slot of batch {lease['batch']} of ingestion ID: {ingestion_id}, it was never released", flush=True)
+            update_counter(dapr_client, "statestore", f"inflight-leaked-{ingestion_id}", 1, ttl_in_seconds=INFLIGHT_TTL_IN_SECONDS)
+        save_inflight_count(ingestion_id, held + 1)
+        return True
+    return False
+
+def release_batch_slot(ingestion_id, batch):
+    """
+    Gives the slot of the batch back, a redelivered release finds none
+    """
+    if not MAX_INFLIGHT_BATCHES:
+        return
+    slots = read_batch_slots(ingestion_id)
+    for slot, (lease, etag) in slots.items():
+        if lease["batch"] != batch:
+            continue
+        try:
+            dapr_client.delete_state(store_name="statestore", key=batch_slot_key(ingestion_id, slot), etag=etag)
+        except STATE_CONFLICT_ERRORS:
+            # the lease expired and another batch took the slot over
+            return
+        save_inflight_count(ingestion_id, sum(1 for lease, _ in slots.values() if lease["expires_at"] > time.time()) - 1)
+        return
+
+def pending_batch_name(batch_event):
+    return f"{PENDING_BATCHES_FOLDER}{batch_event['ingestion_id']}/{batch_event['doc_id']}-batch-{batch_event['batch_nr']:05d}.json"
+
+def submit_batch(container_client, batch_event, batch_content):
+    """
+    Publishes the batch when its ingestion has room for more in-flight batches, otherwise parks it
+    in blob storage. Returns whether the batch was published.
+    """
+    ingestion_id = batch_event["ingestion_id"]
+    batch = backlog.batch_item(batch_event["doc_id"], batch_event["batch_nr"])
+    if acquire_batch_slot(ingestion_id, batch):
+        try:
+            save_and_publish_batch(batch_event, batch_content)
+            return True
+        except Exception:
+            release_batch_slot(ingestion_id, batch)
+            raise
+
+    with track_call("blob", "upload_blob"):
+        container_client.upload_blob(pending_batch_name(batch_event), json.dumps({"event": batch_event, "sections": batch_content}), overwrite=True)
+    backlog.count_parked_batches(dapr_client, ingestion_id, 1)
+    return False
+
+def submitted_batches_key(doc_id, content_version):
+    return f"submitted-batches-{doc_id}-{content_version or 'none'}"
+
+def publish_pending_batches(container_client, ingestion_id):
+    published = 0
+    try:
+        for blob in container_client.list_blobs(name_starts_with=f"{PENDING_BATCHES_FOLDER}{ingestion_id}/"):
+            # named after the batch, see pending_batch_name
+            doc_id, batch_nr = blob.name.split("/")[-1][:-len(".json")].rsplit("-batch-", 1)
+            batch = backlog.batch_item(doc_id, int(batch_nr))
+            if not acquire_batch_slot(ingestion_id, batch):
+                break
+
+            blob_client = container_client.get_blob_client(blob.name)
+            try:
+                with track_call("blob", "download_blob"):
+                    pending = json.loads(blob_client.download_blob().readall())
+                # deleting the blob claims the batch, another replica may have claimed it already
+                blob_client.delete_blob(etag=blob.etag, match_condition=MatchConditions.IfNotModified)
+            except ResourceNotFoundError:
+                release_batch_slot(ingestion_id, batch)
+                continue
+
+            try:
+                save_and_publish_batch(pending["event"], pending["sections"])
+            except Exception:
+                blob_client.upload_blob(json.dumps(pending), overwrite=True)
+                release_batch_slot(ingestion_id, batch)
+                raise
+            published += 1
+    finally:
+        if published:
+            backlog.count_parked_batches(dapr_client, ingestion_id, -published)
+
+    if published:
+        print(f"Published {published} pending batches for ingestion ID: {ingestion_id}", flush=True)
+
+def drop_near_duplicates(ingestion_id, doc_id, sections, signatures, kept_before):
+    # the kept sections are batched in order, after the ones kept before in the document
+    def locate(position):
+        return doc_id, (kept_before + position) // BATCH_SIZE + 1
+    return remove_near_duplicates(dapr_client, "statestore", ingestion_id, sections, signatures,
+                                  NEAR_DUPLICATE_THRESHOLD, NEAR_DUPLICATE_TTL_IN_SECONDS, locate)
+
+def record_near_duplicates(ingestion_id, section_count, kept_count):
+    # every batch less saves a call per enrichment, in "drop" mode every section less a document in the search index
+    removed_calls = (math.ceil(section_count / BATCH_SIZE) - math.ceil(kept_count / BATCH_SIZE)) * enrichment_calls_per_batch()
+    removed_documents = section_count - kept_count if NEAR_DUPLICATE_MODE == "drop" else 0
+    increment_fields(dapr_client, "statestore", f"near-duplicates-{ingestion_id}", {
+        "sections": section_count,
+        "duplicates": section_count - kept_count,
+        "index_documents_removed": removed_documents,
+        "enrichment_calls_removed": removed_calls
+    }, ttl_in_seconds=NEAR_DUPLICATE_TTL_IN_SECONDS)
+    count_near_duplicates(removed_documents, removed_calls)
+
+    print(f"Found {section_count - kept_count} near duplicate sections of {section_count}, saving {removed_calls} enrichment calls", flush=True)
+
+def publish_document_completed(ingestion_id, doc_id):
+    dapr_client.publish_event(
+        pubsub_name=pubsub_name,
+        topic_name=completed_topic,
+        data=json.dumps({
+            "ingestion_id": ingestion_id,
+            "doc_id": doc_id
+        })
+    )
+
 @app.route("/dapr/subscribe", methods=["GET"])
 def subscribe():
-    subscriptions = [
-        {"pubsubname": pubsub_name, "topic": source_topic, "route": "process-document"}
+    subscriptions = lane_subscriptions(source_topic, "process-document", pubsub_name) + [
+        {"pubsubname": lane_pubsub(release_priority, pubsub_name), "topic": release_topic, "route": "batch-released"}
     ]
     print("Dapr pub/sub is subscribed to: " + json.dumps(subscriptions), flush=True)
     return jsonify(subscriptions)
 
 @app.route("/process-document", methods=["POST"])
+@observe_handler
+@when_ready
 def process_page_subscriber():
     event = from_http(request.headers, request.get_data())
 
     ingestion_id = event.data["ingestion_id"]
     doc_id = event.data["doc_id"]
     blob_name = event.data["blob_name"]
+    priority = event_priority(event.data)
+    vector_config = event_vector_config(event.data)
+    content_version = event.data.get("content_version")
     
     print(f"Received filename: {blob_name} with document ID: {doc_id}", flush=True)
 
+    # a redelivered document is not analyzed and batched again
+    ledger_key = idempotency.ledger_key(source_topic, doc_id, content_version=content_version)
+    # what the handler was doing when it failed, for the error log
+    stage = "claiming the document"
     try:
-        # Get the blob client for the specific blob
-        blob_secret = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["AZURE_BLOB_CONNECTION_STRING"]
-        blob_container_name = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["BLOB_CONTAINER_NAME"]
-        blob_service_client = BlobServiceClient.from_connection_string(blob_secret)
-        blob_client = blob_service_client.get_blob_client(container=blob_container_name, blob=blob_name)
-        
-        # Download the blob content
-        blob_content = blob_client.download_blob().readall()
+        with idempotency.once(dapr_client, ledger_key) as claim:
+            if claim != idempotency.CLAIMED:
+                print(f"Skipped redelivered document ID: {doc_id}, {claim}", flush=True)
+                return idempotency.skipped_response(claim)
+
+            # the ingestion is needed to seal the document, check it before any batch is published
+            stage = "reading the ingestion"
+            ingestion_response = dapr_client.get_state(store_name="statestore", key=f"ingestion-{ingestion_id}").data
+            if not ingestion_response:
+                raise ValueError(f"No ingestion found with ID: {ingestion_id}")
+            ingestion = json.loads(ingestion_response)
 
-        print(f"Successfully downloaded blob for analyzing: {blob_name} with document ID: {doc_id}", flush=True)
+            # Get the blob client for the specific blob
+            stage = "downloading the blob"
+            container_client = get_container_client(dapr_client)
+            blob_client = container_client.get_blob_client(blob=blob_name)
+        
+            fr_endpoint = get_secret(dapr_client, "FORM_RECOGNIZER_ENDPOINT")
+            fr_key = get_secret(dapr_client, "FORM_RECOGNIZER_KEY")
 
-        # Process the page with Azure Form Recognizer
-        fr_endpoint = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["FORM_RECOGNIZER_ENDPOINT"]
-        fr_key = dapr_client.get_secret(store_name=secret_store, key="secretstore").secret["FORM_RECOGNIZER_KEY"]
+            # Download the blob with parallel ranged reads into a spooled file, large scans go to disk instead of memory
+            with track_call("blob", "download_blob"):
+                blob_stream, blob_size = download_to_spool(blob_client)
+            observe_payload("blob", blob_size)
 
-        form_recognizer_result = process_with_form_recognizer(blob_content, fr_endpoint, fr_key)
+            print(f"Successfully downloaded blob for analyzing: {blob_name} with document ID: {doc_id}", flush=True)
 
-        # print byte size and amount of characters of form_recognizer_result
-        print(f"form_recognizer_result byte size: {len(json.dumps(form_recognizer_result))}", flush=True)
+            # Process the page with Azure Form Recognizer, streaming the document from the spooled file
+            stage = "analyzing the document with Form Recognizer"
+            with blob_stream:
+                form_recognizer_result = process_with_form_recognizer(blob_stream, fr_endpoint, fr_key)
 
-        sections = list(create_sections(blob_name.split('/')[-1], form_recognizer_result, doc_id, ingestion_id))
+            if form_recognizer_result is None:
+                raise ValueError(f"Form Recognizer could not analyze {blob_name}")
 
-        # print section size of list
-        print(f"entire sections size: {len(sections)}", flush=True)
+            # print the size of form_recognizer_result without serializing it
+            content, pages, tables = form_recognizer_result
+            print(f"form_recognizer_result size: {len(content)} characters, {len(pages)} pages, {len(tables)} tables", flush=True)
 
-        batch_nr = 1  # Initialize batch number
-        batch_content = []
-        total_batch_size = math.ceil(len(sections) / BATCH_SIZE)
+            # a retry of a document that failed partway skips the batches it submitted before, they hold
+            # an in-flight slot and are in the backlog already
+            submitted_key = submitted_batches_key(doc_id, content_version)
+            submitted_batches = int(dapr_client.get_state(store_name="statestore", key=submitted_key).data or 0)
 
-        print(f"total batch size: {total_batch_size}", flush=True)
+            batch_nr = 0
+            batch_content = []
+            section_count = 0
+            kept_count = 0
+            parked_batches = 0
+            duplicates = []
 
-        ## loop through sections, append to batch_content, and save content in Redis and publish event for each full batch
-        for section in sections:
-            batch_content.append(section)
-            if len(batch_content) == BATCH_SIZE:  # Check if the batch size is reached
-                save_and_publish_batch(ingestion_id, doc_id, batch_nr, batch_content, total_batch_size)
-                # Reset the batch content and increment the batch number
-                batch_content = []
+            def submit(batch_content):
+                nonlocal batch_nr, parked_batches
                 batch_nr += 1
+                if batch_nr <= submitted_batches:
+                    return
+                batch_event = {
+                    "ingestion_id": ingestion_id,
+                    "doc_id": doc_id,
+                    "batch_key": f"section-output-{doc_id}-batch-{batch_nr}",
+                    "batch_nr": batch_nr,
+                    "priority": priority,
+                    "vector_config": vector_config,
+                    "enrichment_mode": ENRICHMENT_MODE,
+                    "content_version": content_version
+                }
+                if not submit_batch(container_client, batch_event, batch_content):
+                    parked_batches += 1
+                dapr_client.save_state(store_name="statestore", key=submitted_key, value=str(batch_nr),
+                                       state_metadata={"ttlInSeconds": str(INFLIGHT_TTL_IN_SECONDS)})
+
+            # page assembly and chunking are CPU bound, a worker process does them and sends the sections
+            # back in groups while it chunks, so the first batches are enriched before the document is chunked
+            group_size = BATCH_SIZE * NEAR_DUPLICATE_GROUP_BATCHES if NEAR_DUPLICATE_THRESHOLD else BATCH_SIZE
+            signatures = section_signatures if NEAR_DUPLICATE_THRESHOLD else None
+            stage = "chunking the document"
+            with track_call("chunking_pool", "stream_sections"):
+                for sections, section_group_signatures in chunking_pool.stream(stream_sections, blob_name.split('/')[-1], form_recognizer_result,
+                                                                               doc_id, ingestion_id, group_size, signatures):
+                    section_count += len(sections)
+                    if NEAR_DUPLICATE_THRESHOLD:
+                        stage = "looking up near duplicates"
+                        sections, group_duplicates = drop_near_duplicates(ingestion_id, doc_id, sections, section_group_signatures, kept_count)
+                        duplicates.extend(group_duplicates)
+                    kept_count += len(sections)
+
+                    ## append the sections to batch_content, and save content in Redis and publish event for each full batch
+                    stage = "publishing batches"
+                    for section in sections:
+                        batch_content.append(section)
+                        if len(batch_content) == BATCH_SIZE:
+                            submit(batch_content)
+                            batch_content = []
+                    stage = "chunking the document"
 
-        # Check if there are any sections left in the batch_content after the loop
-        if batch_content:
-            save_and_publish_batch(ingestion_id, doc_id, batch_nr, batch_content, total_batch_size)
-            
+            # Check if there are any sections left in the batch_content after the loop
+            stage = "publishing batches"
+            if batch_content:
+                submit(batch_content)
+
+            stage = "recording near duplicates"
+            if NEAR_DUPLICATE_THRESHOLD and section_count:
+                record_near_duplicates(ingestion_id, section_count, kept_count)
+            if duplicates and NEAR_DUPLICATE_MODE == "reuse":
+                # recorded before the document completes, document-completed indexes them at the end of the ingestion
+                save_near_duplicates(container_client, ingestion_id, doc_id, duplicates)
+
+            print(f"entire sections size: {kept_count}, published in {batch_nr} batches", flush=True)
+            if submitted_batches:
+                print(f"Skipped {min(submitted_batches, batch_nr)} batches submitted before the retry", flush=True)
+
+            stage = "completing the document"
+            if parked_batches:
+                print(f"Parked {parked_batches} of {batch_nr} batches until enrichment catches up", flush=True)
+                # slots may have been released while parking, before any release event could pick the batches up
+                publish_pending_batches(container_client, ingestion_id)
+
+            if batch_nr == 0:
+                # nothing to enrich, e.g. all sections are near duplicates, so no batch will complete the document
+                publish_document_completed(ingestion_id, doc_id)
+            else:
+                # the batches may be enriched already, the seal tells enrichment-completed how many there are
+                seal_document(dapr_client, container_client, ingestion, ingestion_id, doc_id, batch_nr, content_version)
+
+            backlog.dequeue(dapr_client, source_topic, ingestion_id, doc_id)
 
     except Exception as e:
-        print(f"An error occurred while downloading the blob: {e}", flush=True)
-        return json.dumps({"success": False, "error": str(e)}), 500
+        print(f"An error occurred while {stage} for {blob_name} with document ID: {doc_id}: {type(e).__name__}: {e}", flush=True)
+        traceback.print_exc()
+        return json.dumps({"success": False, "stage": stage, "error": str(e)}), 500
     
     return json.dumps({"success": True}), 200, {"ContentType": "application/json"}
 
+@app.route("/batch-released", methods=["POST"])
+@observe_handler
+@when_ready
+def batch_released_subscriber():
+    event = from_http(request.headers, request.get_data())
+    data = json.loads(event.data)
+    ingestion_id = data["ingestion_id"]
+
+    try:
+        # the slot is held by the batch, a redelivered release finds it given back already
+        release_batch_slot(ingestion_id, backlog.batch_item(data["doc_id"], data["batch_nr"]))
+    except Exception as e:
+        print(f"An error occurred while releasing a batch: {e}", flush=True)
+        return json.dumps({"success": False, "error": str(e)}), 500
+
+    try:
+        publish_pending_batches(get_container_client(dapr_client), ingestion_id)
+    except Exception as e:
+        # the redelivery finds the slot released and only publishes the pending batches
+        print(f"An error occurred while publishing pending batches: {e}", flush=True)
+        return json.dumps({"success": False, "error": str(e)}), 500
+
+    return json.dumps({"success": True}), 200, {"ContentType": "application/json"}
+
 
+# the chunking pool is forked above, before the warm-up thread starts
+start_up(app, dapr_client, modules=("azure.storage.blob", "azure.ai.formrecognizer"), clients=(warm_up_clients,),
+         health_checks=(chunking_pool_health,))
 app.run(port=app_port)
@@ -1,10 +1,30 @@
 import html
-from azure.ai.formrecognizer import DocumentAnalysisClient
+import itertools
+import math
+import multiprocessing
+import os
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from azure.core.credentials import AzureKeyCredential
+from common.telemetry import track_call
 
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
+# characters of pages split_text assembles at least at a time
+READ_AHEAD_CHARS = 64 * 1024
+
+# Attribute view of a compact layout (see to_layout), with the names of the Form Recognizer SDK
+# models so build_page_map works on both
+Layout = namedtuple("Layout", ["content", "pages", "tables"])
+Page = namedtuple("Page", ["spans"])
+Span = namedtuple("Span", ["offset", "length"])
+Table = namedtuple("Table", ["row_count", "bounding_regions", "spans", "cells"])
+BoundingRegion = namedtuple("BoundingRegion", ["page_number"])
+Cell = namedtuple("Cell", ["kind", "row_index", "column_index", "row_span", "column_span", "content"])
 
 def table_to_html(table):
     table_html = "<table>"
@@ -21,50 +41,224 @@ def table_to_html(table):
     table_html += "</table>"
     return table_html
 
-def process_with_form_recognizer(blob_content, fr_endpoint, fr_key):
+def build_page_map(form_recognizer_results):
+    return list(iter_pages(form_recognizer_results))
+
+def iter_pages(form_recognizer_results):
+    """
+    Yields the (page number, offset, text) of the pages one by one, tables as html
+    """
     offset = 0
-    page_map = []
 
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
+
+        # mark all positions of the table spans in the page
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+        table_chars = [-1]*page_length
+        for table_id, table in enumerate(tables_on_page):
+            for span in table.spans:
+                # replace all table spans with "table_id" in table_chars array
+                for i in range(span.length):
+                    idx = span.offset - page_offset + i
+                    if idx >=0 and idx < page_length:
+                        table_chars[idx] = table_id
+
+        # build page text by replacing characters in table spans with table html
+        page_text = ""
+        added_tables = set()
+        for idx, table_id in enumerate(table_chars):
+            if table_id == -1:
+                page_text += form_recognizer_results.content[page_offset + idx]
+            elif table_id not in added_tables:
+                page_text += table_to_html(tables_on_page[table_id])
+                added_tables.add(table_id)
+
+        page_text += " "
+        yield (page_num, offset, page_text)
+        offset += len(page_text)
+
+def to_layout(form_recognizer_results):
+    """
+    Keeps only the content, page spans and tables of a layout result, as plain tuples that are cheap
+    to pickle to a chunking worker: (content, [(offset, length)], [(row_count, page_number, spans, cells)])
+    """
+    return (
+        form_recognizer_results.content,
+        [(page.spans[0].offset, page.spans[0].length) for page in form_recognizer_results.pages],
+        [(
+            table.row_count,
+            table.bounding_regions[0].page_number,
+            [(span.offset, span.length) for span in table.spans],
+            [(cell.kind, cell.row_index, cell.column_index, cell.row_span, cell.column_span, cell.content) for cell in table.cells]
+        ) for table in (form_recognizer_results.tables or [])]
+    )
+
+def from_layout(layout):
+    content, pages, tables = layout
+    return Layout(
+        content=content,
+        pages=[Page([Span(*span)]) for span in pages],
+        tables=[Table(row_count, [BoundingRegion(page_number)], [Span(*span) for span in spans], [Cell._make(cell) for cell in cells])
+                for row_count, page_number, spans, cells in tables]
+    )
+
+def available_cpus():
+    """
+    Number of cores the container may use, taking the CPU affinity and the cgroup CPU quota into account
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    quota = None
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+            if limit != "max":
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus or 1)
+
+# queue the streams of a chunking worker are sent back on, inherited when the worker is forked
+_stream_queue = None
+
+def _set_stream_queue(stream_queue):
+    global _stream_queue
+    _stream_queue = stream_queue
+
+def _run_stream(stream_id, fn, args):
+    try:
+        for value in fn(*args):
+            _stream_queue.put((stream_id, value))
+    finally:
+        # end of the stream, the result of the future tells whether it failed
+        _stream_queue.put((stream_id, None))
+
+class ChunkingPool(ProcessPoolExecutor):
+    """
+    Process pool whose workers can send values back while they run, see stream()
+    """
+    def __init__(self, max_workers, mp_context):
+        self._stream_queue = mp_context.Queue()
+        super().__init__(max_workers=max_workers, mp_context=mp_context,
+                         initializer=_set_stream_queue, initargs=(self._stream_queue,))
+        self._streams = {}
+        self._stream_ids = itertools.count()
+        self._streams_lock = threading.Lock()
+        self._router = None
+
+    def stream(self, fn, *args):
+        """
+        Runs the generator function fn(*args) in a worker and yields its values as soon as they are
+        produced. fn must not yield None.
+        """
+        stream_id = next(self._stream_ids)
+        values = queue.Queue()
+        with self._streams_lock:
+            self._streams[stream_id] = values
+            if self._router is None:
+                self._router = threading.Thread(target=self._route, name="chunking-streams", daemon=True)
+                self._router.start()
+
+        try:
+            future = self.submit(_run_stream, stream_id, fn, args)
+            while True:
+                try:
+                    value = values.get(timeout=1)
+                except queue.Empty:
+                    # a worker that died never ends its stream
+                    if future.done() and future.exception():
+                        raise future.exception()
+                    continue
+                if value is None:
+                    break
+                yield value
+            future.result()
+        finally:
+            with self._streams_lock:
+                del self._streams[stream_id]
+
+    @property
+    def broken(self):
+        """
+        Whether a worker died, the executor then fails everything submitted to it from then on
+        """
+        return bool(self._broken)
+
+    def _route(self):
+        while True:
+            stream_id, value = self._stream_queue.get()
+            with self._streams_lock:
+                values = self._streams.get(stream_id)
+            # values of a stream that was abandoned are dropped
+            if values is not None:
+                values.put(value)
+
+def create_chunking_pool(max_workers=None):
+    """
+    Starts a pool of processes for the chunking, so it isn't limited to a single core by the GIL.
+    The workers are forked right away: create the pool before starting any threads.
+    """
+    pool = ChunkingPool(max_workers=max_workers or available_cpus(), mp_context=multiprocessing.get_context("fork"))
+    pool.submit(os.getpid).result()
+    return pool
+
+def chunk_document(filename, layout, doc_id, ingestion_id):
+    """
+    Turns a compact layout into sections, runs in a chunking worker
+    """
+    return list(create_sections(filename, build_page_map(from_layout(layout)), doc_id, ingestion_id))
+
+def stream_sections(filename, layout, doc_id, ingestion_id, group_size, signatures=None):
+    """
+    Turns a compact layout into sections and yields them in groups of group_size while the rest of
+    the document is chunked, each group with signatures(contents) when given. Runs in a chunking
+    worker through ChunkingPool.stream.
+    """
+    group = []
+    for section in create_sections(filename, iter_pages(from_layout(layout)), doc_id, ingestion_id):
+        group.append(section)
+        if len(group) == group_size:
+            yield group, signatures([section["content"] for section in group]) if signatures else None
+            group = []
+    if group:
+        yield group, signatures([section["content"] for section in group]) if signatures else None
+
+@lru_cache(maxsize=None)
+def create_form_recognizer_client(fr_endpoint, fr_key):
+    """
+    Form Recognizer client of the endpoint, created once so its connections are reused. The SDK is
+    imported on first use, the chunking workers never need it.
+    """
+    from azure.ai.formrecognizer import DocumentAnalysisClient
+    return DocumentAnalysisClient(
+        endpoint=fr_endpoint,
+        credential=AzureKeyCredential(fr_key),
+        headers={"x-ms-useragent": "azure-ingestion-app/1.0.0"}
+    )
+
+def process_with_form_recognizer(document, fr_endpoint, fr_key):
     try:
         # Send the stream to Azure Form Recognizer for analysis
-        form_recognizer_client = DocumentAnalysisClient(
-            endpoint=fr_endpoint,
-            credential=AzureKeyCredential(fr_key),
-            headers={"x-ms-useragent": "azure-ingestion-app/1.0.0"}
-        )
-        poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document=blob_content)
-        form_recognizer_results = poller.result()
-
-        for page_num, page in enumerate(form_recognizer_results.pages):
-            tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
-
-            # mark all positions of the table spans in the page
-            page_offset = page.spans[0].offset
-            page_length = page.spans[0].length
-            table_chars = [-1]*page_length
-            for table_id, table in enumerate(tables_on_page):
-                for span in table.spans:
-                    # replace all table spans with "table_id" in table_chars array
-                    for i in range(span.length):
-                        idx = span.offset - page_offset + i
-                        if idx >=0 and idx < page_length:
-                            table_chars[idx] = table_id
-
-            # build page text by replacing characters in table spans with table html
-            page_text = ""
-            added_tables = set()
-            for idx, table_id in enumerate(table_chars):
-                if table_id == -1:
-                    page_text += form_recognizer_results.content[page_offset + idx]
-                elif table_id not in added_tables:
-                    page_text += table_to_html(tables_on_page[table_id])
-                    added_tables.add(table_id)
-
-            page_text += " "
-            page_map.append((page_num, offset, page_text))
-            offset += len(page_text)
-
-        return page_map
+        form_recognizer_client = create_form_recognizer_client(fr_endpoint, fr_key)
+        with track_call("form_recognizer", "analyze_document"):
+            poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document=document)
+            form_recognizer_results = poller.result()
+
+        return to_layout(form_recognizer_results)
 
     except Exception as e:
         # Handle exceptions as needed
@@ -76,15 +270,40 @@ def split_text(page_map, filename):
     WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
     # print(f"Splitting '{filename}' into sections", flush=True)
 
+    # The pages are read as the sections need them, so the first sections are produced before the
+    # last pages are assembled. A section looks at most MAX_SECTION_LENGTH + SENTENCE_SEARCH_LIMIT
+    # characters ahead of its start, with that much text read the sections are the same as with
+    # the whole text. The text is read ahead in growing steps, so it is copied a few times only.
+    pages = iter(page_map)
+    page_offsets = []
+    complete = False
+
+    def read_until(text, position):
+        nonlocal complete
+        if complete or len(text) > position:
+            return text, len(text)
+
+        target = max(position, len(text) + max(READ_AHEAD_CHARS, len(text) // 4))
+        read, length = [text], len(text)
+        while length <= target:
+            page = next(pages, None)
+            if page is None:
+                complete = True
+                break
+            page_offsets.append(page[1])
+            read.append(page[2])
+            length += len(page[2])
+        text = "".join(read)
+        return text, len(text)
+
     def find_page(offset):
-        num_pages = len(page_map)
+        num_pages = len(page_offsets)
         for i in range(num_pages - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
+            if offset >= page_offsets[i] and offset < page_offsets[i + 1]:
                 return i
         return num_pages - 1
 
-    all_text = "".join(p[2] for p in page_map)
-    length = len(all_text)
+    all_text, length = read_until("", MAX_SECTION_LENGTH + SENTENCE_SEARCH_LIMIT)
     start = 0
     end = length
     while start + SECTION_OVERLAP < length:
@@ -127,6 +346,8 @@ def split_text(page_map, filename):
         else:
             start = end - SECTION_OVERLAP
 
+        all_text, length = read_until(all_text, start + MAX_SECTION_LENGTH + SENTENCE_SEARCH_LIMIT)
+
     if start + SECTION_OVERLAP < end:
         yield (all_text[start:end], find_page(start))
         
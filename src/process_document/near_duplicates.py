@@ -0,0 +1,239 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import zlib
+from functools import lru_cache
+
+import numpy as np
+from dapr.clients.grpc._state import Concurrency, StateItem, StateOptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from common.state import STATE_CONFLICT_ERRORS
+from common.telemetry import count_retry
+
+# MinHash signatures of word shingles, with locality sensitive hashing (LSH) over bands of the
+# signature to find candidate near duplicates without comparing every pair of sections
+NUM_PERM = 128
+SHINGLE_SIZE = 3
+PRIME = 4294967291  # largest prime below 2**32, so a * x + b fits in 64 bits
+
+_random_state = np.random.RandomState(1)
+PERMUTATION_A = _random_state.randint(1, PRIME, size=NUM_PERM, dtype=np.uint64)
+PERMUTATION_B = _random_state.randint(0, PRIME, size=NUM_PERM, dtype=np.uint64)
+
+BULK_STATE_KEYS = 1000
+
+# The LSH index of an ingestion: the band buckets of the kept sections are spread over this many
+# shards of {bucket: section}, and the signatures of the sections kept together are stored in a
+# single key. A shard key holds at most NEAR_DUPLICATE_SHARD_BUCKETS buckets, a full one spills
+# over into two keys a level down, split by the bits of the bucket, so a bucket is looked up in a
+# few small keys however many sections are kept.
+NEAR_DUPLICATE_INDEX_SHARDS = int(os.getenv("NEAR_DUPLICATE_INDEX_SHARDS", "65536"))
+NEAR_DUPLICATE_SHARD_BUCKETS = int(os.getenv("NEAR_DUPLICATE_SHARD_BUCKETS", "128"))
+WORD_PATTERN = re.compile(r"\w+")
+
+def shingles(text):
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def minhash(text):
+    """
+    Returns the MinHash signature of a text as bytes, or None when it has no words
+    """
+    text_shingles = shingles(text)
+    if not text_shingles:
+        return None
+    hashes = np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in text_shingles], dtype=np.uint64) % PRIME
+    permuted = (PERMUTATION_A[:, None] * hashes[None, :] + PERMUTATION_B[:, None]) % PRIME
+    return permuted.min(axis=1).astype(np.uint32).tobytes()
+
+def section_signatures(texts):
+    """
+    MinHash signatures of the given section contents, runs in a chunking worker
+    """
+    return [minhash(text) for text in texts]
+
+def similarity(signature_a, signature_b):
+    """
+    Estimated Jaccard similarity of the shingles of two signed texts
+    """
+    return float(np.mean(np.frombuffer(signature_a, dtype=np.uint32) == np.frombuffer(signature_b, dtype=np.uint32)))
+
+# A missed near duplicate is enriched and indexed, a false candidate only costs a signature
+# comparison, so the LSH parameters weigh misses much heavier
+FALSE_POSITIVE_WEIGHT = 0.1
+FALSE_NEGATIVE_WEIGHT = 0.9
+
+@lru_cache()
+def lsh_parameters(threshold, num_perm=NUM_PERM):
+    """
+    Returns the (bands, rows) split of the signature that minimizes the weighted chance of missing
+    a pair above the threshold and of comparing a pair below it
+    """
+    def integrate(f, start, end, steps=100):
+        width = (end - start) / steps
+        return sum(f(start + (i + 0.5) * width) for i in range(steps)) * width
+
+    best = None
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            false_positives = integrate(lambda s: 1 - (1 - s ** rows) ** bands, 0.0, threshold)
+            false_negatives = integrate(lambda s: (1 - s ** rows) ** bands, threshold, 1.0)
+            error = FALSE_POSITIVE_WEIGHT * false_positives + FALSE_NEGATIVE_WEIGHT * false_negatives
+            if best is None or error < best[0]:
+                best = (error, bands, rows)
+    return best[1], best[2]
+
+def band_buckets(signature, bands, rows):
+    return [
+        hashlib.blake2b(bytes([band]) + signature[band * rows * 4:(band + 1) * rows * 4], digest_size=8).hexdigest()
+        for band in range(bands)
+    ]
+
+def bucket_key(ingestion_id, bucket, level=0):
+    value = int(bucket, 16)
+    shard = value % NEAR_DUPLICATE_INDEX_SHARDS
+    if not level:
+        return f"near-duplicate-bands-{ingestion_id}-{shard}"
+    # the bits above the shard pick one of the 2 ** level keys of the level
+    return f"near-duplicate-bands-{ingestion_id}-{shard}-{level}-{(value // NEAR_DUPLICATE_INDEX_SHARDS) % 2 ** level}"
+
+def signatures_key(group_id):
+    return f"near-duplicate-signatures-{group_id}"
+
+def get_bulk(dapr_client, store_name, keys):
+    """
+    Returns the state items of the keys that have a value
+    """
+    items = {}
+    keys = list(keys)
+    for i in range(0, len(keys), BULK_STATE_KEYS):
+        batch = dapr_client.get_bulk_state(store_name=store_name, keys=keys[i:i + BULK_STATE_KEYS], parallelism=10).items
+        items.update({item.key: item for item in batch if item.data})
+    return items
+
+def remove_near_duplicates(dapr_client, store_name, ingestion_id, sections, signatures, threshold, ttl_in_seconds, locate):
+    """
+    Removes the sections that are near duplicates of a section seen before in the same ingestion,
+    in this or another document, and adds the remaining sections to the ingestion's LSH index in
+    the state store. locate(i) returns the (doc_id, batch_nr) the i-th remaining section is
+    published in. Returns the remaining sections and the removed ones as (section, canonical)
+    pairs, canonical being the {"id", "doc_id", "batch_nr"} of the section it duplicates.
+
+    Documents processed at the same time may both keep a near duplicate section, the index is
+    best effort.
+    """
+    bands, rows = lsh_parameters(threshold)
+    section_buckets = [band_buckets(signature, bands, rows) if signature else [] for signature in signatures]
+
+    # one lookup for all buckets of the sections, then one for the signatures of the candidates
+    wanted = {bucket for buckets in section_buckets for bucket in buckets}
+    indexed, _ = lookup_buckets(dapr_client, store_name, ingestion_id, wanted)
+    known_signatures = {}
+    for key, item in get_bulk(dapr_client, store_name, {signatures_key(ref.split("#")[0]) for ref in indexed.values()}).items():
+        group = json.loads(item.data)
+        for i, (section_id, signature, (doc_id, batch_nr)) in enumerate(zip(group["ids"], group["signatures"], group["locations"])):
+            known_signatures[f"{key[len(signatures_key('')):]}#{i}"] = (section_id, base64.b64decode(signature),
+                                                                        {"id": section_id, "doc_id": doc_id, "batch_nr": batch_nr})
+
+    kept_sections = []
+    duplicates = []
+    # the sections kept here are referenced as <group>#<position>, the group named after the first kept section
+    group_id = None
+    group = {"ids": [], "signatures": [], "locations": []}
+    new_buckets = {}
+    for section, signature, buckets in zip(sections, signatures, section_buckets):
+        # candidates share at least one band, keep the section unless one is similar enough. A
+        # retried document finds its own sections in the index, those don't count
+        candidates = {indexed[bucket] for bucket in buckets if bucket in indexed}
+        scores = [(similarity(signature, known_signatures[ref][1]), known_signatures[ref][2]) for ref in candidates
+                  if ref in known_signatures and known_signatures[ref][0] != section["id"]]
+        score, canonical = max(scores, key=lambda scored: scored[0], default=(0, None))
+        if score >= threshold:
+            duplicates.append((section, canonical))
+            continue
+
+        location = locate(len(kept_sections))
+        kept_sections.append(section)
+        if signature is None:
+            continue
+        group_id = group_id or hashlib.blake2b(section["id"].encode("utf-8"), digest_size=6).hexdigest()
+        ref = f"{group_id}#{len(group['ids'])}"
+        group["ids"].append(section["id"])
+        group["signatures"].append(base64.b64encode(signature).decode("ascii"))
+        group["locations"].append(location)
+        known_signatures[ref] = (section["id"], signature, {"id": section["id"], "doc_id": location[0], "batch_nr": location[1]})
+        for bucket in buckets:
+            # the first section in a bucket stays its canonical section
+            if bucket not in indexed:
+                indexed[bucket] = ref
+                new_buckets[bucket] = ref
+
+    if group_id:
+        # the signatures are stored before the buckets that refer to them
+        dapr_client.save_state(store_name=store_name, key=signatures_key(group_id), value=json.dumps(group),
+                               state_metadata={"ttlInSeconds": str(ttl_in_seconds)})
+        add_buckets(dapr_client, store_name, ingestion_id, new_buckets, ttl_in_seconds)
+
+    return kept_sections, duplicates
+
+def lookup_buckets(dapr_client, store_name, ingestion_id, buckets):
+    """
+    Returns the {bucket: section} of the buckets that are in the index and the shard keys read on
+    the way as {key: (value, etag)}, etag None for a key that has no value. A bucket is looked up
+    a level further down as long as its shard key at the level above is full.
+    """
+    found = {}
+    pages = {}
+    pending = set(buckets)
+    level = 0
+    while pending:
+        keys = {bucket_key(ingestion_id, bucket, level) for bucket in pending}
+        items = get_bulk(dapr_client, store_name, keys)
+        pages.update({key: (json.loads(items[key].data), items[key].etag) if key in items else ({}, None) for key in keys})
+        next_pending = set()
+        for bucket in pending:
+            value = pages[bucket_key(ingestion_id, bucket, level)][0]
+            if bucket in value:
+                found[bucket] = value[bucket]
+            elif len(value) >= NEAR_DUPLICATE_SHARD_BUCKETS:
+                next_pending.add(bucket)
+        pending = next_pending
+        level += 1
+    return found, pages
+
+@retry(stop=stop_after_attempt(10), wait=wait_random_exponential(multiplier=0.05, max=2),
+       retry=retry_if_exception_type(STATE_CONFLICT_ERRORS), before_sleep=count_retry("statestore"))
+def add_buckets(dapr_client, store_name, ingestion_id, new_buckets, ttl_in_seconds):
+    """
+    Merges {bucket: section} into the shard keys of the index with optimistic concurrency, each
+    bucket into the first key on its way down that isn't full. A bucket that another document
+    filled in the meantime keeps its section.
+    """
+    found, pages = lookup_buckets(dapr_client, store_name, ingestion_id, new_buckets)
+    changed = set()
+    for bucket, ref in new_buckets.items():
+        if bucket in found:
+            continue
+        level = 0
+        while len(pages[bucket_key(ingestion_id, bucket, level)][0]) >= NEAR_DUPLICATE_SHARD_BUCKETS:
+            level += 1
+            key = bucket_key(ingestion_id, bucket, level)
+            if key not in pages:
+                # a key this document filled up, the level below wasn't read yet
+                item = dapr_client.get_state(store_name=store_name, key=key)
+                pages[key] = (json.loads(item.data), item.etag) if item.data else ({}, None)
+        key = bucket_key(ingestion_id, bucket, level)
+        pages[key][0][bucket] = ref
+        changed.add(key)
+
+    states = [StateItem(key=key, value=json.dumps(pages[key][0]), etag=pages[key][1],
+                        options=None if pages[key][1] else StateOptions(concurrency=Concurrency.first_write),
+                        metadata={"ttlInSeconds": str(ttl_in_seconds)})
+              for key in changed]
+    for i in range(0, len(states), BULK_STATE_KEYS):
+        dapr_client.save_bulk_state(store_name=store_name, states=states[i:i + BULK_STATE_KEYS])